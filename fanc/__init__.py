@@ -24,7 +24,7 @@ from .architecture.aggregate import AggregateMatrix, aggregate_boundaries, aggre
 from .config import config
 from .general import FileBased
 from .map import *
-from .hic import Hic
+from .hic import Hic, MultiResolutionHic
 from .matrix import Edge, RegionMatrix
 from .pairs import ReadPairs
 from .peaks import RaoPeakInfo, RaoPeakCaller, RaoPeakFilter
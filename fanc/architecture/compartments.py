@@ -4,6 +4,8 @@ import genomic_regions as gr
 from .helpers import vector_enrichment_profile
 from ..matrix import RegionMatrixTable, Edge
 import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
 from ..tools.general import RareUpdateProgressBar
 from ..config import config
 from ..regions import Genome
@@ -14,6 +16,28 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def _sparse_eigenvector(m, eigenvector=0):
+    """
+    Calculate an eigenvector of a symmetric :mod:`scipy.sparse` matrix.
+
+    :param m: symmetric sparse matrix; NaN entries are treated as 0
+    :param eigenvector: 0-based index of the eigenvector, where eigenvectors
+                        are ordered by decreasing absolute eigenvalue
+    :return: :class:`~numpy.array`
+    """
+    m = sp.csr_matrix(m, dtype=np.float64)
+    m.data[np.isnan(m.data)] = 0
+
+    k = eigenvector + 1
+    if k < m.shape[0] - 1:
+        w, v = spla.eigsh(m, k=k, which='LM')
+    else:
+        # eigsh can only compute up to n - 1 eigenvectors
+        w, v = np.linalg.eigh(m.toarray())
+    ix = np.argsort(-np.abs(w))[eigenvector]
+    return v[:, ix]
+
+
 class ABCompartmentMatrix(RegionMatrixTable):
     """
     Class representing O/E correlation matrix used to derive AB compartments.
@@ -201,23 +225,13 @@ class ABCompartmentMatrix(RegionMatrixTable):
             ev = np.zeros(len(self.regions))
             if per_chromosome:
                 for chromosome_sub in self.chromosomes():
-                    m = self.matrix((chromosome_sub, chromosome_sub))
-                    m[np.isnan(m)] = 0
-                    w, v = np.linalg.eig(m)
-                    # v might end up being masked
-                    if hasattr(v, 'mask'):
-                        v.mask = False
-                    ab_vector = v[:, eigenvector]
+                    m = self.sparse_matrix((chromosome_sub, chromosome_sub))
+                    ab_vector = _sparse_eigenvector(m, eigenvector)
                     for i, region in enumerate(m.row_regions):
                         ev[region.ix] = ab_vector[i]
             else:
-                m = self.matrix()
-                m[np.isnan(m)] = 0
-                w, v = np.linalg.eig(m)
-                # v might end up being masked
-                if hasattr(v, 'mask'):
-                    v.mask = False
-                ab_vector = v[:, eigenvector]
+                m = self.sparse_matrix()
+                ab_vector = _sparse_eigenvector(m, eigenvector)
                 for i, region in enumerate(m.row_regions):
                     ev[region.ix] = ab_vector[i]
 
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 def cis_trans_ratio(hic, normalise=False):
     """
     Calculate the cis/trans ratio for a Hic object.
@@ -9,12 +12,10 @@ def cis_trans_ratio(hic, normalise=False):
     """
     cis = 0
     trans = 0
-    regions_dict = hic.regions_dict
-    for edge in hic.edges(lazy=True, norm=False):
-        if regions_dict[edge.source].chromosome == regions_dict[edge.sink].chromosome:
-            cis += edge.weight
-        else:
-            trans += edge.weight
+    for _, _, weight in hic.edge_arrays(norm=False, inter_chromosomal=False):
+        cis += np.sum(weight)
+    for _, _, weight in hic.edge_arrays(norm=False, intra_chromosomal=False):
+        trans += np.sum(weight)
     if not normalise:
         return cis / (cis + trans), cis, trans, 1.0
 
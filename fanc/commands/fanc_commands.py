@@ -787,8 +787,8 @@ def pairs_parser():
         '-t', '--threads', dest='threads',
         type=int,
         default=1,
-        help='Number of threads to use for extracting fragment information. '
-             'Default: %(default)d'
+        help='Number of threads to use for extracting fragment information '
+             'and for filtering. Default: %(default)d'
     )
 
     parser.add_argument(
@@ -1044,7 +1044,7 @@ def pairs(argv, **kwargs):
                 pairs.filter_pcr_duplicates(threshold=filter_pcr_duplicates, queue=True)
 
             logger.info("Running filters...")
-            pairs.run_queued_filters(log_progress=True)
+            pairs.run_queued_filters(log_progress=True, threads=threads)
             logger.info("Done.")
 
             pairs.close()
@@ -1243,6 +1243,16 @@ def hic_parser():
              'Otherwise matrix entries will be contact probabilities.'
     )
 
+    parser.add_argument(
+        '--out-of-core', dest='out_of_core',
+        action='store_true',
+        default=False,
+        help='Stream contacts from disk in every iteration of ICE/VC '
+             'normalisation rather than loading them into memory. '
+             'Memory usage is bounded by the "ice_memory_budget" '
+             'option in the FAN-C config file.'
+    )
+
     parser.add_argument(
         '--only-inter', dest='only_inter',
         action='store_true',
@@ -1281,7 +1291,8 @@ def hic_parser():
         '-t', '--threads', dest='threads',
         type=int,
         default=1,
-        help="Number of threads (currently used for binning only)"
+        help="Number of threads (currently used for binning, filtering and "
+             "per-chromosome ICE/VC normalisation only)"
     )
 
     parser.add_argument(
@@ -1324,6 +1335,7 @@ def hic(argv, **kwargs):
 
     whole_matrix = args.whole_matrix
     restore_coverage = args.restore_coverage
+    out_of_core = args.out_of_core
     only_interchromosomal = args.only_inter
     statistics_file = os.path.expanduser(args.stats) if args.stats is not None else None
     statistics_plot_file = os.path.expanduser(args.stats_plot) if args.stats_plot is not None else None
@@ -1367,6 +1379,9 @@ def hic(argv, **kwargs):
     if coverage_args > 1:
         parser.error("The arguments -l, -r, and -a are mutually exclusive")
 
+    if out_of_core and do_norm and norm_method.lower() == 'kr':
+        parser.error("--out-of-core is only supported for ICE and VC normalisation")
+
     if only_interchromosomal:
         whole_matrix = True
 
@@ -1543,7 +1558,7 @@ def hic(argv, **kwargs):
             logger.info("Running filters...")
             for f in filters:
                 binned_hic.filter(f, queue=True)
-            binned_hic.run_queued_filters(log_progress=True)
+            binned_hic.run_queued_filters(log_progress=True, threads=threads)
             logger.info("Done.")
 
         if statistics_file is not None or statistics_plot_file is not None or marginals_plot_file is not None:
@@ -1589,9 +1604,14 @@ def hic(argv, **kwargs):
         if do_norm:
             logger.info("Normalising binned Hic file")
 
+            norm_kwargs = dict()
+            if norm_method.lower() != 'kr':
+                norm_kwargs['threads'] = threads
+                norm_kwargs['out_of_core'] = out_of_core
+
             binned_hic.normalise(norm_method, whole_matrix=whole_matrix,
                                  intra_chromosomal=not only_interchromosomal,
-                                 restore_coverage=restore_coverage)
+                                 restore_coverage=restore_coverage, **norm_kwargs)
 
         binned_hic.close()
     finally:
@@ -1656,7 +1676,7 @@ def from_juicer_parser():
 
     parser.add_argument(
         '--juicer-tools-jar', dest='juicer_tools_jar_path',
-        help='Path to juicer jar. You can also specify this in fanc.conf'
+        help='Deprecated, juicer tools are no longer required. Ignored.'
     )
 
     parser.add_argument(
@@ -1876,7 +1896,9 @@ def to_cooler_parser():
 
     parser.add_argument(
         'input',
-        help='''Input .hic file, fanc format.'''
+        help='''Input .hic file, fanc format. Can also be a
+                multi-resolution .mhic file, in which case all
+                resolutions in the file are exported directly.'''
     )
 
     parser.add_argument(
@@ -1895,7 +1917,17 @@ def to_cooler_parser():
         '-t', '--threads', dest='threads',
         type=int,
         default=1,
-        help='Number of threads used for balancing.'
+        help='Number of threads used for exporting resolutions '
+             'and coarsening.'
+    )
+
+    parser.add_argument(
+        '-b', '--fanc-bias', dest='copy_bias',
+        action='store_true',
+        default=False,
+        help='Use the FAN-C bias vectors of all resolutions in the '
+             'input file in a multi-resolution output, instead of '
+             'balancing them with cooler.'
     )
 
     parser.add_argument(
@@ -1946,6 +1978,7 @@ def to_cooler(argv, **kwargs):
     multi = args.multi
     threads = args.threads
     natural_sort = args.natural_sort
+    copy_bias = args.copy_bias
     tmp = args.tmp
 
     resolutions = args.resolutions
@@ -1976,7 +2009,7 @@ def to_cooler(argv, **kwargs):
 
         with fanc.load(input_file, mode='r', tmpdir=tmp) as hic:
             to_cooler(hic, output_file, balance=norm, multires=multi, resolutions=resolutions,
-                      threads=threads, natural_order=natural_sort)
+                      threads=threads, natural_order=natural_sort, copy_bias=copy_bias)
     finally:
         if tmp:
             shutil.copy(output_file, original_output_file)
@@ -1988,13 +2021,14 @@ def to_cooler(argv, **kwargs):
 def to_juicer_parser():
     parser = argparse.ArgumentParser(
         prog="fanc hic_to_juicer",
-        description="Convert a ReadPairs file to Juicer .hic format"
+        description="Convert a ReadPairs or Hic file to Juicer .hic format"
     )
 
     parser.add_argument(
         'input',
         nargs='+',
-        help='Input .pairs file(s), FAN-C format.'
+        help='Input .pairs or equidistant .hic file(s), FAN-C format. '
+             'Contacts of multiple files are summed.'
     )
 
     parser.add_argument(
@@ -2004,7 +2038,7 @@ def to_juicer_parser():
 
     parser.add_argument(
         '--juicer-tools-jar', dest='juicer_tools_jar_path',
-        help='Path to juicer jar. You can also specify this in fanc.conf'
+        help='Deprecated, juicer tools are no longer required. Ignored.'
     )
 
     parser.add_argument(
@@ -2017,7 +2051,23 @@ def to_juicer_parser():
     parser.add_argument(
         '-r', '--resolutions', dest='resolutions',
         nargs='+',
-        help='Resolutions in bp at which to "zoom" the juicer matrix.'
+        help='Resolutions in bp at which to "zoom" the juicer matrix. '
+             'Default: Juicer default resolutions for .pairs files, '
+             'matrix bin size for .hic files.'
+    )
+
+    parser.add_argument(
+        '-n', '--normalisations', dest='normalisations',
+        nargs='*',
+        default=['VC', 'VC_SQRT', 'KR'],
+        help='Normalisation vectors to calculate. Default: VC VC_SQRT KR'
+    )
+
+    parser.add_argument(
+        '-t', '--threads', dest='threads',
+        type=int,
+        default=1,
+        help='Number of threads used for compressing matrix blocks. Default: %(default)d'
     )
 
     return parser
@@ -2031,6 +2081,8 @@ def to_juicer(argv, **kwargs):
     output_file = os.path.expanduser(args.output)
     juicer_tools_jar_path = args.juicer_tools_jar_path
     resolutions = args.resolutions
+    normalisations = args.normalisations
+    threads = args.threads
     tmp = args.tmp
 
     import fanc
@@ -2041,9 +2093,11 @@ def to_juicer(argv, **kwargs):
 
     pairs = [fanc.load(f, tmpdir=tmp) for f in input_files]
     try:
-        to_juicer(pairs, output_file, resolutions=resolutions,
-                  juicer_tools_jar_path=juicer_tools_jar_path,
-                  tmp=tmp)
+        juicer = to_juicer(pairs, output_file, resolutions=resolutions,
+                           juicer_tools_jar_path=juicer_tools_jar_path,
+                           normalisations=normalisations,
+                           threads=threads, tmp=tmp)
+        juicer.close()
     finally:
         for p in pairs:
             p.close()
@@ -13,9 +13,11 @@ import warnings
 from ..tools.files import tmp_file_name
 from ..tools.general import str_to_int
 import shutil
+import multiprocessing as mp
 
 
 from ..matrix import RegionMatrixContainer, Edge
+from ..hic import MultiResolutionHic
 
 logger = logging.getLogger(__name__)
 
@@ -38,13 +40,18 @@ def to_cooler(hic, path, balance=True, multires=True,
               resolutions=None, n_zooms=10, threads=1,
               chunksize=100000, max_resolution=5000000,
               natural_order=True, chromosomes=None,
-              **kwargs):
+              copy_bias=False, **kwargs):
     """
     Export Hi-C data as Cooler file.
 
     Only contacts that have not been
     filtered are exported. https://github.com/mirnylab/cooler/
 
+    Pixels are streamed to the Cooler file in chunks. If the cooler
+    chromosome order matches the order in a FAN-C file, the chunks
+    are read already sorted from the FAN-C edge tables, otherwise
+    Cooler sorts them out of memory.
+
     Single resolution files:
     If input Hi-C matrix is uncorrected, the uncorrected matrix is stored.
     If it is corrected, the uncorrected matrix is stored along with bias vector.
@@ -52,119 +59,225 @@ def to_cooler(hic, path, balance=True, multires=True,
     matrix and the bias vector.
 
     Multi-resolution files (default):
-
-
-    :param hic: Hi-C file in any compatible (RegionMatrixContainer) format
+    If the input is a :class:`~fanc.hic.MultiResolutionHic`, all resolutions
+    in it are exported directly (in parallel if threads > 1). All other
+    resolutions are coarsened by Cooler from the closest exported resolution
+    they are a multiple of. Zoom levels are balanced by Cooler, or, with
+    copy_bias, take their bias vector from FAN-C where possible.
+
+    :param hic: Hi-C file in any compatible (RegionMatrixContainer) format,
+                or a :class:`~fanc.hic.MultiResolutionHic`
     :param path: Output path for cooler file
     :param balance: Include bias vector in cooler output (single res) or perform
                     iterative correction (multi res)
     :param multires: Generate a multi-resolution cooler file
     :param resolutions: Resolutions in bp (int) for multi-resolution cooler output
-    :param chunksize: Number of pixels processed at a time in cooler
-    :param kwargs: Additional arguments passed to cooler.iterative_correction
+    :param n_zooms: Number of default zoom levels if no resolutions are provided
+    :param threads: Number of processes used for exporting FAN-C resolutions and
+                    coarsening in Cooler
+    :param chunksize: Number of pixels processed at a time
+    :param max_resolution: Largest default resolution
+    :param natural_order: Sort chromosomes in natural order
+    :param chromosomes: List of chromosomes to export, in output order
+    :param copy_bias: In multi-resolution files, use the FAN-C bias vectors of all
+                      resolutions available in the FAN-C input instead of
+                      balancing them with Cooler. Resolutions that are not
+                      normalised in FAN-C are written without weights
+    :param kwargs: Additional arguments passed to cooler.balance_cooler
     """
-    base_resolution = hic.bin_size
-
-    tmp_files = []
+    if isinstance(hic, MultiResolutionHic):
+        fanc_hics = {resolution: hic.hic(resolution) for resolution in hic.resolutions()}
+        if len(fanc_hics) == 0:
+            raise ValueError("MultiResolutionHic does not contain any matrices!")
+        file_name = hic.file.filename
+    else:
+        fanc_hics = {hic.bin_size: hic}
+        file_name = None
+    base_resolution = min(fanc_hics.keys())
+    base_hic = fanc_hics[base_resolution]
+
+    natural_key = cmp_to_key(natural_cmp)
+    if chromosomes is None:
+        chromosomes = base_hic.chromosomes()
+        if natural_order:
+            chromosomes = sorted(chromosomes, key=lambda x: natural_key(x.encode('utf-8')))
+
+    if not multires:
+        _write_cooler(base_hic, path, chromosomes, chunksize=chunksize, bias=balance)
+        return CoolerHic(path)
+
+    if resolutions is None:
+        resolutions = [base_resolution * 2 ** i for i in range(n_zooms)
+                       if base_resolution * 2 ** i < max_resolution]
+        resolutions += [r for r in fanc_hics.keys() if r < max_resolution]
+    else:
+        for r in resolutions:
+            if r % base_resolution != 0:
+                raise ValueError("Resolution {} must be a multiple of "
+                                 "base resolution {}!".format(r, base_resolution))
+    resolutions = sorted(set(resolutions) | {base_resolution})
+    fanc_resolutions = [r for r in resolutions if r in fanc_hics]
+    bias_resolutions = set(fanc_resolutions) if balance and copy_bias else set()
+
+    tmp_files = dict()
     try:
-        if multires:
-            if resolutions is None:
-                resolutions = [base_resolution * 2 ** i for i in range(n_zooms)
-                               if base_resolution * 2 ** i < max_resolution]
-            else:
-                for r in resolutions:
-                    if r % base_resolution != 0:
-                        raise ValueError("Resolution {} must be a multiple of "
-                                         "base resolution {}!".format(r, base_resolution))
-
-            single_path = tempfile.NamedTemporaryFile(delete=False, suffix='.cool').name
-            tmp_files.append(single_path)
-            multi_path = path
+        for resolution in fanc_resolutions:
+            tmp_files[resolution] = tempfile.NamedTemporaryFile(delete=False, suffix='.cool').name
+
+        if threads > 1 and len(fanc_resolutions) > 1 and file_name is not None and os.path.exists(file_name):
+            worker_args = [(file_name, resolution, tmp_files[resolution], chromosomes,
+                            chunksize, resolution in bias_resolutions)
+                           for resolution in fanc_resolutions]
+            for resolution in fanc_resolutions:
+                fanc_hics[resolution].flush()
+            hic.file.flush()
+
+            # workers cannot acquire an HDF5 file lock on a file that
+            # is open for writing
+            file_locking = os.environ.get('HDF5_USE_FILE_LOCKING')
+            os.environ['HDF5_USE_FILE_LOCKING'] = 'FALSE'
+            try:
+                with mp.get_context("spawn").Pool(min(threads, len(worker_args))) as pool:
+                    for _ in pool.imap_unordered(_to_cooler_worker, worker_args):
+                        pass
+            finally:
+                if file_locking is None:
+                    del os.environ['HDF5_USE_FILE_LOCKING']
+                else:
+                    os.environ['HDF5_USE_FILE_LOCKING'] = file_locking
         else:
-            single_path = path
-            multi_path = None
-
-        natural_key = cmp_to_key(natural_cmp)
-        if chromosomes is None:
-            chromosomes = hic.chromosomes()
-            if natural_order:
-                chromosomes = sorted(chromosomes, key=lambda x: natural_key(x.encode('utf-8')))
+            for resolution in fanc_resolutions:
+                _write_cooler(fanc_hics[resolution], tmp_files[resolution], chromosomes,
+                              chunksize=chunksize, bias=resolution in bias_resolutions)
+
+        logger.info("Copying resolutions {} to multi-resolution file".format(
+            ", ".join(str(r) for r in fanc_resolutions)))
+        with h5py.File(path, 'w') as dest:
+            for resolution in fanc_resolutions:
+                with h5py.File(tmp_files[resolution], 'r') as src:
+                    group = dest.require_group('/resolutions').create_group(str(resolution))
+                    for name in src:
+                        src.copy(name, group, name)
+                    group.attrs.update(src.attrs)
+            # same attributes as written by cooler.zoomify_cooler
+            dest.attrs.update({'format': 'HDF5::MCOOL', 'format-version': 2})
+    finally:
+        for tmp_file in tmp_files.values():
+            os.remove(tmp_file)
 
-        logger.info("Loading genomic regions")
-        ix_converter = dict()
-        regions = []
-        region_order = []
-        new_region_index = 0
-        for chromosome in chromosomes:
-            for region in hic.regions(chromosome, lazy=True):
-                regions.append((region.chromosome,
-                                region.start - 1,
-                                region.end))
-                ix_converter[region.ix] = new_region_index
-                region_order.append(region.ix)
-                new_region_index += 1
-        region_df = pandas.DataFrame(regions, columns=['chrom', 'start', 'end'])
-
-        def pixel_iter():
-            for chri in range(len(chromosomes)):
-                chromosome1 = chromosomes[chri]
-                for chrj in range(chri, len(chromosomes)):
-                    chromosome2 = chromosomes[chrj]
-
-                    logger.info("{} - {}".format(chromosome1, chromosome2))
-
-                    def chromosome_pixel_iter():
-                        for edge in hic.edges((chromosome1, chromosome2), norm=False, lazy=True):
-                            source, sink = ix_converter[edge.source], ix_converter[edge.sink]
-                            if sink < source:
-                                source, sink = sink, source
-                            yield source, sink, edge.weight
-
-                    pixels = np.fromiter(chromosome_pixel_iter(),
-                                         dtype=[("bin1_id", np.int_),
-                                                ("bin2_id", np.int_),
-                                                ("count", np.float_)])
-                    pixels = np.sort(pixels, order=("bin1_id", "bin2_id"))
+    written = list(fanc_resolutions)
+    for resolution in resolutions:
+        if resolution in written:
+            continue
+        previous = max(r for r in written if resolution % r == 0)
+        logger.info("Aggregating from {} to {}".format(previous, resolution))
+        cooler.coarsen_cooler(path + "::resolutions/{}".format(previous),
+                              path + "::resolutions/{}".format(resolution),
+                              resolution // previous, chunksize, nproc=threads, mode='r+')
+        written.append(resolution)
+
+    if balance:
+        logger.info("Balancing zoom resolutions...")
+        for resolution in resolutions:
+            if resolution in bias_resolutions:
+                continue
+            uri = path + "::resolutions/" + str(resolution)
+            bias, stats = cooler.balance_cooler(cooler.Cooler(uri), chunksize=chunksize, **kwargs)
+            _write_cooler_bias(uri, bias, stats)
+    return CoolerHic(path + '::resolutions/{}'.format(base_resolution))
+
+
+def _to_cooler_worker(args):
+    file_name, resolution, path, chromosomes, chunksize, bias = args
+    with MultiResolutionHic(file_name=file_name, mode='r') as mhic:
+        _write_cooler(mhic.hic(resolution), path, chromosomes, chunksize=chunksize, bias=bias)
+    return resolution
+
+
+def _write_cooler(hic, path, chromosomes, chunksize=100000, bias=True):
+    """
+    Write a single resolution Cooler file, streaming pixels in chunks.
+
+    :param hic: :class:`~fanc.matrix.RegionMatrixContainer`
+    :param path: Output cooler URI
+    :param chromosomes: List of chromosomes in output order
+    :param chunksize: Approximate number of pixels per chunk
+    :param bias: If True, write the bias vector of hic as cooler weights,
+                 unless hic is not normalised
+    """
+    logger.info("Loading genomic regions")
+    regions = []
+    region_order = []
+    for chromosome in chromosomes:
+        for region in hic.regions(chromosome, lazy=True):
+            regions.append((region.chromosome,
+                            region.start - 1,
+                            region.end))
+            region_order.append(region.ix)
+    region_df = pandas.DataFrame(regions, columns=['chrom', 'start', 'end'])
+    region_order = np.array(region_order, dtype=np.int64)
+
+    # vectorized map of matrix region indexes to cooler bin indexes
+    ix_converter = np.full(len(hic.regions), -1, dtype=np.int64)
+    ix_converter[region_order] = np.arange(len(region_order))
+
+    def pixel_frame(source, sink, weight):
+        bin1, bin2 = ix_converter[source], ix_converter[sink]
+        selected = (bin1 >= 0) & (bin2 >= 0)
+        if not selected.all():
+            bin1, bin2, weight = bin1[selected], bin2[selected], weight[selected]
+        return pandas.DataFrame({'bin1_id': np.minimum(bin1, bin2),
+                                 'bin2_id': np.maximum(bin1, bin2),
+                                 'count': weight})
+
+    def sorted_pixel_iter():
+        for source, sink, weight in hic._sorted_edge_arrays(chunk_size=chunksize):
+            pixels = pixel_frame(source, sink, weight)
+            if len(pixels) > 0:
+                yield pixels
+
+    def pixel_iter():
+        for chri in range(len(chromosomes)):
+            chromosome1 = chromosomes[chri]
+            for chrj in range(chri, len(chromosomes)):
+                chromosome2 = chromosomes[chrj]
+
+                logger.info("{} - {}".format(chromosome1, chromosome2))
+                for source, sink, weight in hic.edge_arrays((chromosome1, chromosome2), norm=False,
+                                                            check_valid=False, chunk_size=chunksize):
+                    pixels = pixel_frame(source, sink, weight)
                     if len(pixels) > 0:
-                        yield pandas.DataFrame(pixels)
-
-        logger.info("Writing cooler")
-        cooler.create_cooler(cool_uri=single_path, bins=region_df, pixels=pixel_iter(), ordered=False)
-
-        cool_path, group_path = cooler.util.parse_cooler_uri(single_path)
-
-        if not multires:
-            if balance:
-                logger.info("Writing bias vector from FAN-C matrix")
-                bias = hic.bias_vector()[np.array(region_order)]
-
-                # Copied this section from
-                # https://github.com/mirnylab/cooler/blob/356a89f6a62e2565f42ff13ec103352f20d251be/cooler/cli/balance.py#L195
-                with h5py.File(cool_path, 'r+') as h5:
-                    grp = h5[group_path]
-                    # add the bias column to the file
-                    h5opts = dict(compression='gzip', compression_opts=6)
-                    grp['bins'].create_dataset("weight", data=bias, **h5opts)
-            return CoolerHic(single_path)
+                        yield pixels
+
+    # FAN-C tables can be read in cooler order if that preserves the region order
+    selected_bins = ix_converter[ix_converter >= 0]
+    ordered = hasattr(hic, '_sorted_edge_arrays') and np.all(np.diff(selected_bins) > 0)
+
+    logger.info("Writing cooler")
+    cooler.create_cooler(cool_uri=path, bins=region_df,
+                         pixels=sorted_pixel_iter() if ordered else pixel_iter(),
+                         ordered=ordered)
+
+    if bias:
+        bias_vector = hic.bias_vector()[region_order]
+        if np.all(bias_vector == 1):
+            logger.info("FAN-C matrix is not normalised, not writing bias vector")
         else:
-            cooler.zoomify_cooler(single_path, multi_path, resolutions, chunksize, nproc=threads)
-            if balance:
-                logger.info("Balancing zoom resolutions...")
-                for resolution in resolutions:
-                    uri = multi_path + "::resolutions/" + str(resolution)
-                    cool_path, group_path = cooler.util.parse_cooler_uri(uri)
-                    cool = cooler.Cooler(uri)
-                    bias, stats = cooler.balance_cooler(cool, chunksize=chunksize, **kwargs)
-                    with h5py.File(cool_path, 'r+') as h5:
-                        grp = h5[group_path]
-                        # add the bias column to the file
-                        h5opts = dict(compression='gzip', compression_opts=6)
-                        grp['bins'].create_dataset("weight", data=bias, **h5opts)
-                        grp['bins']['weight'].attrs.update(stats)
-            return CoolerHic(multi_path + '::resolutions/{}'.format(base_resolution))
-    finally:
-        for tmp_file in tmp_files:
-            os.remove(tmp_file)
+            logger.info("Writing bias vector from FAN-C matrix")
+            _write_cooler_bias(path, bias_vector)
+
+
+def _write_cooler_bias(uri, bias, stats=None):
+    # Copied this section from
+    # https://github.com/mirnylab/cooler/blob/356a89f6a62e2565f42ff13ec103352f20d251be/cooler/cli/balance.py#L195
+    cool_path, group_path = cooler.util.parse_cooler_uri(uri)
+    with h5py.File(cool_path, 'r+') as h5:
+        grp = h5[group_path]
+        # add the bias column to the file
+        h5opts = dict(compression='gzip', compression_opts=6)
+        grp['bins'].create_dataset("weight", data=bias, **h5opts)
+        if stats is not None:
+            grp['bins']['weight'].attrs.update(stats)
 
 
 class LazyCoolerEdge(object):
@@ -212,6 +325,13 @@ class LazyCoolerEdge(object):
         return ['weight']
 
 
+class _CoolerPixel(object):
+    """
+    Mutable pixel table row, used as data source of :class:`~LazyCoolerEdge`.
+    """
+    __slots__ = ('Index', 'bin1_id', 'bin2_id', 'count')
+
+
 class LazyCoolerRegion(GenomicRegion):
     def __init__(self, series, ix=None):
         self._series = series
@@ -293,7 +413,8 @@ class CoolerHic(RegionMatrixContainer, cooler.Cooler):
         cooler.Cooler.__init__(self, *largs, **kwargs)
         RegionMatrixContainer.__init__(self)
         self._mappability = None
-        self._expected_value_and_marginals_cache = None
+        self._expected_value_and_marginals_cache = dict()
+        self._bin1_offsets = None
 
     def __enter__(self):
         return self
@@ -390,7 +511,95 @@ class CoolerHic(RegionMatrixContainer, cooler.Cooler):
         return cl
 
     def _chromosome_bins(self, *args, **kwargs):
-        return RegionMatrixContainer._chromosome_bins(self, lazy=True)
+        chromosome_offsets = self._load_dset('indexes/chrom_offset')
+        chromosome_bins = dict()
+        for i, chromosome in enumerate(self.chromosomes()):
+            if chromosome_offsets[i + 1] > chromosome_offsets[i]:
+                chromosome_bins[chromosome] = [int(chromosome_offsets[i]), int(chromosome_offsets[i + 1])]
+        return chromosome_bins
+
+    def _bin_chromosome_ixs(self):
+        """
+        Index of the chromosome of every bin, in :func:`~CoolerHic.chromosomes` order.
+        """
+        chromosome_offsets = self._load_dset('indexes/chrom_offset')
+        return np.repeat(np.arange(len(chromosome_offsets) - 1), np.diff(chromosome_offsets))
+
+    def _pixel_arrays(self, row_range=None, col_range=None, score_field=None,
+                      chunk_size=1000000):
+        """
+        Read pixels in chunks directly from the HDF5 pixel datasets.
+
+        Only the pixel rows of the selected bins are read, using the
+        :code:`indexes/bin1_offset` index. Like for
+        :func:`~fanc.matrix.RegionPairsTable._edge_arrays_subset`, pixels
+        between a row and a column bin are returned regardless of which
+        of the two is bin1.
+
+        :param row_range: tuple (first, last) bin index, all bins if None
+        :param col_range: tuple (first, last) bin index, all bins if None
+        :param score_field: Pixel column used as weight, 'count' by default
+        :param chunk_size: Maximum number of pixels read at once
+        :return: iterator over (pixel index, bin1, bin2, weight) array tuples
+        """
+        if score_field is None or score_field == 'weight':
+            score_field = 'count'
+
+        if self._bin1_offsets is None:
+            self._bin1_offsets = self._load_dset('indexes/bin1_offset').astype(np.int64)
+        bin1_offsets = self._bin1_offsets
+
+        n_bins = len(bin1_offsets) - 1
+        row_start, row_end = (0, n_bins - 1) if row_range is None else row_range
+        col_start, col_end = (0, n_bins - 1) if col_range is None else col_range
+
+        # pixels are stored with bin1 <= bin2, so a range only needs to be
+        # read as bin1 if the other range extends to or beyond it
+        bin1_ranges = []
+        for (first, last), (_, other_last) in (((row_start, row_end), (col_start, col_end)),
+                                               ((col_start, col_end), (row_start, row_end))):
+            if other_last < first:
+                continue
+            if len(bin1_ranges) > 0 and first <= bin1_ranges[-1][1] + 1 and bin1_ranges[-1][0] <= last + 1:
+                bin1_ranges[-1] = (min(first, bin1_ranges[-1][0]), max(last, bin1_ranges[-1][1]))
+            else:
+                bin1_ranges.append((first, last))
+        bin1_ranges.sort()
+
+        with self.open('r') as grp:
+            bin1_dataset = grp['pixels/bin1_id']
+            bin2_dataset = grp['pixels/bin2_id']
+            weight_dataset = grp['pixels'][score_field]
+            for first_bin, last_bin in bin1_ranges:
+                start, end = bin1_offsets[first_bin], bin1_offsets[last_bin + 1]
+                for chunk_start in range(start, end, chunk_size):
+                    chunk_end = min(end, chunk_start + chunk_size)
+                    bin1 = bin1_dataset[chunk_start:chunk_end].astype(np.int64)
+                    bin2 = bin2_dataset[chunk_start:chunk_end].astype(np.int64)
+                    keep = (((row_start <= bin1) & (bin1 <= row_end) & (col_start <= bin2) & (bin2 <= col_end)) |
+                            ((col_start <= bin1) & (bin1 <= col_end) & (row_start <= bin2) & (bin2 <= row_end)))
+                    if not np.any(keep):
+                        continue
+
+                    weight = weight_dataset[chunk_start:chunk_end].astype(np.float64)
+                    ixs = np.arange(chunk_start, chunk_end)
+                    if not keep.all():
+                        ixs, bin1, bin2, weight = ixs[keep], bin1[keep], bin2[keep], weight[keep]
+                    yield ixs, bin1, bin2, weight
+
+    def _pixel_edges(self, pixel_arrays, lazy=False):
+        lazy_edge = LazyCoolerEdge(_CoolerPixel(), self) if lazy else None
+        for ixs, sources, sinks, weights in pixel_arrays:
+            for ix, source, sink, weight in zip(ixs.tolist(), sources.tolist(),
+                                                sinks.tolist(), weights.tolist()):
+                if lazy:
+                    pixel = lazy_edge._series
+                    pixel.Index, pixel.bin1_id, pixel.bin2_id, pixel.count = ix, source, sink, weight
+                    yield lazy_edge
+                else:
+                    yield Edge(ix=ix, source=source, sink=sink, weight=weight,
+                               source_node=self.regions[source],
+                               sink_node=self.regions[sink])
 
     def _tuple_to_edge(self, t, lazy_edge=None):
         if lazy_edge is None:
@@ -414,27 +623,102 @@ class CoolerHic(RegionMatrixContainer, cooler.Cooler):
             return lazy_edge
 
     def _edges_iter(self, lazy=False, *args, **kwargs):
-        lazy_edge = LazyCoolerEdge(None, self) if lazy else None
-
-        chromosomes = self.chromosomes()
-        for i in range(len(chromosomes)):
-            for j in range(i, len(chromosomes)):
-                df = cooler.Cooler.matrix(self, as_pixels=True, balance=False).fetch(chromosomes[i],
-                                                                                     chromosomes[j])
-                for t in df.itertuples():
-                    yield self._tuple_to_edge(t, lazy_edge=lazy_edge)
+        return self._pixel_edges(self._pixel_arrays(), lazy=lazy)
 
     def _edges_subset(self, key=None, row_regions=None, col_regions=None,
                       lazy=False, *args, **kwargs):
-        lazy_edge = LazyCoolerEdge(None, self) if lazy else None
-
-        row_start, row_end = self._min_max_region_ix(row_regions)
-        col_start, col_end = self._min_max_region_ix(col_regions)
-
-        df = cooler.Cooler.matrix(self, as_pixels=True, balance=False)[row_start:row_end+1, col_start:col_end+1]
+        pixel_arrays = self._pixel_arrays(self._min_max_region_ix(row_regions),
+                                          self._min_max_region_ix(col_regions))
+        return self._pixel_edges(pixel_arrays, lazy=lazy)
+
+    def _edge_arrays_subset(self, row_regions, col_regions, score_field=None,
+                            chunk_size=1000000, *args, **kwargs):
+        for _, sources, sinks, weights in self._pixel_arrays(self._min_max_region_ix(row_regions),
+                                                             self._min_max_region_ix(col_regions),
+                                                             score_field=score_field,
+                                                             chunk_size=chunk_size):
+            yield sources, sinks, weights
+
+    def edge_arrays(self, key=None, norm=True, oe=False, oe_per_chromosome=True,
+                    intra_chromosomal=True, inter_chromosomal=True, check_valid=True,
+                    score_field=None, chunk_size=1000000, *args, **kwargs):
+        """
+        Iterate over edges in chunks of :mod:`numpy` arrays.
 
-        for t in df.itertuples():
-            yield self._tuple_to_edge(t, lazy_edge=lazy_edge, *args, **kwargs)
+        Without a key, pixels are read in file order directly from the
+        pixel table, without creating region objects. See
+        :func:`~fanc.matrix.RegionMatrixContainer.edge_arrays` for details.
+        """
+        if key is not None:
+            return RegionMatrixContainer.edge_arrays(self, key, norm=norm, oe=oe,
+                                                     oe_per_chromosome=oe_per_chromosome,
+                                                     intra_chromosomal=intra_chromosomal,
+                                                     inter_chromosomal=inter_chromosomal,
+                                                     check_valid=check_valid, score_field=score_field,
+                                                     chunk_size=chunk_size, *args, **kwargs)
+        return self._all_edge_arrays(norm=norm, oe=oe, oe_per_chromosome=oe_per_chromosome,
+                                     intra_chromosomal=intra_chromosomal,
+                                     inter_chromosomal=inter_chromosomal,
+                                     check_valid=check_valid, score_field=score_field,
+                                     chunk_size=chunk_size, **kwargs)
+
+    def _all_edge_arrays(self, norm=True, oe=False, oe_per_chromosome=True,
+                         intra_chromosomal=True, inter_chromosomal=True, check_valid=True,
+                         score_field=None, chunk_size=1000000, **kwargs):
+        if score_field is None:
+            score_field = self._default_score_field
+
+        # like Edge.weight, only the weight field is normalised
+        if score_field != kwargs.get('weight_field', 'weight'):
+            norm, oe = False, False
+
+        bias = self.bias_vector() if norm else None
+        valid = self._region_valid() if check_valid else None
+        bin_chromosome_ixs = self._bin_chromosome_ixs()
+
+        if oe:
+            expected_genome, expected_intra, expected_inter = self.expected_values(norm=norm)
+            if oe_per_chromosome:
+                # chromosome expected values concatenated, in bin order
+                chromosome_expected = [np.array(expected_intra[chromosome], dtype=np.float64)
+                                       for chromosome in self.chromosomes()]
+                expected_offsets = np.cumsum([0] + [len(e) for e in chromosome_expected])
+                expected_values = np.concatenate(chromosome_expected)
+            else:
+                expected_values = np.array(expected_genome, dtype=np.float64)
+
+        for _, source, sink, weight in self._pixel_arrays(score_field=score_field,
+                                                          chunk_size=chunk_size):
+            source_chromosome_ixs = bin_chromosome_ixs[source]
+            is_intra = source_chromosome_ixs == bin_chromosome_ixs[sink]
+
+            keep = np.ones(len(source), dtype=bool)
+            if not intra_chromosomal:
+                keep &= ~is_intra
+            if not inter_chromosomal:
+                keep &= is_intra
+            if valid is not None:
+                keep &= valid[source] & valid[sink]
+            if not keep.all():
+                source, sink, weight = source[keep], sink[keep], weight[keep]
+                source_chromosome_ixs, is_intra = source_chromosome_ixs[keep], is_intra[keep]
+
+            if bias is not None:
+                weight *= bias[source] * bias[sink]
+
+            if oe:
+                expected = np.full(len(weight), expected_inter, dtype=np.float64)
+                distance = sink[is_intra] - source[is_intra]
+                if oe_per_chromosome:
+                    expected[is_intra] = expected_values[expected_offsets[source_chromosome_ixs[is_intra]] +
+                                                         distance]
+                else:
+                    expected[is_intra] = expected_values[distance]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    weight /= expected
+
+            if len(source) > 0:
+                yield source, sink, weight
 
     def _edges_getitem(self, item, *args, **kwargs):
         edges = []
@@ -452,32 +736,72 @@ class CoolerHic(RegionMatrixContainer, cooler.Cooler):
     def mappable(self, region=None):
         """
         Get the mappability vector of this matrix.
+
+        A region is mappable if it has at least one pixel.
         """
-        if self._mappability is not None:
+        if self._mappability is None:
+            mappable = np.zeros(len(self.regions), dtype=bool)
+            for _, bin1, bin2, _ in self._pixel_arrays():
+                mappable[bin1] = True
+                mappable[bin2] = True
+            self._mappability = mappable
+
+        if region is None:
             return self._mappability
 
-        mappable = [False] * len(list(self.regions(region)))
-        for edge in self.edges(region, lazy=True):
-            mappable[edge.source] = True
-            mappable[edge.sink] = True
-        self._mappability = mappable
-        return mappable
+        start, end = self._min_max_region_ix(self.regions(region, lazy=True))
+        return self._mappability[start:end + 1]
+
+    def _region_valid(self):
+        with self.open('r') as grp:
+            if 'valid' in grp['bins']:
+                return grp['bins/valid'][:].astype(bool)
+        return np.ones(len(self.regions), dtype=bool)
 
     def bias_vector(self):
-        return np.array([r.bias if np.isfinite(r.bias) else 0 for r in self.regions(lazy=True)])
+        with self.open('r') as grp:
+            if 'weight' not in grp['bins']:
+                return np.ones(len(self.regions), dtype=np.float64)
+            bias = grp['bins/weight'][:].astype(np.float64)
+        bias[~np.isfinite(bias)] = 0
+        return bias
+
+    def marginals(self, masked=True, *args, **kwargs):
+        """
+        Get the marginals vector of this matrix.
+
+        Without a key, marginals are summed directly from the pixel table.
+        See :func:`~fanc.matrix.RegionMatrixContainer.marginals` for details.
+        """
+        key = args[0] if len(args) > 0 else kwargs.get('key', None)
+        if key is not None:
+            return RegionMatrixContainer.marginals(self, masked, *args, **kwargs)
+        kwargs.pop('key', None)
+        kwargs.pop('lazy', None)
+
+        marginals = np.zeros(len(self.regions))
+        for source, sink, weight in self.edge_arrays(**kwargs):
+            marginals += np.bincount(source, weights=weight, minlength=len(marginals))
+            off_diagonal = source != sink
+            marginals += np.bincount(sink[off_diagonal], weights=weight[off_diagonal],
+                                     minlength=len(marginals))
+
+        if masked:
+            marginals = np.ma.masked_where(~self._region_valid(), marginals)
+        return marginals
 
     def expected_values_and_marginals(self, selected_chromosome=None, norm=True,
                                       *args, **kwargs):
-        if self._expected_value_and_marginals_cache is not None:
+        if norm in self._expected_value_and_marginals_cache:
             logger.debug("Using cached expected values")
             intra_expected, chromosome_intra_expected, \
-            inter_expected, marginals, valid = self._expected_value_and_marginals_cache
+            inter_expected, marginals, valid = self._expected_value_and_marginals_cache[norm]
         else:
             intra_expected, chromosome_intra_expected, \
             inter_expected, marginals, valid = RegionMatrixContainer.expected_values_and_marginals(self, norm=norm,
                                                                                                    *args, **kwargs)
-            self._expected_value_and_marginals_cache = intra_expected, chromosome_intra_expected, \
-                                                       inter_expected, marginals, valid
+            self._expected_value_and_marginals_cache[norm] = intra_expected, chromosome_intra_expected, \
+                                                             inter_expected, marginals, valid
 
         if selected_chromosome is not None:
             return chromosome_intra_expected[selected_chromosome], marginals, valid
@@ -2,25 +2,27 @@ import logging
 import struct
 import zlib
 
+import msgpack
 import numpy as np
+import scipy.sparse as sp
 from genomic_regions import GenomicRegion
 
 from ..regions import Genome
-from ..hic import Hic
-from ..pairs import ReadPairs
-from ..matrix import RegionMatrixContainer, Edge
+from ..hic import Hic, _ice_bias_vector, _correct_sparse_matrix
+from ..pairs import ReadPairs, _partition_region_ranges
+from ..matrix import RegionMatrixContainer, Edge, _pack_edge_keys, _unpack_edge_keys, \
+    _sum_duplicate_keys, _sum_sorted_runs
 from ..config import config
 from ..tools.files import tmp_file_name
-from ..tools.general import str_to_int
+from ..tools.general import str_to_int, RareUpdateProgressBar
 
 import os
-import subprocess
 import warnings
 import tempfile
-import gzip
 import shutil
+import multiprocessing as mp
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 logger = logging.getLogger(__name__)
 
@@ -53,11 +55,26 @@ def is_juicer(file_name):
 def convert_juicer_to_hic(juicer_file, genome_file, resolution, juicer_tools_jar_path=None,
                           norm='NONE', output_file=None, inter_chromosomal=True,
                           chromosomes=None):
-    if juicer_tools_jar_path is None:
-        juicer_tools_jar_path = config.juicer_tools_jar_path
-    if juicer_tools_jar_path is None:
-        raise ValueError("Just must provide the juicer tools jar path or set it in fanc.conf!")
+    """
+    Convert a Juicer .hic file to a :class:`~fanc.hic.Hic` object.
+
+    Matrices are read directly with :class:`~JuicerHic`, juicer tools
+    are no longer required.
+
+    :param juicer_file: Path to Juicer .hic file
+    :param genome_file: Genome used to build the regions of the output matrix
+    :param resolution: Bin size in base pairs, must exist in the Juicer file
+    :param juicer_tools_jar_path: Ignored
+    :param norm: Juicer normalisation applied to the contacts ('NONE' for raw counts)
+    :param output_file: Path to the output file
+    :param inter_chromosomal: If False, only convert intra-chromosomal matrices
+    :param chromosomes: list of chromosomes to convert
+    :return: :class:`~fanc.hic.Hic`
+    """
+    if juicer_tools_jar_path is not None:
+        warnings.warn("Juicer files are read natively, juicer_tools_jar_path is ignored.")
 
+    juicer = JuicerHic(juicer_file, resolution=resolution, norm=norm)
     hic = Hic(file_name=output_file, mode='w')
 
     # regions
@@ -72,46 +89,50 @@ def convert_juicer_to_hic(juicer_file, genome_file, resolution, juicer_tools_jar
         chromosomes = hic.chromosomes()
     chromosome_bins = hic.chromosome_bins
 
+    # map Juicer region indexes to output region indexes
+    juicer_chromosomes = set(juicer.chromosomes())
+    region_map = np.full(len(juicer.regions), -1, dtype=np.int64)
+    for chromosome in chromosomes:
+        if chromosome not in juicer_chromosomes:
+            continue
+        start, end = chromosome_bins[chromosome]
+        juicer_start = juicer._chromosome_ix_offset(chromosome)
+        juicer_end = min(juicer_start + end - start, len(region_map))
+        region_map[juicer_start:juicer_end] = np.arange(start, start + juicer_end - juicer_start)
+
     logger.info("Extracting edges from hic file")
+    edge_dtype = [('source', np.int64), ('sink', np.int64), (hic._default_score_field, np.float64)]
     nan_counter = 0
     for i in range(len(chromosomes)):
         chromosome1 = chromosomes[i]
-        offset1 = chromosome_bins[chromosome1][0]
+        if chromosome1 not in juicer_chromosomes:
+            continue
 
         for j in range(i, len(chromosomes)):
             if i != j and not inter_chromosomal:
                 continue
             chromosome2 = chromosomes[j]
-            offset2 = chromosome_bins[chromosome2][0]
+            if chromosome2 not in juicer_chromosomes:
+                continue
 
             logger.info("{} -- {}".format(chromosome1, chromosome2))
 
-            juicer_command = ['java', '-jar', juicer_tools_jar_path,
-                              'dump', 'observed', norm, juicer_file,
-                              chromosome1, chromosome2, 'BP', str(resolution)]
-
-            juicer_process = subprocess.Popen(juicer_command, stdout=subprocess.PIPE)
-
-            for line in juicer_process.stdout:
-                fields = line.rstrip().split()
-
-                try:
-                    start, end, weight = int(fields[0]), int(fields[1]), float(fields[2])
-                except ValueError:
-                    continue
+            for source, sink, weight in juicer.edge_arrays((chromosome1, chromosome2),
+                                                           norm=norm != 'NONE',
+                                                           check_valid=norm != 'NONE'):
+                source, sink = region_map[source], region_map[sink]
+                keep = np.isfinite(weight)
+                nan_counter += int(np.sum(~keep))
+                keep &= (source >= 0) & (sink >= 0)
 
-                start_ix = int(start / resolution) + offset1
-                end_ix = int(end / resolution) + offset2
-                if start_ix > end_ix:
-                    start_ix, end_ix = end_ix, start_ix
-
-                if not np.isfinite(weight):
-                    nan_counter += 1
-                    continue
-
-                hic.add_edge([start_ix, end_ix, weight], check_nodes_exist=False)
+                edges = np.empty(int(np.sum(keep)), dtype=edge_dtype)
+                edges['source'] = np.minimum(source[keep], sink[keep])
+                edges['sink'] = np.maximum(source[keep], sink[keep])
+                edges[hic._default_score_field] = weight[keep]
+                hic._edge_buffer.add_array(edges)
 
     hic.flush()
+    juicer.close()
 
     if nan_counter > 0:
         logger.warning("{} contacts could not be imported, "
@@ -120,120 +141,669 @@ def convert_juicer_to_hic(juicer_file, genome_file, resolution, juicer_tools_jar
     return hic
 
 
-def to_juicer(pairs, juicer_file, juicer_tools_jar_path=None,
+_juicer_default_resolutions = [2500000, 1000000, 500000, 250000, 100000, 50000, 25000, 10000, 5000]
+_juicer_normalisations = ('VC', 'VC_SQRT', 'KR')
+
+
+def to_juicer(data, juicer_file, juicer_tools_jar_path=None,
               resolutions=None, fragment_map=False, tmp=False,
-              verbose=False):
-    tmpdir = None if not tmp else tempfile.mkdtemp()
+              verbose=False, normalisations=_juicer_normalisations,
+              threads=1, chunk_size=1000000):
+    """
+    Write read pairs or a Hi-C matrix to a Juicer .hic file.
+
+    Contacts are read from the pair or edge tables in chunks and binned
+    at all resolutions in a single pass. A chromosome pair is written
+    as soon as all tables that can contain its contacts have been read.
+    Normalisation vectors are calculated for every intra-chromosomal
+    matrix using the FAN-C balancing code, expected values are
+    calculated from the binned contacts.
+
+    :param data: :class:`~fanc.pairs.ReadPairs`, equidistant
+                 :class:`~fanc.hic.Hic`, or a list of these. Contacts
+                 of all objects are summed.
+    :param juicer_file: Path to the output .hic file
+    :param juicer_tools_jar_path: Ignored, juicer tools are no longer required
+    :param resolutions: list of bin sizes in base pairs. Defaults to the
+                        Juicer default resolutions for read pairs, and
+                        to the bin size of Hi-C objects
+    :param fragment_map: Not supported, only base pair resolutions are written
+    :param tmp: If True, write to a temporary file and move it to
+                juicer_file afterwards
+    :param verbose: Ignored
+    :param normalisations: Normalisation vectors to calculate, any of
+                           'VC', 'VC_SQRT', and 'KR'
+    :param threads: Number of processes used to compress matrix blocks
+    :param chunk_size: Number of contacts read at once
+    :return: :class:`~JuicerHic` at the highest resolution
+    """
+    if juicer_tools_jar_path is not None:
+        warnings.warn("Juicer files are written natively, juicer_tools_jar_path is ignored.")
+    if fragment_map:
+        warnings.warn("Fragment resolutions are not supported, only writing base pair resolutions.")
+
+    if isinstance(data, (ReadPairs, Hic)):
+        data = [data]
+    data = list(data)
+    if len(data) == 0:
+        raise ValueError("Must provide at least one ReadPairs or Hic object!")
+    for d in data:
+        if not isinstance(d, (ReadPairs, Hic)):
+            raise ValueError("Can only write ReadPairs or Hic objects to Juicer files, "
+                             "not {}".format(type(d)))
+
+    chromosomes = data[0].chromosomes()
+    chromosome_lengths = data[0].chromosome_lengths
+    chromosome_to_ix = {chromosome: i for i, chromosome in enumerate(chromosomes)}
+
+    if resolutions is None:
+        bin_sizes = [d.bin_size for d in data if isinstance(d, Hic)]
+        resolutions = _juicer_default_resolutions if len(bin_sizes) == 0 else [max(bin_sizes)]
+    resolutions = sorted(set(int(resolution) for resolution in resolutions), reverse=True)
+
+    # contact tables, and the chromosome pairs that are complete after each table
+    tables = []
+    last_table = dict()
+    for d in data:
+        region_arrays = d._region_arrays()
+        try:
+            region_chromosomes = np.array([chromosome_to_ix[chromosome]
+                                           for chromosome in region_arrays['chromosome_names']],
+                                          dtype=np.int64)[region_arrays['chromosome']]
+        except KeyError as e:
+            raise ValueError("Chromosome {} is not in the first object!".format(e))
+
+        if isinstance(d, ReadPairs):
+            region_starts = None
+        else:
+            bin_size = d.bin_size
+            region_starts = region_arrays['start'] - 1
+            if np.any(region_starts % bin_size != 0):
+                raise ValueError("Hi-C matrix regions must be equidistant bins!")
+            for resolution in resolutions:
+                if resolution % bin_size != 0:
+                    raise ValueError("Resolution {} is not a multiple of "
+                                     "the Hi-C bin size {}".format(resolution, bin_size))
+
+        partition_ranges = _partition_region_ranges(d._partition_breaks, len(region_chromosomes))
+        for (source_partition, sink_partition), edge_table in d._iter_edge_tables():
+            source_start, source_end = partition_ranges[source_partition]
+            sink_start, sink_end = partition_ranges[sink_partition]
+            source_chromosomes = np.unique(region_chromosomes[source_start:source_end + 1])
+            sink_chromosomes = np.unique(region_chromosomes[sink_start:sink_end + 1])
+            for chromosome1_ix in source_chromosomes.tolist():
+                for chromosome2_ix in sink_chromosomes.tolist():
+                    chromosome_pair = (min(chromosome1_ix, chromosome2_ix), max(chromosome1_ix, chromosome2_ix))
+                    last_table[chromosome_pair] = len(tables)
+            tables.append((d, edge_table, region_chromosomes, region_starts))
+
+    completed_pairs = defaultdict(list)
+    for chromosome_pair, i in last_table.items():
+        completed_pairs[i].append(chromosome_pair)
+
+    if tmp:
+        output_file = tmp_file_name(tempfile.gettempdir(), prefix='tmp_fanc', extension='_juicer.hic')
+        logger.info("Temporary file: {}".format(output_file))
+    else:
+        output_file = juicer_file
+
+    writer = _JuicerWriter(output_file, chromosomes,
+                           [chromosome_lengths[chromosome] for chromosome in chromosomes],
+                           resolutions, normalisations=normalisations, threads=threads)
     try:
-        if juicer_tools_jar_path is None:
-            juicer_tools_jar_path = config.juicer_tools_jar_path
-        if juicer_tools_jar_path is None:
-            raise ValueError("Just must provide the juicer tools jar path or set it in fanc.conf!")
-
-        # check that juicer tools can be executed
-        if not os.path.exists(juicer_tools_jar_path):
-            raise ValueError("{} does not exist or is unreadable".format(juicer_tools_jar_path))
-
-        help_command = ['java', '-jar', juicer_tools_jar_path, '-h']
-        logger.debug("Testing juicer: {}".format(" ".join(help_command)))
-        res = subprocess.call(help_command)
-        if res != 0:
-            raise RuntimeError("juicer had nonzero exit status ({})! "
-                               "It looks like your .jar path is either wrong ".format(res))
-
-        if isinstance(pairs, ReadPairs):
-            pairs = [pairs]
-
-        chromosomes = pairs[0].chromosomes()
-
-        with tempfile.NamedTemporaryFile(suffix='.chrom.sizes', mode='w', delete=False) as chrom_sizes_file:
-            logger.info("Writing chromosome sizes")
-            for chromosome, size in pairs[0].chromosome_lengths.items():
-                chrom_sizes_file.write("{}\t{}\n".format(chromosome, size))
-            chrom_sizes_file.flush()
-
-            # make restriction site file
-            with tempfile.NamedTemporaryFile(prefix="re_sites_", suffix='.txt', mode='w', dir=tmpdir) as re_file:
-                logger.info("Making restriction map")
-                for chromosome in chromosomes:
-                    re_sites = []
-                    for region in pairs[0].regions(chromosome, lazy=True):
-                        re_sites.append(str(region.end))
-                    re_file.write("{} {}\n".format(chromosome, " ".join(re_sites)))
-                re_file.flush()
-
-                logger.info("Writing pairs")
-                with tempfile.NamedTemporaryFile(prefix='reads_', suffix='.txt.gz', dir=tmpdir) as f:
-                    f.flush()
-                    fgz = gzip.GzipFile(mode='wb', fileobj=f)
-
-                    for chri, chromosome1 in enumerate(chromosomes):
-                        for chrj in range(chri, len(chromosomes)):
-                            chromosome2 = chromosomes[chrj]
-                            for p in pairs:
-                                for pair in p.pairs((chromosome1, chromosome2), lazy=True):
-                                    if pair.left.fragment.chromosome <= pair.right.fragment.chromosome:
-                                        fgz.write("{} {} {} {} {} {} {} {}\n".format(
-                                            1 if pair.left.strand == -1 else 0,
-                                            pair.left.fragment.chromosome,
-                                            pair.left.position,
-                                            pair.left.fragment.ix,
-                                            1 if pair.right.strand == -1 else 0,
-                                            pair.right.fragment.chromosome,
-                                            pair.right.position,
-                                            pair.right.fragment.ix
-                                        ).encode('utf-8'))
-                                    else:
-                                        fgz.write("{} {} {} {} {} {} {} {}\n".format(
-                                            1 if pair.right.strand == -1 else 0,
-                                            pair.right.fragment.chromosome,
-                                            pair.right.position,
-                                            pair.right.fragment.ix,
-                                            1 if pair.left.strand == -1 else 0,
-                                            pair.left.fragment.chromosome,
-                                            pair.left.position,
-                                            pair.left.fragment.ix
-                                        ).encode('utf-8'))
-                    fgz.close()
-
-                    f.flush()
-
-                    pre_command = ['java', '-jar', juicer_tools_jar_path, 'pre']
-                    if fragment_map:
-                        pre_command += ['-f', re_file.name]
-                    if resolutions is not None:
-                        pre_command += ['-r', ",".join([str(r) for r in resolutions])]
-                    if tmp:
-                        pre_command += ['-t', tmpdir]
-                    if verbose:
-                        pre_command.append('-v')
-                    pre_command += [f.name, juicer_file, chrom_sizes_file.name]
-
-                    logger.info("Making Juicer file: {}".format(" ".join(pre_command)))
-                    res = subprocess.call(pre_command)
-                    if res != 0:
-                        raise RuntimeError("juicer pre had nonzero exit status ({})!".format(res))
-        return JuicerHic(juicer_file)
+        n_rows_total = sum(edge_table._original_len() for _, edge_table, _, _ in tables)
+        rows_counter = 0
+        with RareUpdateProgressBar(max_value=n_rows_total, silent=config.hide_progressbars,
+                                   prefix="Juicer") as pb:
+            for i, (d, edge_table, region_chromosomes, region_starts) in enumerate(tables):
+                n_rows = edge_table._original_len()
+                for start in range(0, n_rows, chunk_size):
+                    rows = edge_table.read(start, min(n_rows, start + chunk_size))
+                    rows_counter += len(rows)
+                    rows = rows[rows[edge_table._mask_field] == 0]
+                    if len(rows) > 0:
+                        if region_starts is None:
+                            positions1 = rows['left_read_position']
+                            positions2 = rows['right_read_position']
+                            weights = np.ones(len(rows), dtype=np.float64)
+                        else:
+                            positions1 = region_starts[rows['source']]
+                            positions2 = region_starts[rows['sink']]
+                            weights = rows[d._default_score_field]
+                        writer.add_contacts(region_chromosomes[rows['source']], positions1,
+                                            region_chromosomes[rows['sink']], positions2,
+                                            weights)
+                    pb.update(rows_counter)
+
+                for chromosome_pair in sorted(completed_pairs[i]):
+                    writer.write_matrix(*chromosome_pair)
+        writer.finish()
     finally:
-        if tmpdir is not None:
-            shutil.rmtree(tmpdir)
+        writer.close()
+
+    if tmp:
+        shutil.move(output_file, juicer_file)
+
+    if 'KR' in normalisations or len(normalisations) == 0:
+        norm = 'KR' if len(normalisations) > 0 else 'NONE'
+    else:
+        norm = normalisations[0]
+    return JuicerHic(juicer_file, resolution=resolutions[-1], norm=norm)
 
 
-def _read_cstr(f):
+def _juicer_cstr(value):
+    return value.encode('utf-8') + b'\0'
+
+
+def _juicer_block_worker(block):
     """
-    Copyright (c) 2016 Aiden Lab
+    Encode and compress a Juicer matrix block.
+
+    Contacts are stored as a row-wise sparse (type 1) block. Weights
+    are written as 16-bit integers if possible, and as 32-bit floats
+    otherwise.
 
-    :param f: open binary file
-    :return: str
+    :param block: tuple (x, y, weight) of arrays, sorted by y, then x
+    :return: compressed block (bytes)
     """
-    buf = ""
-    while True:
-        b = f.read(1)
-        b = b.decode('utf-8', 'backslashreplace')
-        if b is None or b == '\0':
-            return str(buf)
+    x, y, weight = block
+    x_offset, y_offset = int(x.min()), int(y.min())
+    use_short = bool(np.all(weight == np.round(weight)) and np.all(np.abs(weight) <= 32767))
+    record_dtype = np.dtype([('x', '<i2'), ('weight', '<i2' if use_short else '<f4')])
+
+    rows, row_starts, row_counts = np.unique(y, return_index=True, return_counts=True)
+    n_rows, n_records = len(rows), len(x)
+
+    # byte offsets of row headers and records in the block
+    header_size = struct.calcsize('<iiibbh')
+    row_positions = header_size + 4 * np.arange(n_rows) + record_dtype.itemsize * row_starts
+    record_rows = np.repeat(np.arange(n_rows), row_counts)
+    record_positions = (row_positions[record_rows] + 4 +
+                        record_dtype.itemsize * (np.arange(n_records) - row_starts[record_rows]))
+
+    row_headers = np.empty(n_rows, dtype=[('y', '<i2'), ('count', '<i2')])
+    row_headers['y'] = rows - y_offset
+    row_headers['count'] = row_counts
+    records = np.empty(n_records, dtype=record_dtype)
+    records['x'] = x - x_offset
+    records['weight'] = weight
+
+    data = np.empty(header_size + 4 * n_rows + record_dtype.itemsize * n_records, dtype=np.uint8)
+    data[:header_size] = np.frombuffer(struct.pack('<iiibbh', n_records, x_offset, y_offset,
+                                                   0 if use_short else 1, 1, n_rows), dtype=np.uint8)
+    data[row_positions[:, None] + np.arange(4)] = row_headers.view(np.uint8).reshape(n_rows, 4)
+    data[record_positions[:, None] + np.arange(record_dtype.itemsize)] = \
+        records.view(np.uint8).reshape(n_records, record_dtype.itemsize)
+    return zlib.compress(data.tobytes())
+
+
+class _JuicerWriter(object):
+    """
+    Write contact matrices to a Juicer .hic file (version 8).
+
+    Contacts are added in chunks with :func:`~_JuicerWriter.add_contacts`
+    and binned at all resolutions at once. Each chromosome pair is written
+    with :func:`~_JuicerWriter.write_matrix` once all of its contacts have
+    been added, together with the normalisation vectors of intra-chromosomal
+    matrices. :func:`~_JuicerWriter.finish` writes expected values and the
+    master index.
+
+    :param file_name: Path to the output file
+    :param chromosomes: list of chromosome names
+    :param chromosome_lengths: list of chromosome lengths
+    :param resolutions: list of bin sizes in base pairs
+    :param normalisations: Normalisation vectors to calculate, any of
+                           'VC', 'VC_SQRT', and 'KR'
+    :param threads: Number of processes used to compress matrix blocks
+    """
+    version = 8
+    block_bin_count = 1000
+
+    def __init__(self, file_name, chromosomes, chromosome_lengths, resolutions,
+                 normalisations=_juicer_normalisations, threads=1):
+        for normalisation in normalisations:
+            if normalisation not in _juicer_normalisations:
+                raise ValueError("Normalisation {} not supported, "
+                                 "use any of {}".format(normalisation, _juicer_normalisations))
+
+        self.chromosomes = list(chromosomes)
+        self.chromosome_lengths = np.array(chromosome_lengths, dtype=np.int64)
+        self.resolutions = list(resolutions)
+        self.normalisations = list(normalisations)
+        self.threads = threads
+
+        self._n_bins = dict()
+        for resolution in self.resolutions:
+            self._n_bins[resolution] = np.maximum(1, (self.chromosome_lengths + resolution - 1) // resolution)
+
+        # binned contacts by chromosome pair and resolution
+        self._counts = dict()
+        self._matrix_entries = []
+        self._normalisation_entries = dict()
+        # contact sums by distance, and by chromosome, for expected values
+        self._distance_sums = dict()
+        self._chromosome_sums = dict()
+        for resolution in self.resolutions:
+            for normalisation in ['NONE'] + self.normalisations:
+                self._distance_sums[(normalisation, resolution)] = np.zeros(self._n_bins[resolution].max())
+                self._chromosome_sums[(normalisation, resolution)] = np.zeros(len(self.chromosomes))
+
+        self._pool = None
+        self._file = open(file_name, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        f = self._file
+        f.write(b'HIC\0')
+        f.write(struct.pack('<i', self.version))
+        self._master_index_position = f.tell()
+        f.write(struct.pack('<q', 0))
+        f.write(_juicer_cstr('fanc'))
+
+        attributes = [('software', 'fanc')]
+        f.write(struct.pack('<i', len(attributes)))
+        for key, value in attributes:
+            f.write(_juicer_cstr(key))
+            f.write(_juicer_cstr(value))
+
+        f.write(struct.pack('<i', len(self.chromosomes) + 1))
+        f.write(_juicer_cstr('All'))
+        f.write(struct.pack('<i', int(self.chromosome_lengths.sum() // 1000)))
+        for chromosome, chromosome_length in zip(self.chromosomes, self.chromosome_lengths):
+            f.write(_juicer_cstr(chromosome))
+            f.write(struct.pack('<i', int(chromosome_length)))
+
+        f.write(struct.pack('<i', len(self.resolutions)))
+        for resolution in self.resolutions:
+            f.write(struct.pack('<i', resolution))
+        # no fragment resolutions
+        f.write(struct.pack('<i', 0))
+
+    def bins(self, chromosome_ixs, positions, resolution):
+        """
+        Bin index of each (0-based) position within its chromosome.
+
+        :param chromosome_ixs: array of chromosome indexes
+        :param positions: array of positions
+        :param resolution: Bin size in base pairs
+        :return: array of bin indexes
+        """
+        return np.minimum(np.asarray(positions, dtype=np.int64) // resolution,
+                          self._n_bins[resolution][chromosome_ixs] - 1)
+
+    def add_contacts(self, chromosome1_ixs, positions1, chromosome2_ixs, positions2, weights):
+        """
+        Add contacts between pairs of genomic positions.
+
+        :param chromosome1_ixs: array of chromosome indexes of the first position
+        :param positions1: array of first (0-based) positions
+        :param chromosome2_ixs: array of chromosome indexes of the second position
+        :param positions2: array of second (0-based) positions
+        :param weights: array of contact weights
+        """
+        chromosome1_ixs = np.asarray(chromosome1_ixs, dtype=np.int64)
+        chromosome2_ixs = np.asarray(chromosome2_ixs, dtype=np.int64)
+        positions1 = np.asarray(positions1, dtype=np.int64)
+        positions2 = np.asarray(positions2, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.float64)
+
+        # lower chromosome, and lower position within chromosomes, first
+        swap = (chromosome1_ixs > chromosome2_ixs) | ((chromosome1_ixs == chromosome2_ixs) &
+                                                      (positions1 > positions2))
+        chromosome1_ixs, chromosome2_ixs = (np.where(swap, chromosome2_ixs, chromosome1_ixs),
+                                            np.where(swap, chromosome1_ixs, chromosome2_ixs))
+        positions1, positions2 = np.where(swap, positions2, positions1), np.where(swap, positions1, positions2)
+
+        pair_keys = _pack_edge_keys(chromosome1_ixs, chromosome2_ixs)
+        order = np.argsort(pair_keys, kind='mergesort')
+        pair_keys = pair_keys[order]
+        first_ixs = np.where(np.r_[True, pair_keys[1:] != pair_keys[:-1]])[0]
+        last_ixs = np.r_[first_ixs[1:], len(pair_keys)]
+        for first_ix, last_ix in zip(first_ixs, last_ixs):
+            ixs = order[first_ix:last_ix]
+            chromosome_pair = (int(chromosome1_ixs[ixs[0]]), int(chromosome2_ixs[ixs[0]]))
+            matrix_counts = self._counts.setdefault(chromosome_pair, dict())
+            for resolution in self.resolutions:
+                keys = _pack_edge_keys(self.bins(chromosome1_ixs[ixs], positions1[ixs], resolution),
+                                       self.bins(chromosome2_ixs[ixs], positions2[ixs], resolution))
+                # sorted runs are merged once, when the matrix is written
+                matrix_counts.setdefault(resolution, []).append(_sum_duplicate_keys(keys, weights[ixs]))
+
+    def _compress_blocks(self, blocks):
+        if self.threads > 1 and len(blocks) > 1:
+            if self._pool is None:
+                self._pool = mp.get_context("spawn").Pool(self.threads)
+            return self._pool.map(_juicer_block_worker, blocks)
+        return [_juicer_block_worker(block) for block in blocks]
+
+    def write_matrix(self, chromosome1_ix, chromosome2_ix):
+        """
+        Write the contacts of a chromosome pair at all resolutions.
+
+        Contacts of this pair must not be added afterwards.
+
+        :param chromosome1_ix: Index of the first chromosome
+        :param chromosome2_ix: Index of the second chromosome,
+                               must not be lower than chromosome1_ix
+        """
+        matrix_counts = self._counts.pop((chromosome1_ix, chromosome2_ix), None)
+        if matrix_counts is None:
+            return
+
+        logger.debug("Writing matrix {} -- {}".format(self.chromosomes[chromosome1_ix],
+                                                      self.chromosomes[chromosome2_ix]))
+        zoom_data = []
+        for resolution in self.resolutions:
+            runs = matrix_counts[resolution]
+            if len(runs) == 1:
+                keys, weights = runs[0]
+            else:
+                keys, weights = (np.concatenate(arrays) for arrays in
+                                 zip(*_sum_sorted_runs([iter([run]) for run in runs])))
+            x, y = _unpack_edge_keys(keys)
+            if chromosome1_ix == chromosome2_ix:
+                self._add_intra_chromosomal(chromosome1_ix, resolution, x, y, weights)
+
+            n_bins = max(self._n_bins[resolution][chromosome1_ix], self._n_bins[resolution][chromosome2_ix])
+            block_column_count = int(n_bins // self.block_bin_count + 1)
+            block_numbers = (y // self.block_bin_count) * block_column_count + x // self.block_bin_count
+            order = np.lexsort((x, y, block_numbers))
+            x, y, block_weights, block_numbers = x[order], y[order], weights[order], block_numbers[order]
+
+            first_ixs = np.where(np.r_[True, block_numbers[1:] != block_numbers[:-1]])[0]
+            last_ixs = np.r_[first_ixs[1:], len(block_numbers)]
+            blocks = self._compress_blocks([(x[first_ix:last_ix], y[first_ix:last_ix],
+                                             block_weights[first_ix:last_ix])
+                                            for first_ix, last_ix in zip(first_ixs, last_ixs)])
+            zoom_data.append((resolution, block_column_count, block_numbers[first_ixs],
+                              blocks, float(weights.sum())))
+
+        f = self._file
+        unit = _juicer_cstr('BP')
+        header_size = 12 + sum(len(unit) + 36 + 16 * len(blocks) for _, _, _, blocks, _ in zoom_data)
+        matrix_position = f.tell()
+        self._matrix_entries.append(("{}_{}".format(chromosome1_ix + 1, chromosome2_ix + 1),
+                                     matrix_position, header_size))
+
+        f.write(struct.pack('<iii', chromosome1_ix + 1, chromosome2_ix + 1, len(zoom_data)))
+        block_position = matrix_position + header_size
+        for resolution, block_column_count, block_numbers, blocks, sum_counts in zoom_data:
+            f.write(unit)
+            f.write(struct.pack('<iffff', self.resolutions.index(resolution), sum_counts, 0, 0, 0))
+            f.write(struct.pack('<iiii', resolution, self.block_bin_count, block_column_count, len(blocks)))
+            for block_number, block in zip(block_numbers, blocks):
+                f.write(struct.pack('<iqi', block_number, block_position, len(block)))
+                block_position += len(block)
+        for _, _, _, blocks, _ in zoom_data:
+            for block in blocks:
+                f.write(block)
+
+    def _add_intra_chromosomal(self, chromosome_ix, resolution, x, y, weights):
+        n_bins = self._n_bins[resolution][chromosome_ix]
+        distance_sums = self._distance_sums[('NONE', resolution)]
+        distance_sums += np.bincount(y - x, weights=weights, minlength=len(distance_sums))
+        self._chromosome_sums[('NONE', resolution)][chromosome_ix] += weights.sum()
+
+        for normalisation in self.normalisations:
+            vector = self._normalisation_vector(normalisation, x, y, weights, n_bins)
+            self._write_normalisation_vector(normalisation, chromosome_ix, resolution, vector)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                normalised = weights / vector[x] / vector[y]
+            valid = np.isfinite(normalised)
+            distance_sums = self._distance_sums[(normalisation, resolution)]
+            distance_sums += np.bincount(y[valid] - x[valid], weights=normalised[valid],
+                                         minlength=len(distance_sums))
+            self._chromosome_sums[(normalisation, resolution)][chromosome_ix] += normalised[valid].sum()
+
+    @staticmethod
+    def _normalisation_vector(normalisation, x, y, weights, n_bins):
+        """
+        Juicer normalisation vector of an intra-chromosomal matrix.
+
+        Normalised weights are obtained by dividing by the vector entries
+        of both bins. Bins that cannot be normalised are NaN.
+        """
+        if normalisation in ('VC', 'VC_SQRT'):
+            off_diagonal = x != y
+            marginals = np.bincount(x, weights=weights, minlength=n_bins) + \
+                np.bincount(y[off_diagonal], weights=weights[off_diagonal], minlength=n_bins)
+            vector, _ = _ice_bias_vector(x, y, weights, n_bins, max_iterations=1,
+                                         sqrt=normalisation == 'VC_SQRT',
+                                         n_valid=np.sum(marginals > 0))
         else:
-            buf = buf + b
+            m = sp.coo_matrix((weights, (x, y)), shape=(n_bins, n_bins)).tocsr()
+            m = m + sp.triu(m, k=1).T
+            try:
+                _, bias_vector = _correct_sparse_matrix(m)
+            except (RuntimeError, ValueError) as e:
+                warnings.warn("KR normalisation failed ({}), masking all bins.".format(e))
+                bias_vector = np.zeros(n_bins)
+            with np.errstate(divide='ignore'):
+                vector = 1 / bias_vector
+
+        vector = np.array(vector, dtype=np.float64)
+        vector[~np.isfinite(vector) | (vector <= 0)] = np.nan
+        return vector
+
+    def _write_normalisation_vector(self, normalisation, chromosome_ix, resolution, vector):
+        position = self._file.tell()
+        self._file.write(struct.pack('<i', len(vector)))
+        self._file.write(np.asarray(vector, dtype='<f8').tobytes())
+        self._normalisation_entries[(normalisation, chromosome_ix, resolution)] = \
+            (position, self._file.tell() - position)
+
+    def _expected_values(self, normalisation, resolution):
+        """
+        Genome-wide expected values by distance and chromosome scaling factors.
+
+        :return: tuple (expected value array, dict of chromosome index: scaling factor)
+        """
+        n_bins = self._n_bins[resolution]
+        distance_sums = self._distance_sums[(normalisation, resolution)]
+
+        # number of intra-chromosomal matrix cells at each distance
+        bin_counts = np.bincount(n_bins, minlength=len(distance_sums) + 1)
+        n_chromosomes_above = np.cumsum(bin_counts[::-1])[::-1]
+        n_bins_above = np.cumsum((bin_counts * np.arange(len(bin_counts)))[::-1])[::-1]
+        distances = np.arange(len(distance_sums))
+        n_cells = n_bins_above[distances + 1] - distances * n_chromosomes_above[distances + 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            expected = np.where(n_cells > 0, distance_sums / n_cells, 0)
+
+        scaling_factors = dict()
+        observed_sums = self._chromosome_sums[(normalisation, resolution)]
+        for chromosome_ix, observed_sum in enumerate(observed_sums):
+            if observed_sum <= 0:
+                continue
+            chromosome_bins = n_bins[chromosome_ix]
+            expected_sum = np.sum(expected[:chromosome_bins] * (chromosome_bins - distances[:chromosome_bins]))
+            scaling_factors[chromosome_ix] = expected_sum / observed_sum
+        return expected, scaling_factors
+
+    def finish(self):
+        """
+        Write all remaining matrices, expected values, and the master index.
+        """
+        for chromosome_pair in sorted(self._counts.keys()):
+            self.write_matrix(*chromosome_pair)
+
+        # chromosomes without intra-chromosomal contacts are masked
+        for resolution in self.resolutions:
+            for chromosome_ix in range(len(self.chromosomes)):
+                for normalisation in self.normalisations:
+                    if (normalisation, chromosome_ix, resolution) not in self._normalisation_entries:
+                        vector = np.full(self._n_bins[resolution][chromosome_ix], np.nan)
+                        self._write_normalisation_vector(normalisation, chromosome_ix, resolution, vector)
+
+        unit = _juicer_cstr('BP')
+        footer = [struct.pack('<i', len(self._matrix_entries))]
+        for key, position, size in self._matrix_entries:
+            footer.append(_juicer_cstr(key))
+            footer.append(struct.pack('<qi', position, size))
+
+        for normalisations in (['NONE'], self.normalisations):
+            footer.append(struct.pack('<i', len(normalisations) * len(self.resolutions)))
+            for normalisation in normalisations:
+                for resolution in self.resolutions:
+                    expected, scaling_factors = self._expected_values(normalisation, resolution)
+                    if normalisation != 'NONE':
+                        footer.append(_juicer_cstr(normalisation))
+                    footer.append(unit)
+                    footer.append(struct.pack('<ii', resolution, len(expected)))
+                    footer.append(expected.astype('<f8').tobytes())
+                    footer.append(struct.pack('<i', len(scaling_factors)))
+                    for chromosome_ix, scaling_factor in sorted(scaling_factors.items()):
+                        footer.append(struct.pack('<id', chromosome_ix + 1, scaling_factor))
+
+        footer.append(struct.pack('<i', len(self._normalisation_entries)))
+        for (normalisation, chromosome_ix, resolution), (position, size) in \
+                sorted(self._normalisation_entries.items()):
+            footer.append(_juicer_cstr(normalisation))
+            footer.append(struct.pack('<i', chromosome_ix + 1))
+            footer.append(unit)
+            footer.append(struct.pack('<iqi', resolution, position, size))
+
+        footer = b''.join(footer)
+        f = self._file
+        master_index = f.tell()
+        f.write(struct.pack('<i', len(footer)))
+        f.write(footer)
+        f.seek(self._master_index_position)
+        f.write(struct.pack('<q', master_index))
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if not self._file.closed:
+            self._file.close()
+
+
+def _decode_block(block, version):
+    """
+    Decode a decompressed Juicer matrix block.
+
+    Records are parsed with :func:`~np.frombuffer` instead of
+    unpacking them one by one. Dense (type 2) blocks are read as a
+    single weight array. For row-wise sparse (type 1) blocks, only
+    the row headers are read in a loop, and the byte offsets of all
+    records are then computed from the cumulative row lengths.
+
+    :param block: decompressed block payload (bytes)
+    :param version: .hic file format version
+    :return: tuple of numpy arrays (x, y, weight). Missing values in
+             dense blocks are removed
+    """
+    n_records = struct.unpack_from('<i', block, 0)[0]
+    if version < 7:
+        records = np.frombuffer(block, dtype=np.dtype([('x', '<i4'), ('y', '<i4'), ('weight', '<f4')]),
+                                count=n_records, offset=4)
+        return (records['x'].astype(np.int64), records['y'].astype(np.int64),
+                records['weight'].astype(np.float64))
+
+    x_offset, y_offset, use_float, block_type = struct.unpack_from('<iibb', block, 4)
+    weight_dtype = np.dtype('<i2') if use_float == 0 else np.dtype('<f4')
+
+    if block_type == 1:
+        row_count = struct.unpack_from('<h', block, 14)[0]
+        record_dtype = np.dtype([('x', '<i2'), ('weight', weight_dtype)])
+
+        rows = np.zeros(row_count, dtype=np.int64)
+        col_counts = np.zeros(row_count, dtype=np.int64)
+        row_offsets = np.zeros(row_count, dtype=np.int64)
+        offset = 16
+        for i in range(row_count):
+            rows[i], col_counts[i] = struct.unpack_from('<hh', block, offset)
+            row_offsets[i] = offset + 4
+            offset += 4 + col_counts[i] * record_dtype.itemsize
+
+        # byte offset of each record: start of its row plus its position within the row
+        n = int(col_counts.sum())
+        position_in_row = np.arange(n) - np.repeat(np.cumsum(col_counts) - col_counts, col_counts)
+        record_offsets = np.repeat(row_offsets, col_counts) + position_in_row * record_dtype.itemsize
+        raw = np.frombuffer(block, dtype=np.uint8)
+        record_bytes = raw[record_offsets[:, None] + np.arange(record_dtype.itemsize)]
+        records = np.ascontiguousarray(record_bytes).view(record_dtype).ravel()
+
+        x = x_offset + records['x'].astype(np.int64)
+        y = y_offset + np.repeat(rows, col_counts)
+        return x, y, records['weight'].astype(np.float64)
+    elif block_type == 2:
+        n_points, w = struct.unpack_from('<ih', block, 14)
+        weights = np.frombuffer(block, dtype=weight_dtype, count=n_points, offset=20)
+        i = np.arange(n_points, dtype=np.int64)
+        if weight_dtype.kind == 'i':
+            keep = weights != -32768
+        else:
+            keep = ~np.isnan(weights)
+        i = i[keep]
+        return x_offset + i % w, y_offset + i // w, weights[keep].astype(np.float64)
+
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+
+class _JuicerReader(object):
+    """
+    Sequential reader for little-endian .hic data structures.
+
+    Reads the underlying file in chunks rather than byte by byte, and
+    skips over large arrays without reading them.
+    """
+    def __init__(self, req, position=0, chunk_size=65536):
+        self._req = req
+        self._chunk_size = chunk_size
+        self._buffer = b''
+        self._offset = 0
+        self._buffer_position = position
+        req.seek(position)
+
+    def tell(self):
+        return self._buffer_position + self._offset
+
+    def _fill(self, n):
+        if len(self._buffer) - self._offset >= n:
+            return
+        self._buffer = self._buffer[self._offset:] + self._req.read(max(n, self._chunk_size))
+        self._buffer_position += self._offset
+        self._offset = 0
+        if len(self._buffer) < n:
+            raise ValueError("Unexpected end of .hic file at position {}".format(self.tell()))
+
+    def unpack(self, fmt):
+        size = struct.calcsize(fmt)
+        self._fill(size)
+        values = struct.unpack_from(fmt, self._buffer, self._offset)
+        self._offset += size
+        return values if len(values) > 1 else values[0]
+
+    def cstr(self):
+        end = self._buffer.find(b'\0', self._offset)
+        while end == -1:
+            self._fill(len(self._buffer) - self._offset + self._chunk_size)
+            end = self._buffer.find(b'\0', self._offset)
+        value = self._buffer[self._offset:end].decode('utf-8', 'backslashreplace')
+        self._offset = end + 1
+        return value
+
+    def array(self, dtype, n):
+        dtype = np.dtype(dtype)
+        self._fill(dtype.itemsize * n)
+        values = np.frombuffer(self._buffer, dtype=dtype, count=n, offset=self._offset).copy()
+        self._offset += dtype.itemsize * n
+        return values
+
+    def skip(self, n):
+        if len(self._buffer) - self._offset >= n:
+            self._offset += n
+        else:
+            position = self.tell() + n
+            self._req.seek(position)
+            self._buffer = b''
+            self._offset = 0
+            self._buffer_position = position
 
 
 class LazyJuicerEdge(object):
@@ -274,7 +844,8 @@ class LazyJuicerEdge(object):
 
 
 class JuicerHic(RegionMatrixContainer):
-    def __init__(self, hic_file, resolution=None, mode='r', tmpdir=None, norm='KR'):
+    def __init__(self, hic_file, resolution=None, mode='r', tmpdir=None, norm='KR',
+                 block_cache_size='256M', index_cache=False):
         RegionMatrixContainer.__init__(self)
         if '@' in hic_file:
             fields = hic_file.split("@")
@@ -290,6 +861,23 @@ class JuicerHic(RegionMatrixContainer):
                                  "{} and {}".format(at_resolution, resolution))
             resolution = str_to_int(at_resolution)
 
+        if not is_juicer(hic_file):
+            raise ValueError("File {} does not seem to be a .hic "
+                             "file produced with juicer!".format(hic_file))
+
+        # header, footer, and matrix indexes are parsed once on first access
+        self._index_data = None
+        self._block_indexes = dict()
+        self._normalisation_vectors = dict()
+        self._expected_vectors = dict()
+        self._index_source_file = hic_file
+        if index_cache is True:
+            self._index_cache_file = hic_file + '.fanc_index'
+        elif index_cache:
+            self._index_cache_file = os.path.expanduser(index_cache)
+        else:
+            self._index_cache_file = None
+
         if tmpdir is None or (isinstance(tmpdir, bool) and not tmpdir):
             self.tmp_file_name = None
             self._hic_file = hic_file
@@ -322,9 +910,10 @@ class JuicerHic(RegionMatrixContainer):
         self._unit = 'BP'
         self._mappability = None
 
-        if not is_juicer(hic_file):
-            raise ValueError("File {} does not seem to be a .hic "
-                             "file produced with juicer!".format(hic_file))
+        # decoded matrix blocks by file position, least recently used first
+        self._block_cache = OrderedDict()
+        self._block_cache_bytes = 0
+        self._block_cache_size = str_to_int(block_cache_size)
 
     def __enter__(self):
         return self
@@ -346,101 +935,165 @@ class JuicerHic(RegionMatrixContainer):
             os.remove(self.tmp_file_name)
 
     @property
-    def version(self):
-        with open(self._hic_file, 'rb') as req:
-            req.read(4)  # jump to version location
-            return struct.unpack('<i', req.read(4))[0]
+    def _index(self):
+        """
+        Tables parsed from the header and footer of the .hic file.
+        """
+        if self._index_data is None:
+            index = self._read_index_cache()
+            if index is None:
+                index = self._read_index()
+                self._write_index_cache(index)
+            self._index_data = index
+        return self._index_data
+
+    def _read_index(self):
+        """
+        Parse header, master index, expected values index, and normalisation
+        vector index of the .hic file.
 
-    def _master_index(self):
+        Large vectors are skipped and only their file positions are
+        recorded, so they can be read on demand.
+
+        :return: dict
+        """
+        index = dict()
         with open(self._hic_file, 'rb') as req:
-            req.read(8)  # jump to master index location
-            return struct.unpack('<q', req.read(8))[0]
+            reader = _JuicerReader(req)
+            reader.skip(4)  # magic string
+            index['version'] = reader.unpack('<i')
+            index['master_index'] = reader.unpack('<q')
+            index['genome'] = reader.cstr()
 
-    @staticmethod
-    def _skip_to_attributes(req):
-        req.seek(0)
+            attributes = []
+            for _ in range(reader.unpack('<i')):
+                attributes.append((reader.cstr(), reader.cstr()))
+            index['attributes'] = attributes
 
-        # skip magic, version, master
-        req.read(16)
+            chromosomes = []
+            for _ in range(reader.unpack('<i')):
+                chromosomes.append((reader.cstr(), reader.unpack('<i')))
+            index['chromosomes'] = chromosomes
+
+            index['bp_resolutions'] = reader.array('<i4', reader.unpack('<i')).tolist()
+            index['fragment_resolutions'] = reader.array('<i4', reader.unpack('<i')).tolist()
+
+            reader = _JuicerReader(req, position=index['master_index'])
+            reader.skip(4)  # number of bytes in footer
+
+            matrix_positions = dict()
+            for _ in range(reader.unpack('<i')):
+                key = tuple(int(ix) for ix in reader.cstr().split('_'))
+                matrix_positions[key] = reader.unpack('<q')
+                reader.skip(4)  # size in bytes
+            index['matrix_positions'] = matrix_positions
+
+            # (normalisation, unit, bin size): (file position, number of values)
+            expected_values = dict()
+            scaling_factors = dict()
+            for normalised in (False, True):
+                for _ in range(reader.unpack('<i')):
+                    normalisation = reader.cstr() if normalised else 'NONE'
+                    unit = reader.cstr()
+                    bin_size = reader.unpack('<i')
+                    n_values = reader.unpack('<i')
+                    key = (normalisation, unit, bin_size)
+                    expected_values[key] = (reader.tell(), n_values)
+                    reader.skip(8 * n_values)
+
+                    factors = reader.array([('chromosome', '<i4'), ('factor', '<f8')], reader.unpack('<i'))
+                    scaling_factors[key] = dict(zip(factors['chromosome'].tolist(), factors['factor'].tolist()))
+            index['expected_values'] = expected_values
+            index['scaling_factors'] = scaling_factors
+
+            # (normalisation, chromosome index, unit, bin size): file position
+            normalisation_vectors = dict()
+            try:
+                n_entries = reader.unpack('<i')
+            except ValueError:
+                n_entries = 0
+            for _ in range(n_entries):
+                normalisation = reader.cstr()
+                chromosome_index = reader.unpack('<i')
+                unit = reader.cstr()
+                bin_size = reader.unpack('<i')
+                normalisation_vectors[(normalisation, chromosome_index, unit, bin_size)] = reader.unpack('<q')
+                reader.skip(4)  # size in bytes
+            index['normalisation_vectors'] = normalisation_vectors
 
-        # skip genome
-        while req.read(1).decode("utf-8") != '\0':
-            pass
+        return index
 
-    @staticmethod
-    def _skip_to_chromosome_lengths(req):
-        JuicerHic._skip_to_attributes(req)
-
-        # skip attributes
-        n_attributes = struct.unpack('<i', req.read(4))[0]
-        for _ in range(0, n_attributes):
-            # skip key
-            while req.read(1).decode("utf-8", "backslashreplace") != '\0':
-                pass
-            # skip value
-            while req.read(1).decode("utf-8", "backslashreplace") != '\0':
-                pass
+    _index_tuple_keys = ('matrix_positions', 'expected_values', 'scaling_factors', 'normalisation_vectors')
 
-    @staticmethod
-    def _skip_to_resolutions(req):
-        JuicerHic._skip_to_chromosome_lengths(req)
+    def _index_cache_key(self):
+        stat = os.stat(self._index_source_file)
+        return [stat.st_size, stat.st_mtime]
 
-        n_chromosomes = struct.unpack('<i', req.read(4))[0]
-        for _ in range(0, n_chromosomes):
-            while req.read(1).decode("utf-8", "backslashreplace") != '\0':
-                pass
-            req.read(4)
+    def _read_index_cache(self):
+        """
+        Load the parsed index from the sidecar cache file.
 
-    @staticmethod
-    def _skip_to_chromosome_sites(req):
-        JuicerHic._skip_to_resolutions(req)
+        :return: dict, or None if there is no cache file or it does
+                 not match the size and modification time of the
+                 .hic file
+        """
+        if self._index_cache_file is None or not os.path.exists(self._index_cache_file):
+            return None
 
-        n_resolutions = struct.unpack('<i', req.read(4))[0]
-        for _ in range(0, n_resolutions):
-            req.read(4)
+        try:
+            with open(self._index_cache_file, 'rb') as f:
+                cache = msgpack.loads(f.read(), use_list=False, raw=False, strict_map_key=False)
+        except (IOError, ValueError, msgpack.exceptions.ExtraData) as e:
+            logger.warning("Cannot read index cache {}: {}".format(self._index_cache_file, e))
+            return None
+
+        if list(cache['key']) != self._index_cache_key():
+            logger.debug("Index cache {} is outdated".format(self._index_cache_file))
+            return None
+
+        index = dict(cache['index'])
+        for key in self._index_tuple_keys:
+            index[key] = dict(index[key])
+        for key in ('attributes', 'chromosomes', 'bp_resolutions', 'fragment_resolutions'):
+            index[key] = list(index[key])
+        return index
+
+    def _write_index_cache(self, index):
+        """
+        Write the parsed index to the sidecar cache file, if enabled.
 
-        n_fragment_resolutions = struct.unpack('<i', req.read(4))[0]
-        for _ in range(0, n_fragment_resolutions):
-            req.read(4)
+        :param index: dict returned by :func:`~JuicerHic._read_index`
+        """
+        if self._index_cache_file is None:
+            return
+
+        index = dict(index)
+        for key in self._index_tuple_keys:
+            index[key] = list(index[key].items())
+
+        try:
+            with open(self._index_cache_file, 'wb') as f:
+                f.write(msgpack.dumps({'key': self._index_cache_key(), 'index': index}))
+        except (IOError, OSError) as e:
+            logger.warning("Cannot write index cache {}: {}".format(self._index_cache_file, e))
+
+    @property
+    def version(self):
+        return self._index['version']
+
+    def _master_index(self):
+        return self._index['master_index']
 
     @property
     def juicer_attributes(self):
-        with open(self._hic_file, 'rb') as req:
-            JuicerHic._skip_to_attributes(req)
-            attributes = {}
-            n_attributes = struct.unpack('<i', req.read(4))[0]
-            for _ in range(0, n_attributes):
-                key = _read_cstr(req)
-                value = _read_cstr(req)
-                attributes[key] = value
-        return attributes
+        return dict(self._index['attributes'])
 
     @property
     def chromosome_lengths(self):
-        with open(self._hic_file, 'rb') as req:
-            JuicerHic._skip_to_chromosome_lengths(req)
-
-            chromosome_lengths = {}
-            n_chromosomes = struct.unpack('<i', req.read(4))[0]
-            for _ in range(0, n_chromosomes):
-                name = _read_cstr(req)
-                length = struct.unpack('<i', req.read(4))[0]
-                chromosome_lengths[name] = length
-
-        return chromosome_lengths
+        return dict(self._index['chromosomes'])
 
     def _all_chromosomes(self):
-        with open(self._hic_file, 'rb') as req:
-            JuicerHic._skip_to_chromosome_lengths(req)
-
-            chromosomes = []
-            n_chromosomes = struct.unpack('<i', req.read(4))[0]
-            for _ in range(0, n_chromosomes):
-                name = _read_cstr(req)
-                req.read(4)
-                chromosomes.append(name)
-
-        return chromosomes
+        return [name for name, _ in self._index['chromosomes']]
 
     def chromosomes(self):
         chromosomes = []
@@ -451,134 +1104,78 @@ class JuicerHic(RegionMatrixContainer):
         return chromosomes
 
     def resolutions(self):
-        with open(self._hic_file, 'rb') as req:
-            JuicerHic._skip_to_resolutions(req)
-
-            resolutions = []
-            n_resolutions = struct.unpack('<i', req.read(4))[0]
-            for _ in range(0, n_resolutions):
-                resolution = struct.unpack('<i', req.read(4))[0]
-                resolutions.append(resolution)
-
-            fragment_resolutions = []
-            n_fragment_resolutions = struct.unpack('<i', req.read(4))[0]
-            for _ in range(0, n_fragment_resolutions):
-                resolution = struct.unpack('<i', req.read(4))[0]
-                fragment_resolutions.append(resolution)
-
-            return resolutions, fragment_resolutions
-
-    @staticmethod
-    def _skip_to_footer(req):
-        req.seek(0)
-        req.read(8)  # jump to master index location
-        master_index = struct.unpack('<q', req.read(8))[0]
-
-        # jump to footer location
-        req.seek(master_index)
-        req.read(4)  # skip number of bytes
-
-    @staticmethod
-    def _skip_to_expected_values(req):
-        JuicerHic._skip_to_footer(req)
-
-        n_entries = struct.unpack('<i', req.read(4))[0]
-        for _ in range(n_entries):
-            while req.read(1).decode("utf-8", "backslashreplace") != '\0':
-                pass
-            req.read(12)
-
-    @staticmethod
-    def _skip_to_normalised_expected_values(req):
-        JuicerHic._skip_to_expected_values(req)
-
-        n_vectors = struct.unpack('<i', req.read(4))[0]
-        for _ in range(n_vectors):
-            while req.read(1).decode("utf-8", "backslashreplace") != '\0':
-                pass
-            req.read(4)
-
-            n_values = struct.unpack('<i', req.read(4))[0]
-            for j in range(n_values):
-                req.read(8)
-
-            n_scaling_factors = struct.unpack('<i', req.read(4))[0]
-            for _ in range(n_scaling_factors):
-                req.read(12)
+        return list(self._index['bp_resolutions']), list(self._index['fragment_resolutions'])
 
-    @staticmethod
-    def _skip_to_normalisation_vectors(req):
-        JuicerHic._skip_to_normalised_expected_values(req)
-
-        n_vectors = struct.unpack('<i', req.read(4))[0]
-        for _ in range(n_vectors):
-            while req.read(1).decode("utf-8", "backslashreplace") != '\0':
-                pass
-            while req.read(1).decode("utf-8", "backslashreplace") != '\0':
-                pass
-            req.read(4)
+    def _matrix_positions(self):
+        return {(str(ix1), str(ix2)): position
+                for (ix1, ix2), position in self._index['matrix_positions'].items()}
 
-            n_values = struct.unpack('<i', req.read(4))[0]
-            for j in range(n_values):
-                req.read(8)
+    def _block_index(self, chromosome1_ix, chromosome2_ix, unit=None, resolution=None):
+        """
+        Get the block index of a chromosome pair matrix.
 
-            n_scaling_factors = struct.unpack('<i', req.read(4))[0]
-            for _ in range(n_scaling_factors):
-                req.read(12)
+        Block indexes are read once per matrix and resolution.
 
-    def _matrix_positions(self):
-        """
-        Copyright (c) 2016 Aiden Lab
+        :return: tuple (block bin count, block column count, dict
+                 of block number: (file position, size in bytes)),
+                 or None if there is no matrix for this chromosome pair
         """
+        if unit is None:
+            unit = self._unit
+        if resolution is None:
+            resolution = self._resolution
 
-        with open(self._hic_file, 'rb') as req:
-            JuicerHic._skip_to_footer(req)
+        key = (chromosome1_ix, chromosome2_ix, unit, resolution)
+        if key in self._block_indexes:
+            return self._block_indexes[key]
 
-            chromosome_pair_positions = {}
-            n_entries = struct.unpack('<i', req.read(4))[0]
-            for _ in range(n_entries):
-                key = tuple(_read_cstr(req).split('_'))
-                file_position = struct.unpack('<q', req.read(8))[0]
-                req.read(4)  # skip size in bytes
-                chromosome_pair_positions[key] = file_position
-            return chromosome_pair_positions
+        try:
+            matrix_file_position = self._index['matrix_positions'][(chromosome1_ix, chromosome2_ix)]
+        except KeyError:
+            return None
 
-    @staticmethod
-    def _expected_value_vectors_from_pos(req, normalisation=None, unit='BP'):
+        block_index = None
+        with open(self._hic_file, 'rb') as req:
+            reader = _JuicerReader(req, position=matrix_file_position)
+            reader.skip(8)  # skip chromosome index
+
+            for _ in range(reader.unpack('<i')):
+                entry_unit = reader.cstr()
+                reader.skip(20)  # skip reserved but unused fields
+                bin_size, block_bin_count, block_column_count, n_blocks = reader.unpack('<iiii')
+                if entry_unit == unit and bin_size == resolution:
+                    blocks = reader.array([('number', '<i4'), ('position', '<i8'), ('size', '<i4')], n_blocks)
+                    block_map = dict(zip(blocks['number'].tolist(),
+                                         zip(blocks['position'].tolist(), blocks['size'].tolist())))
+                    block_index = (block_bin_count, block_column_count, block_map)
+                    break
+                reader.skip(16 * n_blocks)
+
+        if block_index is None:
+            raise ValueError("Matrix data for {} {} not found!".format(resolution, unit))
+
+        self._block_indexes[key] = block_index
+        return block_index
+
+    def _expected_vector(self, normalisation, unit, resolution):
+        key = (normalisation, unit, resolution)
+        if key not in self._expected_vectors:
+            try:
+                position, n_values = self._index['expected_values'][key]
+            except KeyError:
+                return None
+            with open(self._hic_file, 'rb') as req:
+                self._expected_vectors[key] = _JuicerReader(req, position=position).array('<f8', n_values)
+        return self._expected_vectors[key]
+
+    def _expected_value_vectors(self, normalisation):
         expected_values = defaultdict(list)
         scaling_factors = defaultdict(dict)
-
-        n_vectors = struct.unpack('<i', req.read(4))[0]
-        for _ in range(n_vectors):
-            if normalisation:
-                entry_normalisation = _read_cstr(req)
-                entry_unit = _read_cstr(req)
-            else:
-                entry_unit = _read_cstr(req)
-                entry_normalisation = 'NONE'
-
-            bin_size = struct.unpack('<i', req.read(4))[0]
-
-            ev = []
-            n_values = struct.unpack('<i', req.read(4))[0]
-
-            for j in range(n_values):
-                v = struct.unpack('<d', req.read(8))[0]
-                ev.append(v)
-
-            if entry_unit == unit and (normalisation is None or entry_normalisation == normalisation):
-                expected_values[bin_size] = ev
-
-            sf = dict()
-            n_scaling_factors = struct.unpack('<i', req.read(4))[0]
-            for _ in range(n_scaling_factors):
-                chromosome_index = struct.unpack('<i', req.read(4))[0]
-                f = struct.unpack('<d', req.read(8))[0]
-                sf[chromosome_index] = f
-
-            if normalisation is None or entry_normalisation == normalisation:
-                scaling_factors[bin_size] = sf
-
+        for entry_normalisation, unit, bin_size in self._index['expected_values'].keys():
+            if entry_normalisation != normalisation or unit != self._unit:
+                continue
+            expected_values[bin_size] = self._expected_vector(normalisation, unit, bin_size).tolist()
+            scaling_factors[bin_size] = dict(self._index['scaling_factors'][(normalisation, unit, bin_size)])
         return expected_values, scaling_factors
 
     def expected_value_vector(self, chromosome, normalisation=None, resolution=None):
@@ -590,33 +1187,26 @@ class JuicerHic(RegionMatrixContainer):
 
         chromosome_ix = self._all_chromosomes().index(chromosome)
 
-        if normalisation == 'NONE':
-            vectors, scaling_factors = self.expected_value_vectors()
-        else:
-            vectors, scaling_factors = self.normalised_expected_value_vectors(normalisation)
+        vector = self._expected_vector(normalisation, self._unit, resolution)
+        if vector is None:
+            vector = np.zeros(0)
 
         try:
-            sf = scaling_factors[resolution][chromosome_ix]
+            sf = self._index['scaling_factors'][(normalisation, self._unit, resolution)][chromosome_ix]
         except KeyError:
             warnings.warn("Cannot find an expected value scaling factor "
                           "for {}, setting to 0.".format(chromosome))
             sf = 0.0
-        return np.array(vectors[resolution]) / sf
+        return vector / sf
 
     def expected_value_vectors(self):
-        with open(self._hic_file, 'rb') as req:
-            JuicerHic._skip_to_expected_values(req)
-
-            return JuicerHic._expected_value_vectors_from_pos(req)
+        return self._expected_value_vectors('NONE')
 
     def normalised_expected_value_vectors(self, normalisation=None):
         if normalisation is None:
             normalisation = self._normalisation
 
-        with open(self._hic_file, 'rb') as req:
-            JuicerHic._skip_to_normalised_expected_values(req)
-
-            return JuicerHic._expected_value_vectors_from_pos(req, normalisation=normalisation)
+        return self._expected_value_vectors(normalisation)
 
     def expected_values(self, selected_chromosome=None, norm=True, *args, **kwargs):
         if selected_chromosome is not None:
@@ -651,33 +1241,20 @@ class JuicerHic(RegionMatrixContainer):
         chromosomes = self.chromosomes()
         chromosome_index = chromosomes.index(chromosome) + 1
 
-        with open(self._hic_file, 'rb') as req:
-            JuicerHic._skip_to_normalisation_vectors(req)
+        key = (normalisation, chromosome_index, unit, resolution)
+        if key not in self._normalisation_vectors:
+            try:
+                position = self._index['normalisation_vectors'][key]
+            except KeyError:
+                raise ValueError("Cannot find normalisation vector that matches "
+                                 "chromosome: {}, normalisation: {}, "
+                                 "resolution: {}, unit: {}".format(chromosome, normalisation, resolution, unit))
 
-            n_entries = struct.unpack('<i', req.read(4))[0]
-            for _ in range(n_entries):
-                entry_normalisation = _read_cstr(req)
-                entry_chromosome_index = struct.unpack('<i', req.read(4))[0]
-                entry_unit = _read_cstr(req)
-                entry_resolution = struct.unpack('<i', req.read(4))[0]
-                file_position = struct.unpack('<q', req.read(8))[0]
-                req.read(4)  # skip size in bytes
-
-                if (entry_chromosome_index == chromosome_index and
-                        entry_normalisation == normalisation and
-                        entry_resolution == resolution and
-                        entry_unit == unit):
-                    req.seek(file_position)
-                    vector = []
-                    n_values = struct.unpack('<i', req.read(4))[0]
-                    for _ in range(n_values):
-                        v = struct.unpack('<d', req.read(8))[0]
-                        vector.append(v)
-
-                    return vector
-        raise ValueError("Cannot find normalisation vector that matches "
-                         "chromosome: {}, normalisation: {}, "
-                         "resolution: {}, unit: {}".format(chromosome, normalisation, resolution, unit))
+            with open(self._hic_file, 'rb') as req:
+                reader = _JuicerReader(req, position=position)
+                self._normalisation_vectors[key] = reader.array('<f8', reader.unpack('<i'))
+
+        return self._normalisation_vectors[key].tolist()
 
     def region_by_ix(self, ix):
         chromosome_lengths = self.chromosome_lengths
@@ -752,7 +1329,7 @@ class JuicerHic(RegionMatrixContainer):
                                                                                   self._resolution, chromosome))
                 norm = None
 
-            for i, start in enumerate(range(1, chromosome_length, self._resolution)):
+            for i, start in enumerate(range(1, chromosome_length + 1, self._resolution)):
                 if norm is None or np.isnan(norm[i]) or norm[i] == 0:
                     valid = False
                     bias = 1.0
@@ -809,72 +1386,45 @@ class JuicerHic(RegionMatrixContainer):
             length += ixs
         return length
 
-    def _read_block(self, req, file_position, block_size_in_bytes):
-        req.seek(file_position)
-        block_compressed = req.read(block_size_in_bytes)
-        block = zlib.decompress(block_compressed)
-
-        n_records = struct.unpack('<i', block[0:4])[0]
-        if self.version < 7:
-            for i in range(n_records):
-                x = struct.unpack('<i', block[(12 * i + 4):(12 * i + 8)])[0]
-                y = struct.unpack('<i', block[(12 * i + 8):(12 * i + 12)])[0]
-                weight = struct.unpack('<f', block[(12 * i + 12):(12 * i + 16)])[0]
-                yield x, y, weight
-        else:
-            x_offset = struct.unpack('<i', block[4:8])[0]
-            y_offset = struct.unpack('<i', block[8:12])[0]
-            use_short = not struct.unpack('<b', block[12:13])[0] == 0
-            block_type = struct.unpack('<b', block[13:14])[0]
-            index = 0
-
-            if block_type == 1:
-                row_count = struct.unpack('<h', block[14:16])[0]
-                temp = 16
-                for i in range(row_count):
-                    y_raw = struct.unpack('<h', block[temp:(temp + 2)])[0]
-                    temp += 2
-                    y = y_raw + y_offset
-                    col_count = struct.unpack('<h', block[temp:(temp + 2)])[0]
-                    temp += 2
-                    for j in range(col_count):
-                        x_raw = struct.unpack('<h', block[temp:(temp + 2)])[0]
-                        temp += 2
-                        x = x_offset + x_raw
-                        if not use_short:
-                            weight = struct.unpack('<h', block[temp:(temp + 2)])[0]
-                            temp += 2
-                        else:
-                            weight = struct.unpack('<f', block[temp:(temp + 4)])[0]
-                            temp += 4
-                        yield x, y, weight
-
-                        index += 1
-            elif block_type == 2:
-                temp = 14
-                n_points = struct.unpack('<i', block[temp:(temp + 4)])[0]
-                temp += 4
-                w = struct.unpack('<h', block[temp:(temp + 2)])[0]
-                temp += 2
-                for i in range(n_points):
-                    row = int(i / w)
-                    col = i - row * w
-                    x = int(x_offset + col)
-                    y = int(y_offset + row)
-                    if not use_short:
-                        weight = struct.unpack('<h', block[temp:(temp + 2)])[0]
-                        temp += 2
-                        if weight != -32768:
-                            yield x, y, weight
-                            index += 1
-                    else:
-                        weight = struct.unpack('<f', block[temp:(temp + 4)])[0]
-                        temp += 4
-                        if weight != 0x7fc00000:
-                            yield x, y, weight
-                            index = index + 1
+    def _read_block(self, req, file_position, block_size_in_bytes, version=None):
+        """
+        Read and decode a matrix block.
+
+        Decoded blocks are kept in a size-bounded LRU cache, so repeated
+        queries of the same matrix region do not decompress and decode
+        the same blocks again.
+
+        :param req: open binary file
+        :param file_position: position of the block in the file
+        :param block_size_in_bytes: compressed size of the block
+        :param version: .hic file format version. Read from file if None
+        :return: tuple of numpy arrays (x, y, weight)
+        """
+        try:
+            arrays = self._block_cache.pop(file_position)
+        except KeyError:
+            if version is None:
+                version = self.version
+            req.seek(file_position)
+            block = zlib.decompress(req.read(block_size_in_bytes))
+            arrays = _decode_block(block, version)
+            for array in arrays:
+                array.flags.writeable = False
+            self._block_cache_bytes += sum(array.nbytes for array in arrays)
+        self._block_cache[file_position] = arrays
+
+        while self._block_cache and self._block_cache_bytes > self._block_cache_size:
+            _, evicted = self._block_cache.popitem(last=False)
+            self._block_cache_bytes -= sum(array.nbytes for array in evicted)
+
+        return arrays
 
     def _read_matrix(self, region1, region2):
+        for x, y, weight in self._read_matrix_arrays(region1, region2):
+            for edge in zip(x.tolist(), y.tolist(), weight.tolist()):
+                yield edge
+
+    def _read_matrix_arrays(self, region1, region2):
         region1 = self._convert_region(region1)
         region2 = self._convert_region(region2)
 
@@ -889,46 +1439,16 @@ class JuicerHic(RegionMatrixContainer):
         region1_chromosome_offset = self._chromosome_ix_offset(region1.chromosome)
         region2_chromosome_offset = self._chromosome_ix_offset(region2.chromosome)
 
-        try:
-            matrix_file_position = self._matrix_positions()[(str(chromosome1_ix), str(chromosome2_ix))]
-        except KeyError:
+        block_index = self._block_index(chromosome1_ix, chromosome2_ix)
+        if block_index is None:
             return
+        block_bin_count, block_column_count, block_map = block_index
 
+        version = self.version
         with open(self._hic_file, 'rb') as req:
-            req.seek(matrix_file_position)
-            req.read(8)  # skip chromosome index
-
-            block_bin_count = None
-            block_column_count = None
-            block_map = dict()
-            n_resolutions = struct.unpack('<i', req.read(4))[0]
-            for i in range(n_resolutions):
-                unit = _read_cstr(req)
-                req.read(20)  # skip reserved but unused fields
-
-                bin_size = struct.unpack('<i', req.read(4))[0]
-                if unit == self._unit and bin_size == self._resolution:
-                    block_bin_count = struct.unpack('<i', req.read(4))[0]
-                    block_column_count = struct.unpack('<i', req.read(4))[0]
-
-                    n_blocks = struct.unpack('<i', req.read(4))[0]
-                    for b in range(n_blocks):
-                        block_number = struct.unpack('<i', req.read(4))[0]
-                        file_position = struct.unpack('<q', req.read(8))[0]
-                        block_size_in_bytes = struct.unpack('<i', req.read(4))[0]
-                        block_map[block_number] = (file_position, block_size_in_bytes)
-                else:
-                    req.read(8)
-
-                    n_blocks = struct.unpack('<i', req.read(4))[0]
-                    for b in range(n_blocks):
-                        req.read(16)
-
-            if block_bin_count is None or block_column_count is None:
-                raise ValueError("Matrix data for {} {} not found!".format(self._resolution, self._unit))
-
-            region1_bins = int(region1.start / self._resolution), int(region1.end / self._resolution) + 1
-            region2_bins = int(region2.start / self._resolution), int(region2.end / self._resolution) + 1
+            # first and last (exclusive) bin, including partial bins at chromosome ends
+            region1_bins = (region1.start - 1) // self._resolution, (region1.end - 1) // self._resolution + 1
+            region2_bins = (region2.start - 1) // self._resolution, (region2.end - 1) // self._resolution + 1
 
             col1, col2 = int(region1_bins[0] / block_bin_count), int(region1_bins[1] / block_bin_count)
             row1, row2 = int(region2_bins[0] / block_bin_count), int(region2_bins[1] / block_bin_count)
@@ -948,20 +1468,29 @@ class JuicerHic(RegionMatrixContainer):
             for block_number in blocks:
                 try:
                     file_position, block_size_in_bytes = block_map[block_number]
-
-                    for x, y, weight in self._read_block(req, file_position, block_size_in_bytes):
-                        if x < y:
-                            if region1_bins[0] <= x < region1_bins[1] - 1 and region2_bins[0] <= y < region2_bins[1] - 1:
-                                yield x + region1_chromosome_offset, y + region2_chromosome_offset, weight
-                            elif region1.chromosome == region2.chromosome:
-                                if region1_bins[0] <= y < region1_bins[1] - 1 and region2_bins[0] <= x < region2_bins[1] - 1:
-                                    yield x + region1_chromosome_offset, y + region2_chromosome_offset, weight
-                        else:
-                            if region1_bins[0] <= x < region1_bins[1] - 1 and region2_bins[0] <= y < region2_bins[1] - 1:
-                                yield y + region2_chromosome_offset, x + region1_chromosome_offset, weight
-
                 except KeyError:
                     logger.debug("Could not find block {}".format(block_number))
+                    continue
+
+                x, y, weight = self._read_block(req, file_position, block_size_in_bytes, version=version)
+
+                x_in_region1 = (region1_bins[0] <= x) & (x < region1_bins[1])
+                y_in_region2 = (region2_bins[0] <= y) & (y < region2_bins[1])
+                in_regions = x_in_region1 & y_in_region2
+                lower = x < y
+                keep = in_regions
+                if region1.chromosome == region2.chromosome:
+                    y_in_region1 = (region1_bins[0] <= y) & (y < region1_bins[1])
+                    x_in_region2 = (region2_bins[0] <= x) & (x < region2_bins[1])
+                    keep |= lower & y_in_region1 & x_in_region2
+
+                if not np.any(keep):
+                    continue
+
+                x, y, weight, lower = x[keep], y[keep], weight[keep], lower[keep]
+                yield (np.where(lower, x + region1_chromosome_offset, y + region2_chromosome_offset),
+                       np.where(lower, y + region2_chromosome_offset, x + region1_chromosome_offset),
+                       weight)
 
     def _edges_subset(self, key=None, row_regions=None, col_regions=None,
                       lazy=False, *args, **kwargs):
@@ -999,6 +1528,27 @@ class JuicerHic(RegionMatrixContainer):
                 edge.source, edge.sink, edge.weight = x, y, weight
                 yield edge
 
+    def _edge_arrays_subset(self, row_regions, col_regions, score_field=None,
+                            chunk_size=1000000, *args, **kwargs):
+        if row_regions[0].chromosome != row_regions[-1].chromosome:
+            raise ValueError("Cannot subset rows across multiple chromosomes!")
+
+        if col_regions[0].chromosome != col_regions[-1].chromosome:
+            raise ValueError("Cannot subset columns across multiple chromosomes!")
+
+        row_span = GenomicRegion(chromosome=row_regions[0].chromosome,
+                                 start=row_regions[0].start,
+                                 end=row_regions[-1].end)
+
+        col_span = GenomicRegion(chromosome=col_regions[0].chromosome,
+                                 start=col_regions[0].start,
+                                 end=col_regions[-1].end)
+
+        for x, y, weight in self._read_matrix_arrays(row_span, col_span):
+            for i in range(0, len(x), chunk_size):
+                x_chunk, y_chunk = x[i:i + chunk_size], y[i:i + chunk_size]
+                yield np.minimum(x_chunk, y_chunk), np.maximum(x_chunk, y_chunk), weight[i:i + chunk_size]
+
     def _edges_iter(self, *args, **kwargs):
         chromosomes = self.chromosomes()
         for ix1 in range(len(chromosomes)):
@@ -1041,7 +1591,7 @@ class JuicerHic(RegionMatrixContainer):
                     continue
 
                 norm = self.normalisation_vector(chromosome)
-                for i, _ in enumerate(range(1, chromosome_length, self._resolution)):
+                for i, _ in enumerate(range(1, chromosome_length + 1, self._resolution)):
                     if np.isnan(norm[i]):
                         mappable.append(False)
                     else:
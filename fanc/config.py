@@ -38,6 +38,7 @@ _default_config_content = """\
 # MEMORY
 #
 edge_buffer_size: 3G
+ice_memory_budget: 1G
 
 #
 # HDF5
@@ -263,8 +263,10 @@ class FileGroup(FileBased):
 
     _classid = 'FILEGROUP'
 
-    def __init__(self, group, file_name=None, mode='a', tmpdir=None):
-        FileBased.__init__(self, file_name=file_name, mode=mode, tmpdir=tmpdir)
+    def __init__(self, group, file_name=None, mode='a', tmpdir=None,
+                 _meta_group='meta_information'):
+        FileBased.__init__(self, file_name=file_name, mode=mode, tmpdir=tmpdir,
+                           _meta_group=_meta_group)
 
         try:
             group_node = self.file.get_node("/" + group)
@@ -885,15 +887,51 @@ class MaskedTable(t.Table):
     def _has_mask(self, row, mask):
         return mask in self._row_masks(row)
 
-    def _filter(self, mask_filters):
-        mask_filter_ixs = [2 ** mask_filter.mask_ix for mask_filter in mask_filters]
+    def _filter_masks(self, mask_filters, chunk_size=1000000):
+        """
+        Calculate the mask column resulting from a list of filters.
+
+        Only reads from the table, so it can be run on a read-only
+        handle. Use :func:`~MaskedTable._apply_masks` to write the
+        result to the table.
+
+        :param mask_filters: list of :class:`~MaskFilter`
+        :param chunk_size: Number of rows read at once by vectorised filters
+        :return: numpy array with the binary mask of each row
+        """
         n_rows = self._original_len()
         masks = self.col(self._mask_field)
 
-        for i, row in enumerate(self._iter_visible_and_masked()):
-            for j, mask_filter in enumerate(mask_filters):
-                if not mask_filter.valid(row):
-                    masks[i] = masks[i] | mask_filter_ixs[j]
+        chunk_filters = [f for f in mask_filters if f.supports_chunks()]
+        row_filters = [f for f in mask_filters if not f.supports_chunks()]
+
+        # vectorised filters operate on whole chunks of rows
+        if len(chunk_filters) > 0:
+            for start in range(0, n_rows, chunk_size):
+                stop = min(n_rows, start + chunk_size)
+                rows = self.read(start, stop)
+                for mask_filter in chunk_filters:
+                    valid = np.asarray(mask_filter.valid_chunk(rows), dtype=bool)
+                    masks[start:stop][~valid] |= 2 ** mask_filter.mask_ix
+
+        # remaining filters are checked row by row
+        if len(row_filters) > 0:
+            row_filter_ixs = [2 ** mask_filter.mask_ix for mask_filter in row_filters]
+            for i, row in enumerate(self._iter_visible_and_masked()):
+                for j, mask_filter in enumerate(row_filters):
+                    if not mask_filter.valid(row):
+                        masks[i] = masks[i] | row_filter_ixs[j]
+
+        return masks
+
+    def _apply_masks(self, masks):
+        """
+        Write a mask column and update the mask index accordingly.
+
+        :param masks: numpy array with the binary mask of each row
+        :return: dict with mask statistics
+        """
+        n_rows = self._original_len()
         mask_ixs, masked_length, stats = self._mask_ixs_and_stats_from_masks(masks)
 
         try:
@@ -910,12 +948,18 @@ class MaskedTable(t.Table):
 
         return stats
 
+    def _filter(self, mask_filters, chunk_size=1000000):
+        masks = self._filter_masks(mask_filters, chunk_size=chunk_size)
+        return self._apply_masks(masks)
+
     def filter(self, mask_filter, _logging=not config.hide_progressbars):
         """
         Run a MaskFilter on this table.
         
         This functions calls the MaskFilter.valid function on
         every row and masks them if the function returns False.
+        Filters implementing :func:`~MaskFilter.valid_chunk`
+        are applied to chunks of rows at once instead.
         After running the filter, the table index is updated
         to match only unmasked rows.
 
@@ -1017,3 +1061,30 @@ class MaskFilter(with_metaclass(ABCMeta, object)):
             bool: True if row is valid, False otherwise
         """
         pass
+
+    def valid_chunk(self, rows):
+        """
+        Test the validity of a chunk of rows at once.
+
+        Optional, vectorised alternative to :func:`~MaskFilter.valid`.
+        Filters overriding this method are applied by MaskedTable
+        to chunks of rows read into memory, which is much faster
+        than checking every row individually.
+
+        Args:
+            rows (numpy.ndarray):
+                Structured array with the table columns as fields
+
+        Returns:
+            numpy.ndarray: Boolean array, True for valid rows
+        """
+        raise NotImplementedError("Filter does not support chunks of rows")
+
+    def supports_chunks(self):
+        """
+        Check if this filter implements :func:`~MaskFilter.valid_chunk`.
+
+        Returns:
+            bool: True if chunks of rows can be filtered at once
+        """
+        return type(self).valid_chunk is not MaskFilter.valid_chunk
@@ -1,20 +1,22 @@
 from .config import config
 from .regions import Chromosome, Genome
-from .matrix import RegionMatrixTable, RegionMatrixContainer, Edge, LazyEdge
+from .matrix import RegionMatrixTable, RegionMatrixContainer, Edge, LazyEdge, _balanced_partition_breaks
 from abc import abstractmethod, ABCMeta
 from future.utils import with_metaclass, string_types, viewitems
 from .tools.load import load
-from .tools.general import distribute_integer, RareUpdateProgressBar
+from .tools.general import distribute_integer, RareUpdateProgressBar, str_to_int
 from .tools.matrix import restore_sparse_rows, remove_sparse_rows
-from .general import MaskFilter, MaskedTableView
+from .general import MaskFilter, MaskedTableView, FileBased
 from collections import defaultdict
 import multiprocessing as mp
 import threading
 import queue
 import numpy as np
+import scipy.sparse as sp
 import warnings
 import logging
 import msgpack
+import tables
 import copy
 
 logger = logging.getLogger(__name__)
@@ -109,9 +111,97 @@ def _get_overlap_map(old_regions, new_regions):
     return old_to_new
 
 
+def _region_arrays_by_chromosome(regions):
+    """
+    Collect region index, start and end arrays for each chromosome.
+
+    :param regions: iterator over regions, sorted by chromosome and start
+    :return: dict chromosome: (ixs, starts, ends)
+    """
+    region_lists = defaultdict(lambda: ([], [], []))
+    for i, region in enumerate(regions):
+        ixs, starts, ends = region_lists[region.chromosome]
+        ixs.append(i)
+        starts.append(region.start)
+        ends.append(region.end)
+    return {chromosome: tuple(np.array(values, dtype=np.int64) for values in lists)
+            for chromosome, lists in region_lists.items()}
+
+
+def _coarsening_map(old_regions, new_regions):
+    """
+    Map equidistant bins to larger equidistant bins by integer division.
+
+    Only applies if, on every chromosome, the old regions are bins of
+    equal size starting at 1 and the new bin size is a multiple of the
+    old one, so that each old bin lies entirely within one new bin.
+
+    :param old_regions: iterator over regions of the original matrix
+    :param new_regions: iterator over regions of the binned matrix
+    :return: array with the new region index of each old region (-1 for
+             chromosomes not in new_regions), or None if the regions
+             cannot be mapped by integer division
+    """
+    old_bins = _region_arrays_by_chromosome(old_regions)
+    new_bins = _region_arrays_by_chromosome(new_regions)
+    if len(old_bins) == 0:
+        return None
+
+    n_old = sum(len(ixs) for ixs, _, _ in old_bins.values())
+    new_ixs = np.full(n_old, -1, dtype=np.int64)
+    for chromosome, (old_ixs, old_starts, old_ends) in old_bins.items():
+        if chromosome not in new_bins:
+            continue
+        new_chromosome_ixs, new_starts, new_ends = new_bins[chromosome]
+
+        old_size = old_ends[0] - old_starts[0] + 1
+        if not np.array_equal(old_starts, np.arange(len(old_starts)) * old_size + 1):
+            return None
+
+        if len(new_starts) > 1:
+            new_size = new_ends[0] - new_starts[0] + 1
+            if new_size % old_size != 0:
+                return None
+            factor = new_size // old_size
+        else:
+            factor = len(old_starts)
+
+        new_local_ixs = np.minimum((old_ixs - old_ixs[0]) // factor, len(new_starts) - 1)
+        if not (np.all(old_starts >= new_starts[new_local_ixs]) and
+                np.all(old_ends <= new_ends[new_local_ixs])):
+            return None
+        new_ixs[old_ixs] = new_chromosome_ixs[new_local_ixs]
+    return new_ixs
+
+
+def _region_start_map(old_regions, new_regions):
+    """
+    Map regions to the regions that contain their start.
+
+    :param old_regions: iterator over regions, sorted by chromosome and start
+    :param new_regions: iterator over regions, sorted by chromosome and start
+    :return: array with the new region index of each old region (-1 if
+             the start is not in any new region)
+    """
+    old_bins = _region_arrays_by_chromosome(old_regions)
+    new_bins = _region_arrays_by_chromosome(new_regions)
+
+    n_old = sum(len(ixs) for ixs, _, _ in old_bins.values())
+    new_ixs = np.full(n_old, -1, dtype=np.int64)
+    for chromosome, (old_ixs, old_starts, _) in old_bins.items():
+        if chromosome not in new_bins:
+            continue
+        new_chromosome_ixs, new_starts, new_ends = new_bins[chromosome]
+        new_local_ixs = np.searchsorted(new_starts, old_starts, side='right') - 1
+        is_contained = new_local_ixs >= 0
+        is_contained[is_contained] = old_starts[is_contained] <= new_ends[new_local_ixs[is_contained]]
+        new_ixs[old_ixs[is_contained]] = new_chromosome_ixs[new_local_ixs[is_contained]]
+    return new_ixs
+
+
 def _bin_hic_partition_worker(hic_file, qin, qout,
                               overlap_map, _edges_by_overlap_method,
-                              access_lock):
+                              access_lock, load_kwargs=None):
 
     try:
         overlap_map = msgpack.loads(overlap_map, strict_map_key=False)
@@ -127,7 +217,7 @@ def _bin_hic_partition_worker(hic_file, qin, qout,
             with access_lock:
                 hic = None
                 try:
-                    hic = load(hic_file)
+                    hic = load(hic_file, **(load_kwargs or {}))
                     _weight_field = hic._default_score_field
                     all_edges = []
                     key = slice(partition1[0], partition1[1], 1), slice(partition2[0], partition2[1], 1)
@@ -170,14 +260,21 @@ class Hic(RegionMatrixTable):
                  partition_strategy='auto',
                  additional_region_fields=None, additional_edge_fields=None,
                  _table_name_regions='regions', _table_name_edges='edges',
-                 _edge_buffer_size=config.edge_buffer_size):
+                 _edge_buffer_size=config.edge_buffer_size,
+                 _table_name_expected_values='expected_values',
+                 _table_name_masks='mask', _meta_group='meta_information',
+                 clustered=False):
         RegionMatrixTable.__init__(self, file_name=file_name,
                                    mode=mode, tmpdir=tmpdir,
                                    additional_region_fields=additional_region_fields,
                                    additional_edge_fields=additional_edge_fields,
                                    partition_strategy=partition_strategy,
+                                   clustered=clustered,
                                    _table_name_regions=_table_name_regions,
                                    _table_name_edges=_table_name_edges,
+                                   _table_name_expected_values=_table_name_expected_values,
+                                   _table_name_masks=_table_name_masks,
+                                   _meta_group=_meta_group,
                                    _edge_buffer_size=_edge_buffer_size)
 
     def load_from_hic(self, hic, threads=1, chromosomes=None,
@@ -215,6 +312,15 @@ class Hic(RegionMatrixTable):
         else:
             logger.info("Binning Hi-C contacts")
 
+            # equidistant bins map to larger bins by integer division
+            new_region_ixs = _coarsening_map(hic.regions(lazy=True), self.regions(lazy=True))
+            if new_region_ixs is not None:
+                logger.debug("Binning by region index")
+                self._bin_edges_by_index(hic, new_region_ixs, chromosomes=chromosomes)
+                logger.debug("Final flush")
+                self.flush()
+                return
+
             # create region "overlap map"
             overlap_map = _get_overlap_map(hic.regions(lazy=False), self.regions(lazy=False))
 
@@ -224,7 +330,9 @@ class Hic(RegionMatrixTable):
             qout = m.Queue()
             qin = m.Queue()
 
-            if not isinstance(hic, RegionMatrixTable):
+            # a matrix in the same file (e.g. a MultiResolutionHic) cannot be
+            # read by worker processes while this process writes to it
+            if not isinstance(hic, RegionMatrixTable) or hic.file is self.file:
                 edge_counter = 0
                 with RareUpdateProgressBar(max_value=len(hic.edges), silent=config.hide_progressbars,
                                            prefix="Binning") as pb:
@@ -260,25 +368,26 @@ class Hic(RegionMatrixTable):
                                                        qin, qout,
                                                        msgpack.dumps(overlap_map),
                                                        _edges_by_overlap_method,
-                                                       access_lock)) as pool:
+                                                       access_lock,
+                                                       hic._load_kwargs)) as pool:
 
+                        # split chromosomes into chunks with similar numbers of edges.
+                        # chunks must not share binned regions, so chromosomes are not split
                         n_fragments = len(hic.regions)
-                        thread_max = min(int(n_fragments/threads), _regions_soft_max)
-                        partitions = [[0, 0]]
+                        thread_max = max(1, min(int(n_fragments/threads), _regions_soft_max))
+                        n_partitions = max(threads, int(np.ceil(n_fragments / thread_max)))
+                        chromosome_starts = [0]
                         previous_chromosome = None
                         for i, region in enumerate(hic.regions(lazy=True)):
-                            if previous_chromosome is not None and (region.chromosome != previous_chromosome
-                                                                    or i == n_fragments - 1):
-                                partition_size = partitions[-1][1] - partitions[-1][0]
-                                current_size = i - partitions[-1][1]
-                                partition_empty = thread_max - partition_size
-
-                                if partition_size == 0 or partition_empty > current_size/2:
-                                    partitions[-1][1] = i
-                                else:
-                                    partitions.append([partitions[-1][1], i])
+                            if previous_chromosome is not None and region.chromosome != previous_chromosome:
+                                chromosome_starts.append(i)
                             previous_chromosome = region.chromosome
-                        partitions[-1][1] = n_fragments
+                        chromosome_starts.append(n_fragments)
+                        chromosome_weights = np.add.reduceat(hic._region_edge_density(), chromosome_starts[:-1])
+                        breaks = [chromosome_starts[b] for b in _balanced_partition_breaks(chromosome_weights,
+                                                                                            n_partitions)]
+                        partitions = [[start, end] for start, end in zip([0] + breaks,
+                                                                         breaks + [n_fragments])]
 
                         logger.info("Submitting partitions")
 
@@ -316,12 +425,61 @@ class Hic(RegionMatrixTable):
             logger.debug("Final flush")
             self.flush()
 
+    def _bin_edges_by_index(self, hic, new_region_ixs, chromosomes=None):
+        """
+        Bin the contacts of another matrix using a region index map.
+
+        :param hic: Matrix object, e.g. :class:`~Hic`
+        :param new_region_ixs: array with the index of the region in this
+                               object for every region in hic, -1 for regions
+                               that are not binned. See :func:`~_coarsening_map`
+        :param chromosomes: List of chromosomes to bin. All chromosomes by default
+        """
+        if chromosomes is None:
+            chromosomes = hic.chromosomes()
+
+        n_regions = len(self.regions)
+        edge_dtype = [('source', np.int64), ('sink', np.int64), (self._default_score_field, np.float64)]
+        chromosome_pairs = [(chromosomes[i], chromosomes[j])
+                            for i in range(len(chromosomes)) for j in range(i, len(chromosomes))]
+
+        self._disable_edge_indexes()
+        with RareUpdateProgressBar(max_value=len(chromosome_pairs), silent=config.hide_progressbars,
+                                   prefix="Binning") as pb:
+            for i, chromosome_pair in enumerate(chromosome_pairs):
+                sources, sinks, weights = [], [], []
+                for source, sink, weight in hic.edge_arrays(chromosome_pair, norm=False):
+                    new_source, new_sink = new_region_ixs[source], new_region_ixs[sink]
+                    is_binned = np.logical_and(new_source >= 0, new_sink >= 0)
+                    sources.append(np.minimum(new_source, new_sink)[is_binned])
+                    sinks.append(np.maximum(new_source, new_sink)[is_binned])
+                    weights.append(weight[is_binned])
+
+                if len(sources) > 0:
+                    m = sp.coo_matrix((np.concatenate(weights),
+                                       (np.concatenate(sources), np.concatenate(sinks))),
+                                      shape=(n_regions, n_regions))
+                    m.sum_duplicates()
+                    m.eliminate_zeros()
+                    logger.debug("Adding edges {}/{} ({})".format(chromosome_pair[0], chromosome_pair[1], m.nnz))
+
+                    edges = np.empty(m.nnz, dtype=edge_dtype)
+                    edges['source'] = m.row
+                    edges['sink'] = m.col
+                    edges[self._default_score_field] = m.data
+                    self._edge_buffer.add_array(edges)
+                pb.update(i)
+
     def bin(self, bin_size, threads=1, chromosomes=None, *args, **kwargs):
         """
         Map edges in this object to equidistant bins.
 
         :param bin_size: Bin size in base pairs
         :param threads: Number of threads used for binning
+        :param args: Positional arguments passed to the constructor of the binned object
+        :param kwargs: Keyword arguments passed to the constructor of the binned object.
+                       With :code:`partition_strategy='density'`, the edge tables of the
+                       binned object are balanced using the edge counts of this object
         :return: :class:`~Hic` object
         """
         # find chromosome lengths
@@ -347,6 +505,13 @@ class Hic(RegionMatrixTable):
         if 'mode' not in kwargs:
             kwargs['mode'] = 'w'
         hic = self.__class__(*args, **kwargs)
+        if kwargs.get('partition_strategy') == 'density':
+            logger.info("Estimating edge density of binned matrix...")
+            new_region_ixs = _region_start_map(self.regions(lazy=True), regions.regions(lazy=True))
+            is_mapped = new_region_ixs >= 0
+            hic._set_partition_density(np.bincount(new_region_ixs[is_mapped],
+                                                   weights=self._region_edge_density()[is_mapped],
+                                                   minlength=len(regions.regions)))
         hic.add_regions(regions.regions(lazy=True), preserve_attributes=False)
         regions.close()
         hic.load_from_hic(self, threads=threads, chromosomes=chromosomes)
@@ -366,8 +531,7 @@ class Hic(RegionMatrixTable):
         if vector is not None:
             self.region_data('bias', vector)
 
-        biases = np.array(list(self.region_data('bias')))
-        return biases
+        return self._region_arrays()['bias'].copy()
 
     def filter_diagonal(self, distance=0, queue=False):
         """
@@ -418,6 +582,10 @@ class Hic(RegionMatrixTable):
         low_coverage_filter = LowCoverageFilter(self, rel_cutoff=rel_cutoff, cutoff=cutoff, mask=mask)
         self.filter(low_coverage_filter, queue)
 
+    def _prepare_filter(self, mask_filter):
+        if isinstance(mask_filter, HicEdgeFilter):
+            mask_filter.set_hic_object(self)
+
     def filter_statistics(self):
         stats = self.mask_statistics(self._edges)
         return stats
@@ -520,6 +688,193 @@ class LegacyHic(Hic):
             return np.repeat(1., len(self.regions))
 
 
+class MultiResolutionHic(FileBased):
+    """
+    Container for the same Hi-C matrix at several resolutions.
+
+    Each resolution is stored as a separate :class:`~Hic` in a
+    set of HDF5 nodes suffixed with the bin size, so that a single file
+    replaces a collection of per-resolution files. Coarser resolutions
+    are built from the next finer one in the file:
+
+    .. code::
+
+        with MultiResolutionHic('/path/to/file.mhic', mode='w') as mhic:
+            mhic.add_hic(fanc.load('/path/to/5kb.hic'), 5000)
+            mhic.coarsen([10000, 25000, 50000, 100000])
+
+    Individual resolutions can be obtained from the container with
+    :func:`~MultiResolutionHic.hic`, or opened directly using
+    :code:`fanc.load('/path/to/file.mhic', resolution=25000)`.
+    """
+
+    _classid = 'MULTIRESOLUTIONHIC'
+
+    def __init__(self, file_name=None, mode='a', tmpdir=None):
+        FileBased.__init__(self, file_name=file_name, mode=mode, tmpdir=tmpdir)
+        self._mode = mode
+        self._hics = dict()
+
+        if 'resolutions' not in self.meta:
+            try:
+                self.meta['resolutions'] = []
+            except tables.FileModeError:
+                pass
+
+    @classmethod
+    def _load_file(cls, file_name, mode='r', resolution=None, tmpdir=None, *args, **kwargs):
+        """
+        Open the container, or a single resolution as :class:`~Hic`.
+
+        Used by :func:`~fanc.load` to support the :code:`resolution`
+        argument.
+        """
+        if resolution is None:
+            return cls(file_name=file_name, mode=mode, tmpdir=tmpdir, *args, **kwargs)
+
+        with cls(file_name=file_name, mode='r') as mhic:
+            resolutions = mhic.resolutions()
+        resolution = str_to_int(resolution) if isinstance(resolution, string_types) else int(resolution)
+        if resolution not in resolutions:
+            raise ValueError("Resolution {} not in file, available resolutions are: "
+                             "{}".format(resolution, ", ".join(str(r) for r in resolutions)))
+        return MultiResolutionHic._resolution_hic(file_name, resolution, mode=mode, tmpdir=tmpdir)
+
+    @staticmethod
+    def _resolution_hic(file_name, resolution, mode='r', tmpdir=None):
+        """
+        Open a single resolution in a container file as :class:`~Hic`.
+
+        :param file_name: Path to the container, or its open :class:`tables.File`
+        :param resolution: Bin size in base pairs
+        :return: :class:`~Hic`
+        """
+        hic = Hic(file_name=file_name, mode=mode, tmpdir=tmpdir,
+                  **MultiResolutionHic._node_names(resolution))
+        hic._load_kwargs = dict(resolution=resolution)
+        return hic
+
+    @staticmethod
+    def _node_names(resolution):
+        return dict(_table_name_regions='regions_{}'.format(resolution),
+                    _table_name_edges='edges_{}'.format(resolution),
+                    _table_name_expected_values='expected_values_{}'.format(resolution),
+                    _table_name_masks='mask_{}'.format(resolution),
+                    _meta_group='meta_information_{}'.format(resolution))
+
+    def resolutions(self):
+        """
+        List of resolutions (bin sizes) in this container.
+
+        :return: sorted list of int
+        """
+        try:
+            return sorted(int(r) for r in self.meta['resolutions'])
+        except KeyError:
+            return []
+
+    def _add_resolution(self, resolution):
+        resolutions = self.resolutions()
+        resolutions.append(resolution)
+        self.meta['resolutions'] = sorted(resolutions)
+
+    def hic(self, resolution):
+        """
+        Get the :class:`~Hic` object for a specific resolution.
+
+        The returned object shares the file of this container - do not
+        close it individually, close the container instead.
+
+        :param resolution: Bin size in base pairs
+        :return: :class:`~Hic`
+        """
+        resolution = int(resolution)
+        if resolution not in self.resolutions():
+            raise ValueError("Resolution {} not in container, available resolutions are: "
+                             "{}".format(resolution, ", ".join(str(r) for r in self.resolutions())))
+
+        if resolution not in self._hics:
+            self._hics[resolution] = MultiResolutionHic._resolution_hic(self.file, resolution, mode=self._mode)
+        return self._hics[resolution]
+
+    def add_hic(self, hic, resolution=None):
+        """
+        Copy a Hi-C matrix into this container.
+
+        Regions are copied including their attributes (such as bias
+        values), edges are copied without normalisation.
+
+        :param hic: :class:`~Hic` or other :class:`~RegionMatrixContainer`
+        :param resolution: Bin size of the matrix in base pairs. Determined
+                           from the matrix regions if not provided.
+        :return: :class:`~Hic` in this container
+        """
+        if resolution is None:
+            resolution = hic.bin_size
+        resolution = int(resolution)
+        if resolution in self.resolutions():
+            raise ValueError("Resolution {} already exists in container".format(resolution))
+
+        logger.info("Adding matrix at resolution {}".format(resolution))
+        new_hic = MultiResolutionHic._resolution_hic(self.file, resolution, mode='a')
+        new_hic.add_regions(hic.regions(lazy=True), preserve_attributes=True)
+
+        chromosomes = hic.chromosomes()
+        edge_dtype = [('source', np.int64), ('sink', np.int64), (new_hic._default_score_field, np.float64)]
+        new_hic._disable_edge_indexes()
+        for i in range(len(chromosomes)):
+            for j in range(i, len(chromosomes)):
+                for source, sink, weight in hic.edge_arrays((chromosomes[i], chromosomes[j]), norm=False):
+                    edges = np.empty(len(source), dtype=edge_dtype)
+                    edges['source'] = source
+                    edges['sink'] = sink
+                    edges[new_hic._default_score_field] = weight
+                    new_hic._edge_buffer.add_array(edges)
+        new_hic.flush()
+
+        self._add_resolution(resolution)
+        self._hics[resolution] = new_hic
+        return new_hic
+
+    def coarsen(self, resolutions, threads=1):
+        """
+        Build coarser resolutions from the matrices in this container.
+
+        Resolutions are processed from fine to coarse, and each one is
+        binned from the next finer resolution in the container that it
+        is a multiple of, so that contacts are summed by region index
+        rather than by overlap.
+
+        :param resolutions: Bin size or list of bin sizes in base pairs
+        :param threads: Number of threads used for binning
+        :return: list of :class:`~Hic` objects, one per resolution
+        """
+        if not isinstance(resolutions, (list, tuple)):
+            resolutions = [resolutions]
+
+        hics = []
+        for resolution in sorted(int(r) for r in resolutions):
+            if resolution in self.resolutions():
+                logger.info("Resolution {} already exists, skipping".format(resolution))
+                hics.append(self.hic(resolution))
+                continue
+
+            finer = [r for r in self.resolutions() if r < resolution and resolution % r == 0]
+            if len(finer) == 0:
+                raise ValueError("Resolution {} is not a multiple of any resolution in "
+                                 "the container ({})".format(resolution,
+                                                             ", ".join(str(r) for r in self.resolutions())))
+
+            logger.info("Binning resolution {} from {}".format(resolution, max(finer)))
+            hic = self.hic(max(finer)).bin(resolution, threads=threads, file_name=self.file, mode='a',
+                                           **MultiResolutionHic._node_names(resolution))
+            hic._load_kwargs = dict(resolution=resolution)
+            self._add_resolution(resolution)
+            self._hics[resolution] = hic
+            hics.append(hic)
+        return hics
+
+
 class HicEdgeFilter(with_metaclass(ABCMeta, MaskFilter)):
     """
     Abstract class that provides filtering functionality for the
@@ -569,6 +924,19 @@ class HicEdgeFilter(with_metaclass(ABCMeta, MaskFilter)):
         """
         pass
 
+    def __getstate__(self):
+        # the Hic object cannot be pickled, it is
+        # set again by Hic._prepare_filter
+        state = self.__dict__.copy()
+        state['_hic'] = None
+        state['_lazy_edge'] = None
+        return state
+
+    def __setstate__(self, state):
+        # LazyEdge cannot be unpickled
+        self.__dict__.update(state)
+        self._lazy_edge = LazyEdge(None)
+
     def set_hic_object(self, hic_object):
         """
         Set the :class:`~Hic` instance to be filtered by this
@@ -616,6 +984,10 @@ class DiagonalFilter(HicEdgeFilter):
             return False
         return True
 
+    def valid_chunk(self, rows):
+        distance = np.abs(rows['source'].astype(np.int64) - rows['sink'])
+        return distance > self.distance
+
 
 class LowCoverageFilter(HicEdgeFilter):
     """
@@ -662,10 +1034,8 @@ class LowCoverageFilter(HicEdgeFilter):
             cutoff = self.calculate_cutoffs(rel_cutoff)[0]
         logger.info("Final absolute cutoff threshold is {:.4}".format(float(cutoff)))
 
-        self._regions_to_mask = set()
-        for i, contacts in enumerate(self._marginals):
-            if contacts < cutoff:
-                self._regions_to_mask.add(i)
+        self._low_coverage = self._marginals < cutoff
+        self._regions_to_mask = set(np.where(self._low_coverage)[0].tolist())
         logger.info("Selected a total of {} ({:.1%}) regions to be masked".format(
             len(self._regions_to_mask), len(self._regions_to_mask)/len(hic_object.regions)))
 
@@ -684,10 +1054,14 @@ class LowCoverageFilter(HicEdgeFilter):
             return False
         return True
 
+    def valid_chunk(self, rows):
+        return ~np.logical_or(self._low_coverage[rows['source']],
+                              self._low_coverage[rows['sink']])
+
 
 def ice_balancing(hic, tolerance=1e-2, max_iterations=500, whole_matrix=True,
                   inter_chromosomal=True, intra_chromosomal=True, restore_coverage=False,
-                  sqrt=True):
+                  sqrt=True, threads=1, out_of_core=False, memory_budget=config.ice_memory_budget):
     """
     Apply ICE balancing to Hi-C matrices.
 
@@ -704,123 +1078,64 @@ def ice_balancing(hic, tolerance=1e-2, max_iterations=500, whole_matrix=True,
     :param restore_coverage: Restore the matrix to its original coverage after balancing,
                              i.e. the sum of contacts in the matrix after balancing remains
                              (roughly) the same
+    :param threads: Number of processes used to balance chromosomes in parallel
+                    (only if whole_matrix is False and out_of_core is False)
+    :param out_of_core: Do not load all edges into memory, but stream them from
+                        the edge tables in chunks in every iteration. Slower, but
+                        memory usage is bounded by memory_budget
+    :param memory_budget: Approximate memory used for edge chunks in out-of-core mode,
+                          in bytes or as string with suffix, e.g. "1G"
     :return: bias vector
     """
     logger.info("Starting ICE matrix balancing")
 
-    if not whole_matrix:
-        bias_vectors = []
-        for chromosome in hic.chromosomes():
-            logger.debug("Chromosome {}".format(chromosome))
-            region_converter = dict()
-            bias_vector = []
-            n_regions = 0
-            for i, region in enumerate(hic.regions(chromosome)):
-                region_converter[region.ix] = i
-                bias_vector.append(1)
-                if region.valid:
-                    n_regions += 1
-            bias_vector = np.array(bias_vector, dtype='float64')
-
-            marginal_error = tolerance + 1
-            current_iteration = 0
-
-            total_weight = 0
-            edges = []
-            for e in hic.edges_dict((chromosome, chromosome), lazy=True, norm=False):
-                source, sink, weight = e['source'], e['sink'], e['weight']
-                edges.append([source, sink, weight])
-                total_weight += weight
-                if source != sink:
-                    total_weight += weight
-
-            if len(edges) > 0:
-                while (marginal_error > tolerance and
-                       current_iteration < max_iterations):
-                    m = np.zeros(len(bias_vector), dtype='float64')
-                    for source, sink, weight in edges:
-                        source_sub = region_converter[source]
-                        sink_sub = region_converter[sink]
-                        m[source_sub] += weight
-                        if source != sink:
-                            m[sink_sub] += weight
-
-                    try:
-                        marginal_error = _marginal_error(m)
-                    except Exception as e:
-                        print(e)
-                        print(edges)
-                        raise
-
-                    if sqrt:
-                        m = np.sqrt(m)
-                    else:
-                        # multiply with constant factor so marginals are 1
-                        bias_mean = np.mean(m[m != 0])
-                        marginal_mean = np.sqrt(np.sum(m) / n_regions)
-                        m = m * marginal_mean / bias_mean
-
-                    bias_vector *= m
-
-                    for i in range(len(edges)):
-                        source = region_converter[edges[i][0]]
-                        sink = region_converter[edges[i][1]]
-                        edges[i][2] = 0 if m[sink] == 0 else edges[i][2] / m[source] / m[sink]
-
-                    current_iteration += 1
-
-                    if restore_coverage:
-                        bias_vector = bias_vector / np.sqrt(total_weight / n_regions)
+    if out_of_core:
+        bias_vector = _ice_balancing_out_of_core(hic, tolerance=tolerance, max_iterations=max_iterations,
+                                                 whole_matrix=whole_matrix,
+                                                 inter_chromosomal=inter_chromosomal,
+                                                 intra_chromosomal=intra_chromosomal,
+                                                 restore_coverage=restore_coverage, sqrt=sqrt,
+                                                 memory_budget=memory_budget)
+    elif not whole_matrix:
+        mappable = hic.mappable()
+        cb = hic.chromosome_bins
 
-                    logger.debug("Iteration: %d, error: %lf" % (current_iteration, marginal_error))
-            else:
+        chromosomes = []
+        chromosome_edges = []
+        for chromosome in hic.chromosomes():
+            logger.debug("Collecting edges for chromosome {}".format(chromosome))
+            start, end = cb[chromosome]
+            source, sink, weight = _concatenate_edge_arrays(hic.edge_arrays((chromosome, chromosome),
+                                                                            norm=False))
+            if len(source) == 0:
                 warnings.warn("Chromosome {} has no valid edges, skipping normalisation!".format(chromosome))
-
-            bias_vectors.append(bias_vector)
+            chromosomes.append(chromosome)
+            chromosome_edges.append((source - start, sink - start, weight, end - start,
+                                     np.sum(mappable[start:end]), tolerance, max_iterations,
+                                     sqrt, restore_coverage))
+
+        if threads > 1:
+            with mp.get_context("spawn").Pool(threads) as pool:
+                bias_vectors = pool.map(_ice_balancing_chromosome_worker, chromosome_edges)
+        else:
+            bias_vectors = [_ice_balancing_chromosome_worker(edges) for edges in chromosome_edges]
         logger.info("Done.")
         logger.info("Adding bias vector...")
         bias_vector = np.concatenate(bias_vectors)
 
         logger.info("Done.")
     else:
-        bias_vector = np.ones(len(hic.regions), float)
-        marginal_error = tolerance + 1
-        current_iteration = 0
         logger.info("Collecting edges")
-
-        total_weight = 0
-        edges = []
-        for e in hic.edges(norm=False, lazy=True,
-                           intra_chromosomal=intra_chromosomal,
-                           inter_chromosomal=inter_chromosomal):
-            source, sink, weight = e.source, e.sink, e.weight
-            edges.append([source, sink, weight])
-            total_weight += weight
-            if source != sink:
-                total_weight += weight
+        source, sink, weight = _concatenate_edge_arrays(hic.edge_arrays(norm=False,
+                                                                        intra_chromosomal=intra_chromosomal,
+                                                                        inter_chromosomal=inter_chromosomal))
 
         logger.info("Starting iterations")
-        while (marginal_error > tolerance and
-               current_iteration < max_iterations):
-            m = np.zeros(len(bias_vector), dtype='float64')
-            for i in range(len(edges)):
-                source = edges[i][0]
-                sink = edges[i][1]
-                m[source] += edges[i][2]
-                if source != sink:
-                    m[sink] += edges[i][2]
-
-            bias_vector *= np.sqrt(m)
-            marginal_error = _marginal_error(m)
-            for i in range(len(edges)):
-                source = edges[i][0]
-                sink = edges[i][1]
-                edges[i][2] = 0 if m[sink] == 0 else edges[i][2]/np.sqrt(m[source])/np.sqrt(m[sink])
-
-            current_iteration += 1
-            logger.debug("Iteration: %d, error: %lf" % (current_iteration, marginal_error))
+        bias_vector, _ = _ice_bias_vector(source, sink, weight, len(hic.regions),
+                                          tolerance=tolerance, max_iterations=max_iterations)
 
         if restore_coverage:
+            total_weight = _total_weight(source, sink, weight)
             bias_vector = bias_vector / np.sqrt(total_weight / len(hic.regions))
 
     with np.errstate(divide='ignore'):
@@ -831,6 +1146,200 @@ def ice_balancing(hic, tolerance=1e-2, max_iterations=500, whole_matrix=True,
     return bias_vector
 
 
+def _concatenate_edge_arrays(edge_arrays):
+    sources, sinks, weights = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+    for source, sink, weight in edge_arrays:
+        sources.append(source)
+        sinks.append(sink)
+        weights.append(weight)
+    return np.concatenate(sources), np.concatenate(sinks), np.concatenate(weights)
+
+
+def _total_weight(source, sink, weight):
+    return np.sum(weight) + np.sum(weight[source != sink])
+
+
+def _ice_bias_vector(source, sink, weight, n_regions, tolerance=1e-2, max_iterations=500,
+                     sqrt=True, n_valid=None):
+    """
+    Iteratively correct a matrix given as edge arrays.
+
+    :param source: Array of edge source indexes (0-based within matrix)
+    :param sink: Array of edge sink indexes (0-based within matrix)
+    :param weight: Array of uncorrected edge weights
+    :param n_regions: Number of matrix rows
+    :param tolerance: Error tolerance (marginal error)
+    :param max_iterations: Maximum number of iterations
+    :param sqrt: If False, use scaled marginals rather than their square root
+                 as correction factors
+    :param n_valid: Number of valid matrix rows, only used if sqrt is False
+    :return: (uninverted) bias vector, number of iterations
+    """
+    bias_vector = np.ones(n_regions, dtype=np.float64)
+    weight = np.array(weight, dtype=np.float64)
+    off_diagonal = source != sink
+    sink_off_diagonal = sink[off_diagonal]
+
+    marginal_error = tolerance + 1
+    current_iteration = 0
+    while (marginal_error > tolerance and
+           current_iteration < max_iterations):
+        m = np.bincount(source, weights=weight, minlength=n_regions) + \
+            np.bincount(sink_off_diagonal, weights=weight[off_diagonal], minlength=n_regions)
+        marginal_error = _marginal_error(m)
+
+        if sqrt:
+            m = np.sqrt(m)
+        else:
+            # multiply with constant factor so marginals are 1
+            bias_mean = np.mean(m[m != 0])
+            marginal_mean = np.sqrt(np.sum(m) / n_valid)
+            m = m * marginal_mean / bias_mean
+
+        bias_vector *= m
+
+        m_sink = m[sink]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = np.where(m_sink == 0, 0, weight / m[source] / m_sink)
+
+        current_iteration += 1
+        logger.debug("Iteration: %d, error: %lf" % (current_iteration, marginal_error))
+
+    return bias_vector, current_iteration
+
+
+def _ice_balancing_chromosome_worker(chromosome_edges):
+    source, sink, weight, n_regions, n_valid, tolerance, max_iterations, \
+        sqrt, restore_coverage = chromosome_edges
+
+    if len(source) == 0:
+        return np.ones(n_regions, dtype=np.float64)
+
+    bias_vector, n_iterations = _ice_bias_vector(source, sink, weight, n_regions,
+                                                 tolerance=tolerance, max_iterations=max_iterations,
+                                                 sqrt=sqrt, n_valid=n_valid)
+
+    if restore_coverage:
+        # coverage is restored once per iteration
+        total_weight = _total_weight(source, sink, weight)
+        bias_vector = bias_vector / np.sqrt(total_weight / n_valid) ** n_iterations
+
+    return bias_vector
+
+
+# approximate bytes per edge needed for the arrays of an out-of-core ICE chunk
+_ice_out_of_core_bytes_per_edge = 80
+
+
+def _ice_balancing_out_of_core(hic, tolerance=1e-2, max_iterations=500, whole_matrix=True,
+                               inter_chromosomal=True, intra_chromosomal=True,
+                               restore_coverage=False, sqrt=True,
+                               memory_budget=config.ice_memory_budget):
+    """
+    ICE balancing with edges streamed from disk in every iteration.
+
+    Rather than updating edge weights in place, the uncorrected weights are
+    divided by the current (uninverted) bias of source and sink on the fly.
+    In per-chromosome mode, all chromosomes are balanced in the same
+    passes over the data, each until it has individually converged.
+
+    See :func:`~ice_balancing` for parameters.
+    """
+    chunk_size = max(1, str_to_int(memory_budget) // _ice_out_of_core_bytes_per_edge)
+    logger.info("Out-of-core ICE with chunks of {} edges".format(chunk_size))
+
+    n_regions = len(hic.regions)
+    valid = hic.mappable()
+
+    if whole_matrix:
+        segments = [(0, n_regions)]
+    else:
+        cb = hic.chromosome_bins
+        segments = [cb[chromosome] for chromosome in hic.chromosomes()]
+        intra_chromosomal, inter_chromosomal = True, False
+
+    segment_ix = np.zeros(n_regions, dtype=np.int64)
+    chromosome_ix = np.zeros(n_regions, dtype=np.int64)
+    for i, (start, end) in enumerate(segments):
+        segment_ix[start:end] = i
+    for i, (start, end) in enumerate(hic.chromosome_bins.values()):
+        chromosome_ix[start:end] = i
+
+    def edge_chunks():
+        if hasattr(hic, '_edge_arrays_iter'):
+            chunks = hic._edge_arrays_iter(chunk_size=chunk_size)
+        else:
+            chunks = hic.edge_arrays(norm=False, check_valid=False, chunk_size=chunk_size)
+
+        for source, sink, weight in chunks:
+            keep = np.logical_and(valid[source], valid[sink])
+            if not intra_chromosomal:
+                keep &= chromosome_ix[source] != chromosome_ix[sink]
+            if not inter_chromosomal:
+                keep &= chromosome_ix[source] == chromosome_ix[sink]
+            yield source[keep], sink[keep], weight[keep]
+
+    bias_vector = np.ones(n_regions, dtype=np.float64)
+    active = np.ones(len(segments), dtype=bool)
+    n_iterations = np.zeros(len(segments), dtype=np.int64)
+    total_weights = None
+    while active.any():
+        m = np.zeros(n_regions, dtype=np.float64)
+        n_edges = np.zeros(len(segments), dtype=np.int64)
+        for source, sink, weight in edge_chunks():
+            b = bias_vector[source] * bias_vector[sink]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                weight = np.where(b == 0, 0, weight / b)
+            off_diagonal = source != sink
+            m += np.bincount(source, weights=weight, minlength=n_regions)
+            m += np.bincount(sink[off_diagonal], weights=weight[off_diagonal], minlength=n_regions)
+            if total_weights is None:
+                n_edges += np.bincount(segment_ix[source], minlength=len(segments))
+
+        if total_weights is None:
+            total_weights = np.array([np.sum(m[start:end]) for start, end in segments])
+            for i, (start, end) in enumerate(segments):
+                if n_edges[i] == 0:
+                    active[i] = False
+                    if not whole_matrix:
+                        warnings.warn("Chromosome {} has no valid edges, "
+                                      "skipping normalisation!".format(hic.chromosomes()[i]))
+
+        for i, (start, end) in enumerate(segments):
+            if not active[i]:
+                continue
+
+            m_segment = m[start:end]
+            marginal_error = _marginal_error(m_segment)
+
+            if sqrt or whole_matrix:
+                m_segment = np.sqrt(m_segment)
+            else:
+                # multiply with constant factor so marginals are 1
+                bias_mean = np.mean(m_segment[m_segment != 0])
+                marginal_mean = np.sqrt(np.sum(m_segment) / np.sum(valid[start:end]))
+                m_segment = m_segment * marginal_mean / bias_mean
+
+            bias_vector[start:end] *= m_segment
+            n_iterations[i] += 1
+            logger.debug("Segment {}, iteration: {}, error: {}".format(i, n_iterations[i], marginal_error))
+
+            if marginal_error <= tolerance or n_iterations[i] >= max_iterations:
+                active[i] = False
+
+    if restore_coverage:
+        if whole_matrix:
+            bias_vector = bias_vector / np.sqrt(total_weights[0] / n_regions)
+        else:
+            for i, (start, end) in enumerate(segments):
+                if n_iterations[i] > 0:
+                    # matches in-memory mode, where coverage is restored once per iteration
+                    n_valid = np.sum(valid[start:end])
+                    bias_vector[start:end] /= np.sqrt(total_weights[i] / n_valid) ** n_iterations[i]
+
+    return bias_vector
+
+
 def _marginal_error(marginals, percentile=99.9):
     marginals = marginals[marginals != 0]
     error = np.percentile(np.abs(marginals - marginals.mean()), percentile)
@@ -872,21 +1381,14 @@ def kr_balancing(hic, whole_matrix=True, intra_chromosomal=True, inter_chromosom
     if not whole_matrix:
         bias_vectors = []
         for chromosome in hic.chromosomes():
-            m = hic.matrix((chromosome, chromosome), norm=False)
+            m = hic.sparse_matrix((chromosome, chromosome), norm=False)
             m_corrected, bias_vector_chromosome = correct_matrix(m, restore_coverage=restore_coverage)
             bias_vectors.append(bias_vector_chromosome)
         bias_vector = np.concatenate(bias_vectors)
     else:
         logger.debug("Fetching whole genome matrix")
-        m = hic.matrix(norm=False)
-        cb = hic.chromosome_bins
-        if not intra_chromosomal:
-            for chromosome, bins in cb.items():
-                m[bins[0]:bins[1], bins[0]:bins[1]] = 0
-        if not inter_chromosomal:
-            for chromosome, bins in cb:
-                m[0:bins[0], bins[0]:bins[1]] = 0
-                m[bins[1]:, bins[0]:bins[1]] = 0
+        m = hic.sparse_matrix(norm=False, intra_chromosomal=intra_chromosomal,
+                              inter_chromosomal=inter_chromosomal)
 
         m_corrected, bias_vector = correct_matrix(m, restore_coverage=restore_coverage)
 
@@ -895,6 +1397,9 @@ def kr_balancing(hic, whole_matrix=True, intra_chromosomal=True, inter_chromosom
 
 
 def correct_matrix(m, max_attempts=50, restore_coverage=False):
+    if sp.issparse(m):
+        return _correct_sparse_matrix(m, max_attempts=max_attempts, restore_coverage=restore_coverage)
+
     # remove zero-sum rows
     removed_rows = []
     m_nonzero, ixs = remove_sparse_rows(m, cutoff=0)
@@ -936,6 +1441,80 @@ def correct_matrix(m, max_attempts=50, restore_coverage=False):
     return m_nonzero, x
 
 
+class _MaskedMatrix(object):
+    """
+    Square matrix with rows/columns hidden by a boolean mask.
+
+    Supports just enough of the matrix interface for :func:`~get_bias_vector`,
+    without copying the unmasked part of the underlying matrix.
+    """
+    def __init__(self, m, mask):
+        self.matrix = m
+        self.mask = mask
+
+    @property
+    def shape(self):
+        n = int(np.sum(self.mask))
+        return n, n
+
+    def dot(self, x):
+        y = np.zeros(self.matrix.shape[1], dtype=np.result_type(x, np.float64))
+        y[self.mask] = x
+        return self.matrix.dot(y)[self.mask]
+
+    def marginals(self):
+        return self.dot(np.ones(self.shape[0]))
+
+
+def _correct_sparse_matrix(m, max_attempts=50, restore_coverage=False):
+    """
+    Knight-Ruiz matrix balancing for :mod:`scipy.sparse` matrices.
+
+    Equivalent to :func:`~correct_matrix`, but rather than copying the
+    matrix every time sparse rows are removed, they are hidden using
+    a mask.
+    """
+    m = sp.csr_matrix(m, dtype=np.float64)
+
+    # remove zero-sum rows
+    mask = np.asarray(m.sum(axis=0)).ravel() > 0
+    m_masked = _MaskedMatrix(m, mask)
+
+    has_errors = True
+    iterations = 0
+    x = None
+    while has_errors:
+        has_errors = False
+
+        try:
+            x = get_bias_vector(m_masked)
+        except ValueError as e:
+            logger.debug("Matrix balancing failed (this can happen!), \
+                          removing sparsest rows to try again. Error: \
+                          %s" % str(e))
+            marginals = m_masked.marginals()
+            mask[mask] = marginals > np.min(marginals)
+            has_errors = True
+
+        iterations += 1
+        if iterations > max_attempts:
+            raise RuntimeError("Exceeded maximum attempts (%d)" % max_attempts)
+
+    logger.debug("Removed {} sparse rows.".format(np.sum(~mask)))
+
+    if restore_coverage:
+        x = x*np.sqrt(np.sum(m_masked.marginals())/m_masked.shape[0])
+
+    bias_vector = np.zeros(m.shape[0])
+    bias_vector[mask] = x
+
+    logger.debug("Applying bias vector")
+    m_corrected = sp.diags(bias_vector).dot(m).dot(sp.diags(bias_vector)).tocsr()
+    m_corrected.eliminate_zeros()
+
+    return m_corrected, bias_vector
+
+
 def get_bias_vector(A, x0=None, tol=1e-06, delta=0.1, Delta=3, fl=0, high_precision=False, outer_limit=300):
     logger.debug("Starting matrix balancing")
 
@@ -945,7 +1524,7 @@ def get_bias_vector(A, x0=None, tol=1e-06, delta=0.1, Delta=3, fl=0, high_precis
         try:
             # basic variables
             # n=size_(A,1)
-            if not isinstance(A, np.ndarray):
+            if not isinstance(A, (np.ndarray, _MaskedMatrix)) and not sp.issparse(A):
                 try:
                     if high_precision:
                         A = np.array(A, dtype=np.float128)
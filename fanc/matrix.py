@@ -5,13 +5,20 @@
 """
 
 import logging
+import multiprocessing as mp
 import os
+import shutil
+import tempfile
+import threading
 import warnings
 from bisect import bisect_right
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+from queue import Empty
 
 import intervaltree
 import numpy as np
+import scipy.sparse as sp
 import tables
 from future.utils import string_types
 
@@ -388,6 +395,48 @@ class RegionPairsContainer(RegionBased):
         raise NotImplementedError("Subclass must implement _edges_getitem "
                                   "to enable getting specific edges!")
 
+    @staticmethod
+    def _edge_tuple_chunks(edge_tuples, chunk_size=1000000):
+        """
+        Convert an iterator over (source, sink, weight) tuples to chunks of arrays.
+        """
+        sources, sinks, weights = [], [], []
+        for source, sink, weight in edge_tuples:
+            sources.append(source)
+            sinks.append(sink)
+            weights.append(weight)
+
+            if len(sources) >= chunk_size:
+                yield (np.array(sources, dtype=np.int64), np.array(sinks, dtype=np.int64),
+                       np.array(weights, dtype=np.float64))
+                sources, sinks, weights = [], [], []
+
+        if len(sources) > 0:
+            yield (np.array(sources, dtype=np.int64), np.array(sinks, dtype=np.int64),
+                   np.array(weights, dtype=np.float64))
+
+    def _edge_arrays_subset(self, row_regions, col_regions, score_field=None,
+                            chunk_size=1000000, *args, **kwargs):
+        """
+        Get raw (source, sink, weight) arrays for edges between row and col regions.
+
+        This default implementation converts the output of
+        :func:`~RegionPairsContainer._edges_subset`, subclasses should
+        override it with a columnar implementation for speed.
+        """
+        if score_field is None:
+            score_field = self._default_score_field if self._default_score_field is not None else 'weight'
+        default_value = self._default_value
+
+        key = (GenomicRegion(row_regions[0].chromosome, start=row_regions[0].start,
+                             end=row_regions[-1].end),
+               GenomicRegion(col_regions[0].chromosome, start=col_regions[0].start,
+                             end=col_regions[-1].end))
+        edge_tuples = ((edge.source, edge.sink, getattr(edge, score_field, default_value))
+                       for edge in self._edges_subset(key, row_regions, col_regions,
+                                                      lazy=True, *args, **kwargs))
+        return self._edge_tuple_chunks(edge_tuples, chunk_size=chunk_size)
+
     def _key_to_regions(self, key, *args, **kwargs):
         if isinstance(key, tuple):
             if len(key) == 2:
@@ -705,7 +754,7 @@ class RegionPairsContainer(RegionBased):
                 else:
                     expected_genome, expected_intra, expected_inter = None, None, None
 
-                valid = [getattr(r, 'valid', True) for r in self._regions_pairs.regions(lazy=True)]
+                valid = self._regions_pairs._region_valid()
 
                 # getting regions
                 row_regions, col_regions = self._regions_pairs._key_to_regions(key)
@@ -885,6 +934,18 @@ class RegionPairsContainer(RegionBased):
         return np.array([True if getattr(r, 'valid', True) else False
                          for r in self.regions(region, lazy=True)])
 
+    def _region_valid(self):
+        """
+        Get the 'valid' attribute of all regions.
+
+        Unlike :func:`~RegionPairsContainer.mappable`, this never
+        computes mappability from edges, so it can be used
+        while iterating over edges.
+
+        :return: boolean :class:`~np.array`, one entry per region
+        """
+        return np.array([getattr(r, 'valid', True) for r in self.regions(lazy=True)], dtype=bool)
+
 
 class RegionMatrixContainer(RegionPairsContainer, RegionBasedWithBins):
     """
@@ -937,6 +998,124 @@ class RegionMatrixContainer(RegionPairsContainer, RegionBasedWithBins):
         self._default_value = 0.0
         self._default_score_field = 'weight'
 
+    def edge_arrays(self, key=None, norm=True, oe=False, oe_per_chromosome=True,
+                    intra_chromosomal=True, inter_chromosomal=True, check_valid=True,
+                    score_field=None, chunk_size=1000000, *args, **kwargs):
+        """
+        Iterate over edges in chunks of :mod:`numpy` arrays.
+
+        This is the bulk equivalent of :func:`~RegionPairsContainer.edges`,
+        and accepts the same keys and options. Instead of individual
+        :class:`~Edge` objects, it returns (source, sink, weight) tuples of
+        arrays with at most :code:`chunk_size` entries each. Normalisation
+        and O/E transformation are applied to the weight arrays as a whole.
+
+        .. code ::
+
+            marginals = np.zeros(len(hic.regions))
+            for source, sink, weight in hic.edge_arrays(norm=False):
+                marginals += np.bincount(source, weights=weight, minlength=len(marginals))
+
+        :param key: Edge selector, see :func:`~RegionPairsContainer.edges`
+        :param norm: If False, return unnormalised weights
+        :param oe: If True, divide weights by their expected value
+        :param oe_per_chromosome: If True (default), use chromosome-specific
+                                  expected values for O/E
+        :param intra_chromosomal: If False, skip intra-chromosomal edges
+        :param inter_chromosomal: If False, skip inter-chromosomal edges
+        :param check_valid: If True (default), skip edges involving
+                            unmappable regions
+        :param score_field: Edge attribute used as weight. Defaults to the
+                            :code:`_default_score_field` of this object
+        :param chunk_size: Maximum number of edges per chunk
+        :param kwargs: Passed on to the underlying implementation,
+                       e.g. :code:`excluded_filters`
+        :return: iterator over (source, sink, weight) :class:`~numpy.ndarray` tuples
+        """
+        if score_field is None:
+            score_field = self._default_score_field
+
+        # like Edge.weight, only the weight field is normalised
+        if score_field != kwargs.get('weight_field', 'weight'):
+            norm, oe = False, False
+
+        if norm and hasattr(self, 'bias_vector'):
+            bias = np.array(self.bias_vector(), dtype=np.float64)
+        else:
+            bias = None
+
+        if oe:
+            if not hasattr(self, 'expected_values'):
+                raise ValueError("Cannot perform O/E transformation because this object does not "
+                                 "support the expected_values function!")
+            expected_genome, expected_intra, expected_inter = self.expected_values(norm=norm)
+        else:
+            expected_genome, expected_intra, expected_inter = None, None, None
+
+        if check_valid:
+            valid = self._region_valid()
+        else:
+            valid = None
+
+        row_regions, col_regions = self._key_to_regions(key)
+        if isinstance(row_regions, GenomicRegion):
+            row_regions = [row_regions]
+        if isinstance(col_regions, GenomicRegion):
+            col_regions = [col_regions]
+
+        row_regions_by_chromosome = defaultdict(list)
+        for r in row_regions:
+            row_regions_by_chromosome[r.chromosome].append(r)
+
+        col_regions_by_chromosome = defaultdict(list)
+        for r in col_regions:
+            col_regions_by_chromosome[r.chromosome].append(r)
+
+        chromosome_pairs = set()
+        for row_chromosome, row_chromosome_regions in row_regions_by_chromosome.items():
+            for col_chromosome, col_chromosome_regions in col_regions_by_chromosome.items():
+                if (col_chromosome, row_chromosome) in chromosome_pairs:
+                    continue
+                chromosome_pairs.add((row_chromosome, col_chromosome))
+
+                ex = None
+                if row_chromosome == col_chromosome:
+                    if not intra_chromosomal:
+                        continue
+                    if oe:
+                        ex = expected_intra[row_chromosome] if oe_per_chromosome else expected_genome
+                        if ex is not None:
+                            ex = np.array(ex, dtype=np.float64)
+                else:
+                    if not inter_chromosomal:
+                        continue
+                    if oe:
+                        ex = expected_inter
+
+                for source, sink, weight in self._edge_arrays_subset(row_chromosome_regions,
+                                                                     col_chromosome_regions,
+                                                                     score_field=score_field,
+                                                                     chunk_size=chunk_size,
+                                                                     *args, **kwargs):
+                    if valid is not None:
+                        is_valid = np.logical_and(valid[source], valid[sink])
+                        if not is_valid.all():
+                            source, sink, weight = source[is_valid], sink[is_valid], weight[is_valid]
+
+                    weight = weight.astype(np.float64)
+                    if bias is not None:
+                        weight *= bias[source] * bias[sink]
+
+                    if ex is not None:
+                        with np.errstate(divide='ignore', invalid='ignore'):
+                            if row_chromosome == col_chromosome:
+                                weight /= ex[np.abs(sink - source)]
+                            else:
+                                weight /= ex
+
+                    if len(source) > 0:
+                        yield source, sink, weight
+
     def regions_and_matrix_entries(self, key=None, score_field=None, *args, **kwargs):
         """
         Convenient access to non-zero matrix entries and associated regions.
@@ -1002,9 +1181,9 @@ class RegionMatrixContainer(RegionPairsContainer, RegionBasedWithBins):
                               that have no associated edge/contact
         :param mask: If False, do not mask unmappable regions
         :param args: Positional arguments passed to
-                     :func:`~fanc.matrix.RegionMatrixContainer.regions_and_matrix_entries`
+                     :func:`~fanc.matrix.RegionMatrixContainer.edge_arrays`
         :param kwargs: Keyword arguments passed to
-                       :func:`~fanc.matrix.RegionMatrixContainer.regions_and_matrix_entries`
+                       :func:`~fanc.matrix.RegionMatrixContainer.edge_arrays`
         :return: :class:`~fanc.matrix.RegionMatrix`
         """
 
@@ -1014,21 +1193,15 @@ class RegionMatrixContainer(RegionPairsContainer, RegionBasedWithBins):
         if kwargs.get('oe', False):
             default_value = 1.0
 
-        kwargs['lazy'] = True
-        row_regions, col_regions, matrix_entries = self.regions_and_matrix_entries(key,
-                                                                                   *args,
-                                                                                   **kwargs)
+        row_regions, col_regions, entries = self._regions_and_matrix_entry_arrays(key, *args, **kwargs)
 
         m = np.full((len(row_regions), len(col_regions)), default_value)
-
-        for source, sink, weight in matrix_entries:
-            ir = source
-            jr = sink
-            if 0 <= ir < m.shape[0] and 0 <= jr < m.shape[1]:
-                m[ir, jr] = weight
+        for i, j, weight in entries:
+            m[i, j] = weight
 
         if log:
-            m = np.log(m) / np.log(log_base)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                m = np.log(m) / np.log(log_base)
             m[~np.isfinite(m)] = default_value
 
         if isinstance(key, tuple) and len(key) == 2:
@@ -1041,6 +1214,100 @@ class RegionMatrixContainer(RegionPairsContainer, RegionBasedWithBins):
 
         return RegionMatrix(m, row_regions=row_regions, col_regions=col_regions, mask=mask)
 
+    def _regions_and_matrix_entry_arrays(self, key=None, *args, **kwargs):
+        """
+        Array equivalent of :func:`~RegionMatrixContainer.regions_and_matrix_entries`.
+
+        :return: list of row regions, list of col regions,
+                 iterator over (i, j, weight) :class:`~numpy.ndarray` tuples
+        """
+        # edge_arrays always works on raw table rows
+        kwargs.pop('lazy', None)
+
+        row_regions, col_regions = self._key_to_regions(key)
+        if isinstance(row_regions, GenomicRegion):
+            row_regions = [row_regions]
+        else:
+            row_regions = list(row_regions)
+
+        if isinstance(col_regions, GenomicRegion):
+            col_regions = [col_regions]
+        else:
+            col_regions = list(col_regions)
+
+        if len(row_regions) == 0 or len(col_regions) == 0:
+            return row_regions, col_regions, []
+
+        row_offset = row_regions[0].ix
+        col_offset = col_regions[0].ix
+        n_rows, n_cols = len(row_regions), len(col_regions)
+
+        def entry_iter():
+            for source, sink, weight in self.edge_arrays((row_regions, col_regions), *args, **kwargs):
+                i, j = source - row_offset, sink - col_offset
+                upper = (i >= 0) & (i < n_rows) & (j >= 0) & (j < n_cols)
+
+                # mirror the symmetric half
+                k, l = sink - row_offset, source - col_offset
+                lower = (source != sink) & (k >= 0) & (k < n_rows) & (l >= 0) & (l < n_cols)
+
+                yield (np.concatenate([i[upper], k[lower]]),
+                       np.concatenate([j[upper], l[lower]]),
+                       np.concatenate([weight[upper], weight[lower]]))
+
+        return row_regions, col_regions, entry_iter()
+
+    def sparse_matrix(self, key=None, format='csr', *args, **kwargs):
+        """
+        Assemble a :mod:`scipy.sparse` matrix from region pairs.
+
+        This is the sparse equivalent of :func:`~RegionMatrixContainer.matrix`
+        and accepts the same keys and options. It is useful for large
+        matrices that would not fit into memory in dense form.
+        Like in :class:`~RegionMatrix`, the regions associated with each
+        matrix dimension are available via the :code:`row_regions` and
+        :code:`col_regions` attributes. Note that these are not
+        propagated to matrices derived from the returned object.
+
+        .. code ::
+
+            m = hic.sparse_matrix(('chr18', 'chr18'), norm=False)
+            type(m)  # scipy.sparse.csr_matrix
+            m.row_regions[0]  # chr18:1-1000000
+
+        Matrix entries without associated edge/contact are implicit
+        zeros, also when using :code:`oe=True`. Edges involving
+        unmappable regions are omitted.
+
+        :param key: Matrix selector. See :func:`~fanc.matrix.RegionPairsContainer.edges`
+                    for all supported key types
+        :param format: Sparse matrix format, "csr" (default) or "coo"
+        :param args: Positional arguments passed to
+                     :func:`~fanc.matrix.RegionMatrixContainer.edge_arrays`
+        :param kwargs: Keyword arguments passed to
+                       :func:`~fanc.matrix.RegionMatrixContainer.edge_arrays`
+        :return: :class:`~scipy.sparse.csr_matrix` or :class:`~scipy.sparse.coo_matrix`
+        """
+        if format not in ('csr', 'coo'):
+            raise ValueError("Sparse matrix format must be 'csr' or 'coo', not '{}'".format(format))
+
+        row_regions, col_regions, entries = self._regions_and_matrix_entry_arrays(key, *args, **kwargs)
+
+        rows, cols, data = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+        for i, j, weight in entries:
+            rows.append(i)
+            cols.append(j)
+            data.append(weight)
+
+        m = sp.coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                          shape=(len(row_regions), len(col_regions)))
+        if format == 'csr':
+            m = m.tocsr()
+
+        m.row_regions = row_regions
+        m.col_regions = col_regions
+        return m
+
     def __getitem__(self, item):
         return self.matrix(item)
 
@@ -1062,10 +1329,8 @@ class RegionMatrixContainer(RegionPairsContainer, RegionBasedWithBins):
                  possible inter-chromosomal pairs
         """
         logger.debug("Calculating possible counts")
-
-        logger.debug("Setup for possible counts")
         chromosomes = self.chromosomes()
-        mappability = self.mappable()
+        mappability = np.array(self.mappable(), dtype=bool)
         cb = self.chromosome_bins
 
         max_distance = 0
@@ -1074,40 +1339,45 @@ class RegionMatrixContainer(RegionPairsContainer, RegionBasedWithBins):
         for chromosome in chromosomes:
             logger.debug("Possible counts for {}".format(chromosome))
             chromosome_start_bin, chromosome_end_bin = cb[chromosome]
-            mappable_chromosome = np.array(mappability[chromosome_start_bin:chromosome_end_bin])
+            mappable_chromosome = mappability[chromosome_start_bin:chromosome_end_bin]
             max_distance = max(max_distance, chromosome_end_bin - chromosome_start_bin)
 
-            possible_by_distance = np.zeros(chromosome_end_bin - chromosome_start_bin)
-            sub = np.ones(chromosome_end_bin - chromosome_start_bin)
-            d = len(mappable_chromosome)
-            for i, mappable in enumerate(mappable_chromosome):
-                if mappable:
-                    possible_by_distance[:(d - i)] += np.ones(d - i)
-                else:
-                    # subtract vertical
-                    sub[i] = 0
-                    possible_by_distance[:(i+1)] -= sub[:(i+1)][::-1]
-
-            chromosome_intra_total[chromosome] = possible_by_distance
+            chromosome_intra_total[chromosome] = self._possible_pairs_by_distance(mappable_chromosome)
             chromosome_mappable_counts[chromosome] = np.sum(mappable_chromosome)
 
-        possible_by_distance_whole_matrix = defaultdict(int)
+        intra_total = np.zeros(max_distance)
         for possible_by_distance in chromosome_intra_total.values():
-            for distance, count in enumerate(possible_by_distance):
-                possible_by_distance_whole_matrix[distance] += count
-
-        intra_total = [possible_by_distance_whole_matrix[i]
-                       for i in range(max_distance)]
+            intra_total[:len(possible_by_distance)] += possible_by_distance
 
-        inter_total = 0
-        for i in range(len(chromosomes)):
-            chromosome1 = chromosomes[i]
-            for j in range(i + 1, len(chromosomes)):
-                chromosome2 = chromosomes[j]
-                inter_total += chromosome_mappable_counts[chromosome1] * chromosome_mappable_counts[chromosome2]
+        mappable_counts = np.array([chromosome_mappable_counts[c] for c in chromosomes], dtype=np.float64)
+        inter_total = (np.sum(mappable_counts) ** 2 - np.sum(mappable_counts ** 2)) / 2
 
         return intra_total, chromosome_intra_total, inter_total
 
+    @staticmethod
+    def _possible_pairs_by_distance(mappable):
+        """
+        Count pairs of mappable bins for every separation distance.
+
+        Without unmappable bins, the number of pairs separated by d bins
+        is simply n - d. Otherwise, this is the autocorrelation of the
+        mappability mask, which is computed via FFT.
+
+        :param mappable: boolean array with mappability of consecutive bins
+        :return: float array, index corresponds to distance in bins
+        """
+        n = len(mappable)
+        n_mappable = np.sum(mappable)
+        if n_mappable == n:
+            return np.arange(n, 0, -1, dtype=np.float64)
+        if n_mappable == 0:
+            return np.zeros(n)
+
+        fft_size = 1 << int(2 * n - 1).bit_length()
+        f = np.fft.rfft(np.asarray(mappable, dtype=np.float64), fft_size)
+        autocorrelation = np.fft.irfft(f * np.conj(f), fft_size)[:n]
+        return np.round(autocorrelation)
+
     def expected_values_and_marginals(self, selected_chromosome=None, norm=True,
                                       *args, **kwargs):
         """
@@ -1138,79 +1408,68 @@ class RegionMatrixContainer(RegionPairsContainer, RegionBasedWithBins):
         """
         weight_field = getattr(self, '_default_score_field', None)
         default_value = getattr(self, '_default_value', 1.)
+        n_regions = len(self.regions)
 
         # get all the bins of the different chromosomes
         chromosome_bins = self.chromosome_bins
-        chromosome_dict = defaultdict(list)
+        chromosomes = list(chromosome_bins.keys())
+        bin_chromosome_ix = np.zeros(n_regions, dtype=np.int64)
 
-        chromosome_max_distance = defaultdict(int)
+        chromosome_max_distance = dict()
         max_distance = 0
-        for chromosome, (start, stop) in chromosome_bins.items():
+        for i, chromosome in enumerate(chromosomes):
+            start, stop = chromosome_bins[chromosome]
+            bin_chromosome_ix[start:stop] = i
             max_distance = max(max_distance, stop - start)
-            chromosome_max_distance[chromosome] = max(chromosome_max_distance[chromosome], stop - start)
-
-            for i in range(start, stop):
-                chromosome_dict[i] = chromosome
-
-        chromosome_intra_sums = dict()
-        chromosome_intra_expected = dict()
-        for chromosome, d in chromosome_max_distance.items():
-            chromosome_intra_sums[chromosome] = [0.0] * d
-            chromosome_intra_expected[chromosome] = [0.0] * d
+            chromosome_max_distance[chromosome] = stop - start
 
         # get the sums of edges at any given distance
-        marginals = [0.0] * len(self.regions)
-        valid = [False] * len(self.regions)
+        marginals = np.zeros(n_regions)
+        valid = np.zeros(n_regions, dtype=bool)
         inter_sums = 0.0
-        intra_sums = [0.0] * max_distance
+        intra_sums = np.zeros(max_distance)
+        chromosome_intra_sums = np.zeros(len(chromosomes) * max_distance)
         with RareUpdateProgressBar(max_value=len(self.edges), prefix='Expected') as pb:
-            for i, edge in enumerate(self.edges(lazy=True, norm=norm, check_valid=False)):
-                source, sink = edge.source, edge.sink
-                try:
-                    weight = getattr(edge, weight_field)
-                except AttributeError:
-                    weight = default_value
-
-                source_chromosome = chromosome_dict[source]
-                sink_chromosome = chromosome_dict[sink]
-
-                marginals[source] += weight
-                marginals[sink] += weight
-                if weight != self._default_value:
-                    valid[source] = True
-                    valid[sink] = True
-
-                if sink_chromosome != source_chromosome:
-                    inter_sums += weight
-                else:
-                    distance = sink - source
-                    intra_sums[distance] += weight
-                    chromosome_intra_sums[source_chromosome][distance] += weight
+            i = 0
+            for source, sink, weight in self.edge_arrays(norm=norm, check_valid=False,
+                                                         score_field=weight_field):
+                marginals += np.bincount(source, weights=weight, minlength=n_regions)
+                marginals += np.bincount(sink, weights=weight, minlength=n_regions)
+
+                has_weight = weight != default_value
+                valid[source[has_weight]] = True
+                valid[sink[has_weight]] = True
+
+                source_chromosome_ix = bin_chromosome_ix[source]
+                is_intra = source_chromosome_ix == bin_chromosome_ix[sink]
+                inter_sums += np.sum(weight[~is_intra])
+
+                distance = sink[is_intra] - source[is_intra]
+                intra_weight = weight[is_intra]
+                intra_sums += np.bincount(distance, weights=intra_weight, minlength=max_distance)
+                chromosome_intra_sums += np.bincount(source_chromosome_ix[is_intra] * max_distance + distance,
+                                                     weights=intra_weight,
+                                                     minlength=len(chromosome_intra_sums))
+                i += len(source)
                 pb.update(i)
+        chromosome_intra_sums = chromosome_intra_sums.reshape((len(chromosomes), max_distance))
 
         intra_total, chromosome_intra_total, inter_total = self.possible_contacts()
 
         # expected values
         inter_expected = 0 if inter_total == 0 else inter_sums / inter_total
 
-        intra_expected = [0.0] * max_distance
-        bin_size = self.bin_size
-        distances = []
-        for d in range(max_distance):
-            distances.append(bin_size * d)
-
-            # whole genome
-            count = intra_total[d]
-            if count > 0:
-                intra_expected[d] = intra_sums[d] / count
-
-        # chromosomes
-        for chromosome in chromosome_intra_expected:
-            for d in range(chromosome_max_distance[chromosome]):
-                chromosome_count = chromosome_intra_total[chromosome][d]
-                if chromosome_count > 0:
-                    chromosome_intra_expected[chromosome][d] = chromosome_intra_sums[chromosome][
-                                                                   d] / chromosome_count
+        intra_expected = np.zeros(max_distance)
+        np.divide(intra_sums, intra_total, out=intra_expected, where=intra_total > 0)
+
+        chromosome_intra_expected = dict()
+        for i, chromosome in enumerate(chromosomes):
+            d = chromosome_max_distance[chromosome]
+            chromosome_count = chromosome_intra_total[chromosome]
+            chromosome_expected = np.zeros(d)
+            np.divide(chromosome_intra_sums[i, :d], chromosome_count, out=chromosome_expected,
+                      where=chromosome_count > 0)
+            chromosome_intra_expected[chromosome] = chromosome_expected
 
         if selected_chromosome is not None:
             return chromosome_intra_expected[selected_chromosome], marginals, valid
@@ -1246,6 +1505,8 @@ class RegionMatrixContainer(RegionPairsContainer, RegionBasedWithBins):
         """
         result = self.expected_values_and_marginals(selected_chromosome=selected_chromosome,
                                                     norm=norm, *args, **kwargs)
+        if selected_chromosome is not None:
+            return result[0]
         return result[:-2]
 
     def marginals(self, masked=True, *args, **kwargs):
@@ -1265,24 +1526,28 @@ class RegionMatrixContainer(RegionPairsContainer, RegionBasedWithBins):
                        corresponding to unmappable regions
         :param kwargs: Keyword arguments passed to :func:`~RegionPairsContainer.edges`
         """
-        kwargs.setdefault('lazy', True)
-        row_regions, col_regions, edges_iter = self.regions_and_matrix_entries(*args, **kwargs)
+        kwargs.pop('lazy', None)
+        key = args[0] if len(args) > 0 else kwargs.pop('key', None)
+        row_regions, col_regions = self._key_to_regions(key)
+        row_regions = [row_regions] if isinstance(row_regions, GenomicRegion) else list(row_regions)
+        col_regions = [col_regions] if isinstance(col_regions, GenomicRegion) else list(col_regions)
+
         min_ix = min(row_regions[0].ix, col_regions[0].ix)
         max_ix = max(row_regions[-1].ix, col_regions[-1].ix)
 
         marginals = np.zeros(max_ix - min_ix + 1)
 
         logger.debug("Calculating marginals...")
-        for i, (source, sink, weight) in enumerate(edges_iter):
-            if source <= sink:
-                marginals[source] += weight
-            if source < sink:
-                marginals[sink] += weight
+        for source, sink, weight in self.edge_arrays((row_regions, col_regions), **kwargs):
+            marginals += np.bincount(source - min_ix, weights=weight, minlength=len(marginals))
+            off_diagonal = source != sink
+            marginals += np.bincount(sink[off_diagonal] - min_ix, weights=weight[off_diagonal],
+                                     minlength=len(marginals))
 
         if masked:
             mask = np.zeros(len(marginals), dtype=bool)
             for r in row_regions + col_regions:
-                mask[r.ix - min_ix] = not r.valid
+                mask[r.ix - min_ix] = not getattr(r, 'valid', True)
             marginals = np.ma.masked_where(mask, marginals)
 
         return marginals
@@ -1304,14 +1569,12 @@ class RegionMatrixContainer(RegionPairsContainer, RegionBasedWithBins):
 
         logger.info("Calculating scaling factor...")
         m1_sum = 0
-        for v1 in self.edge_data(weight_column, lazy=True):
-            if np.isfinite(v1):
-                m1_sum += v1
+        for _, _, v1 in self.edge_arrays(score_field=weight_column):
+            m1_sum += np.sum(v1[np.isfinite(v1)])
 
         m2_sum = 0
-        for v2 in matrix.edge_data(weight_column, lazy=True):
-            if np.isfinite(v2):
-                m2_sum += v2
+        for _, _, v2 in matrix.edge_arrays(score_field=weight_column):
+            m2_sum += np.sum(v2[np.isfinite(v2)])
 
         scaling_factor = m1_sum / m2_sum
         logger.debug("Scaling factor: {}/{} = {}".format(m1_sum, m2_sum, scaling_factor))
@@ -1518,6 +1781,293 @@ class TableBuffer(object):
         if weight is not None:
             row[self._weight_field] = weight
 
+    def add_array(self, edges):
+        """
+        Add a block of edges stored in a numpy structured array.
+
+        Fields are matched to edge table columns by name, fields without
+        a matching column are ignored and missing columns are set to their
+        default values. Source must not be larger than sink in any edge.
+
+        :param edges: numpy structured array with at least 'source'
+                      and 'sink' fields
+        """
+        if len(edges) == 0:
+            return
+
+        if not self._is_initialised:
+            self.initialise_buffers()
+
+        partition_breaks = np.array(self._matrix._partition_breaks, dtype=np.int64)
+        source_partitions = np.searchsorted(partition_breaks, edges['source'], side='right')
+        sink_partitions = np.searchsorted(partition_breaks, edges['sink'], side='right')
+        partition_keys = source_partitions * (len(partition_breaks) + 1) + sink_partitions
+
+        order = np.argsort(partition_keys, kind='stable')
+        partition_keys = partition_keys[order]
+        boundaries = np.r_[0, np.where(np.diff(partition_keys) != 0)[0] + 1, len(order)]
+        fields = [name for name in edges.dtype.names if name in self._colindices]
+
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            partition = (int(source_partitions[order[start]]), int(sink_partitions[order[start]]))
+            partition_edges = edges[order[start:end]]
+
+            offset = 0
+            while offset < len(partition_edges):
+                # reserve first row to obtain a buffer with free space
+                self._current_buffer_row(partition)
+                ix = self._counter[partition] - 1
+                buffer_table = self._buffer[partition]
+                n = min(len(partition_edges) - offset, buffer_table.shape[0] - ix)
+                for name in fields:
+                    buffer_table[name][ix:ix + n] = partition_edges[name][offset:offset + n]
+                self._counter[partition] = ix + n
+                offset += n
+
+
+def _filter_edge_table_worker(file_name, load_kwargs, mask_filters, input_queue, output_queue):
+    """
+    Compute the mask columns of edge tables in a worker process.
+
+    Every worker receives the filters and opens the file only once.
+    Partition tuples are read from the input queue until None is
+    received.
+
+    :param file_name: Path to the file with the edge tables
+    :param load_kwargs: Additional keyword arguments for :func:`~fanc.load`
+                        that open the filtered object from the file
+    :param mask_filters: list of :class:`~fanc.general.MaskFilter`
+    :param input_queue: queue with partition tuples
+    :param output_queue: queue receiving (partition, mask array) tuples,
+                         or an exception if filtering failed
+    """
+    pairs = None
+    try:
+        pairs = load(file_name, mode='r', **load_kwargs)
+        for mask_filter in mask_filters:
+            pairs._prepare_filter(mask_filter)
+
+        while True:
+            partition = input_queue.get()
+            if partition is None:
+                break
+            edge_table = pairs._edge_table(*partition, create_if_missing=False)
+            output_queue.put((partition, edge_table._filter_masks(mask_filters)))
+    except Exception as e:
+        output_queue.put(e)
+    finally:
+        if pairs is not None:
+            pairs.close()
+
+
+def _pack_edge_keys(source, sink):
+    """
+    Pack source and sink region indexes into a single 64-bit key.
+
+    Sorting keys sorts edges by source, then sink.
+    """
+    return (np.asarray(source, dtype=np.int64) << 32) | np.asarray(sink, dtype=np.int64)
+
+
+def _unpack_edge_keys(keys):
+    """
+    Reverse of :func:`~_pack_edge_keys`.
+
+    :return: tuple (source array, sink array)
+    """
+    return keys >> 32, keys & 0xffffffff
+
+
+def _sum_duplicate_keys(keys, weights):
+    """
+    Sort keys and sum the weights of identical keys.
+
+    :return: tuple (sorted unique keys, summed weights)
+    """
+    order = np.argsort(keys)
+    keys, weights = keys[order], weights[order]
+
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    first_ixs = np.where(first)[0]
+    return keys[first_ixs], np.add.reduceat(weights, first_ixs)
+
+
+def _merge_sorted_runs(runs):
+    """
+    K-way merge of sorted runs of arrays.
+
+    Every run is an iterator over tuples (keys, ...) of arrays, sorted by
+    their int64 keys within and across the chunks of the run. Only the
+    current chunk of each run is held in memory: in every step, all
+    entries up to the smallest last key of the current chunks are
+    merged and returned, so identical keys never span two steps.
+
+    :param runs: list of iterators over tuples of arrays, keys first
+    :return: iterator over tuples of arrays, sorted by keys
+    """
+    buffers = []
+    for run in runs:
+        for chunk in run:
+            if len(chunk[0]) > 0:
+                buffers.append((run, chunk))
+                break
+
+    while len(buffers) > 0:
+        threshold = min(chunk[0][-1] for _, chunk in buffers)
+
+        parts = []
+        remaining = []
+        for run, chunk in buffers:
+            n = np.searchsorted(chunk[0], threshold, side='right')
+            parts.append(tuple(a[:n] for a in chunk))
+            if n < len(chunk[0]):
+                remaining.append((run, tuple(a[n:] for a in chunk)))
+                continue
+
+            for chunk in run:
+                if len(chunk[0]) > 0:
+                    remaining.append((run, chunk))
+                    break
+        buffers = remaining
+
+        merged = tuple(np.concatenate(arrays) for arrays in zip(*parts))
+        order = np.argsort(merged[0], kind='mergesort')
+        yield tuple(a[order] for a in merged)
+
+
+def _array_chunks(arrays, chunk_size):
+    """
+    Iterate over consecutive slices of a tuple of equally long arrays.
+    """
+    for start in range(0, len(arrays[0]), chunk_size):
+        yield tuple(np.asarray(a[start:start + chunk_size]) for a in arrays)
+
+
+def _sum_sorted_runs(runs):
+    """
+    Merge sorted runs of (keys, weights) arrays and sum the weights of identical keys.
+
+    :param runs: list of iterators over (keys, weights) tuples, see
+                 :func:`~_merge_sorted_runs`
+    :return: iterator over (sorted unique keys, summed weights) tuples
+    """
+    for keys, weights in _merge_sorted_runs(runs):
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        first_ixs = np.where(first)[0]
+        yield keys[first_ixs], np.add.reduceat(weights, first_ixs)
+
+
+def _save_sorted_run(run_dir, keys, weights):
+    """
+    Save a sorted run of (keys, weights) arrays to a temporary file.
+
+    :return: path to the run file
+    """
+    run = np.empty(len(keys), dtype=[('key', np.int64), ('weight', np.float64)])
+    run['key'] = keys
+    run['weight'] = weights
+    run_file = tempfile.NamedTemporaryFile(dir=run_dir, suffix='.npy', delete=False).name
+    np.save(run_file, run)
+    return run_file
+
+
+def _load_sorted_runs(run_files, chunk_size=1000000):
+    """
+    Open runs saved with :func:`~_save_sorted_run` for :func:`~_merge_sorted_runs`.
+
+    Runs are memory-mapped and read in chunks, so that all runs together
+    hold at most about chunk_size entries in memory.
+
+    :return: list of iterators over (keys, weights) tuples
+    """
+    run_chunk_size = max(1, chunk_size // max(1, len(run_files)))
+    runs = []
+    for run_file in run_files:
+        run = np.load(run_file, mmap_mode='r')
+        runs.append(_array_chunks((run['key'], run['weight']), run_chunk_size))
+    return runs
+
+
+def _balanced_partition_breaks(region_weights, n_partitions):
+    """
+    Split regions into contiguous partitions of similar total weight.
+
+    :param region_weights: array with a weight (e.g. estimated number of
+                           edges) for each region
+    :param n_partitions: Number of partitions. Fewer partitions are returned
+                         if single regions exceed the weight of a partition
+    :return: list of partition breaks (index of the first region of every
+             partition but the first)
+    """
+    region_weights = np.asarray(region_weights, dtype=np.float64)
+    n_regions = len(region_weights)
+    if n_partitions <= 1 or n_regions <= 1:
+        return []
+
+    cumulative_weights = np.cumsum(region_weights)
+    if cumulative_weights[-1] <= 0:
+        cumulative_weights = np.arange(1, n_regions + 1, dtype=np.float64)
+
+    # break before or after the region that reaches each target,
+    # whichever gets the cumulative weight closer to it
+    targets = cumulative_weights[-1] * np.arange(1, n_partitions) / n_partitions
+    ixs = np.minimum(np.searchsorted(cumulative_weights, targets, side='left'), n_regions - 1)
+    upper = cumulative_weights[ixs]
+    lower = np.where(ixs > 0, cumulative_weights[ixs - 1], 0)
+    breaks = np.unique(np.where(upper - targets < targets - lower, ixs + 1, ixs))
+    return [int(b) for b in breaks if 0 < b < n_regions]
+
+
+def _merge_edge_tables(matrices, partition, score_field, chunk_size=1000000, lock=None,
+                       tmpdir=None):
+    """
+    Sum the edges of the same edge table in several matrices.
+
+    Every table is read in chunks, which are sorted and saved to temporary
+    files as sorted runs. The runs are then combined in a k-way merge, so
+    that memory use is bounded by chunk_size rather than the size of the
+    merged table. File access is guarded by lock, so that several
+    partitions can be merged in parallel threads.
+
+    :param matrices: list of :class:`~RegionPairsTable`
+    :param partition: tuple (source partition, sink partition)
+    :param score_field: Name of the weight column
+    :param chunk_size: Maximum number of rows read or merged at once
+    :param lock: :class:`~threading.Lock` for file access
+    :param tmpdir: Directory for the sorted runs. Defaults to the system
+                   temporary directory
+    :return: iterator over (sorted unique packed edge keys, summed weights) tuples
+    """
+    if lock is None:
+        lock = threading.Lock()
+
+    run_dir = tempfile.mkdtemp(prefix='fanc_merge_', dir=tmpdir)
+    try:
+        run_files = []
+        for matrix in matrices:
+            with lock:
+                if not matrix._has_edge_table(*partition):
+                    continue
+                edge_table = matrix._edge_table(*partition, create_if_missing=False)
+                chunks = matrix._edge_table_arrays(edge_table, score_field=score_field,
+                                                   chunk_size=chunk_size)
+
+            while True:
+                with lock:
+                    arrays = next(chunks, None)
+                if arrays is None:
+                    break
+                source, sink, weight = arrays
+                keys, weights = _sum_duplicate_keys(_pack_edge_keys(source, sink), weight)
+                run_files.append(_save_sorted_run(run_dir, keys, weights))
+
+        for keys, weights in _sum_sorted_runs(_load_sorted_runs(run_files, chunk_size=chunk_size)):
+            yield keys, weights
+    finally:
+        shutil.rmtree(run_dir)
+
 
 class RegionPairsTable(RegionPairsContainer, Maskable, RegionsTable):
     """
@@ -1530,7 +2080,9 @@ class RegionPairsTable(RegionPairsContainer, Maskable, RegionsTable):
                  additional_region_fields=None, additional_edge_fields=None,
                  partition_strategy='auto',
                  _table_name_regions='regions', _table_name_edges='edges',
-                 _edge_buffer_size=config.edge_buffer_size, _edge_table_prefix='chrpair_'):
+                 _edge_buffer_size=config.edge_buffer_size, _edge_table_prefix='chrpair_',
+                 _table_name_masks='mask', _meta_group='meta_information',
+                 clustered=False):
         """
         Initialize a :class:`~RegionPairsTable` object.
 
@@ -1538,8 +2090,23 @@ class RegionPairsTable(RegionPairsContainer, Maskable, RegionsTable):
         :param mode: File mode to open underlying file
         :param additional_region_fields: Additional fields (in PyTables notation) associated with
                                          edge data, e.g. {'weight': tables.Float32Col()}
+        :param partition_strategy: How edge tables are partitioned by region index. One of
+                                   'auto' (about 100 partitions of equal region count),
+                                   'chromosome', 'density', an integer partition size
+                                   in regions, or a list of partition breaks. 'density'
+                                   creates as many partitions as 'auto', but balances
+                                   them by the estimated number of edges per region
+                                   (see :func:`~RegionPairsTable._set_partition_density`),
+                                   so that small chromosomes share partitions
+        :param clustered: If True, edge tables of a new object are sorted by source
+                          and sink on flush, and an index of the first row of each
+                          source region is stored alongside each table. Range queries
+                          then read contiguous blocks of rows. Existing objects keep
+                          the layout they were created with.
         :param _table_name_regions: (Internal) name of the HDF5 node for regions
         :param _table_name_edges: (Internal) name of the HDF5 node for edges
+        :param _table_name_masks: (Internal) name of the HDF5 node for mask descriptions
+        :param _meta_group: (Internal) name of the HDF5 node for meta information
         :param _edge_buffer_size: (Internal) size of edge / contact buffer
         """
 
@@ -1547,10 +2114,16 @@ class RegionPairsTable(RegionPairsContainer, Maskable, RegionsTable):
         self._edges_dirty = False
         self._mappability_dirty = False
         self._partition_strategy = partition_strategy
+        self._partition_density = None
         self._edge_table_prefix = _edge_table_prefix
+        # keyword arguments for fanc.load that reopen this object
+        # from its file, e.g. in worker processes
+        self._load_kwargs = dict()
 
         file_exists = False
-        if file_name is not None:
+        if isinstance(file_name, tables.file.File):
+            file_exists = '/' + _table_name_edges in file_name
+        elif file_name is not None:
             file_name = os.path.expanduser(file_name)
             if os.path.exists(file_name):
                 file_exists = True
@@ -1563,18 +2136,23 @@ class RegionPairsTable(RegionPairsContainer, Maskable, RegionsTable):
         additional_region_fields['valid'] = tables.BoolCol(dflt=True)
 
         RegionsTable.__init__(self, file_name=file_name, _table_name_regions=_table_name_regions,
-                              mode=mode, tmpdir=tmpdir, additional_fields=additional_region_fields)
-        Maskable.__init__(self, self.file)
+                              mode=mode, tmpdir=tmpdir, additional_fields=additional_region_fields,
+                              _meta_group=_meta_group)
+        Maskable.__init__(self, self.file, table_name=_table_name_masks)
 
         if file_exists and mode != 'w':
             # retrieve edge tables and partitions
             self._edges = self.file.get_node('/', _table_name_edges)
             self._partition_breaks = getattr(self.meta, 'partition_breaks', None)
             self._partition_strategy = getattr(self.meta, 'partition_strategy', 'chromosome')
+            self._clustered = bool(getattr(self.meta, 'clustered', False))
             if self._partition_breaks is None:
                 self._update_partitions()
         else:
             self._edges = self.file.create_group('/', _table_name_edges)
+            self._clustered = clustered
+            if clustered:
+                self.meta['clustered'] = True
 
             basic_fields = {
                 'source': tables.Int32Col(pos=0),
@@ -1674,6 +2252,10 @@ class RegionPairsTable(RegionPairsContainer, Maskable, RegionsTable):
             logger.debug("Flushing edge buffer")
             self._edge_buffer.flush()
 
+            if self._clustered:
+                logger.debug("Sorting edge tables")
+                self._cluster_edge_tables()
+
             logger.debug("Flushing all edge tables and updating index")
             for _, edge_table in self._iter_edge_tables():
                 edge_table.flush(update_index=True, log_progress=False)
@@ -1716,6 +2298,177 @@ class RegionPairsTable(RegionPairsContainer, Maskable, RegionsTable):
             edge_table.enable_mask_index()
             edge_table.flush()
 
+    def _partition_region_range(self, partition_ix):
+        """
+        First and last (exclusive) region index of a partition.
+        """
+        start = 0 if partition_ix == 0 else self._partition_breaks[partition_ix - 1]
+        if partition_ix < len(self._partition_breaks):
+            end = self._partition_breaks[partition_ix]
+        else:
+            end = len(self.regions)
+        return start, end
+
+    def _edge_table_index_name(self, source_partition, sink_partition):
+        return self._edge_table_prefix + str(source_partition) + '_' + str(sink_partition) + '_index'
+
+    def _cluster_edge_tables(self, chunk_size=1000000):
+        """
+        Sort edge tables by source and sink, and index the first row of each source.
+
+        Tables are sorted out of memory: chunks of chunk_size rows are sorted
+        and, if a table has more than one chunk, written to temporary files
+        and merged back into the table. Tables whose index is up to date are
+        skipped. Masks are sorted along with the rows, the mask index has to
+        be updated afterwards.
+        """
+        for (source_partition, sink_partition), edge_table in self._iter_edge_tables():
+            n_rows = edge_table._original_len()
+            index_name = self._edge_table_index_name(source_partition, sink_partition)
+            try:
+                index = getattr(self._edges, index_name)
+                if index.attrs['n_rows'] == n_rows:
+                    continue
+                index._f_remove()
+            except tables.NoSuchNodeError:
+                pass
+
+            region_start, region_end = self._partition_region_range(source_partition)
+            counts = np.zeros(region_end - region_start, dtype=np.int64)
+            tmp_dir = tempfile.mkdtemp(prefix='fanc_sort_') if n_rows > chunk_size else None
+            try:
+                runs = []
+                is_sorted = True
+                previous_key = None
+                for start in range(0, n_rows, chunk_size):
+                    rows = edge_table.read(start, min(n_rows, start + chunk_size))
+                    keys = _pack_edge_keys(rows['source'], rows['sink'])
+                    counts += np.bincount(rows['source'].astype(np.int64) - region_start,
+                                          minlength=len(counts))
+
+                    order = np.argsort(keys, kind='mergesort')
+                    if np.any(order != np.arange(len(order))) or \
+                            (previous_key is not None and keys[0] < previous_key):
+                        is_sorted = False
+                    keys, rows = keys[order], rows[order]
+                    previous_key = keys[-1]
+
+                    if tmp_dir is None:
+                        runs.append((keys, rows))
+                    else:
+                        run_file = os.path.join(tmp_dir, '{}.npy'.format(len(runs)))
+                        np.save(run_file, rows)
+                        runs.append(run_file)
+
+                if not is_sorted:
+                    if tmp_dir is None:
+                        edge_table.modify_rows(0, n_rows, rows=runs[0][1])
+                    else:
+                        run_chunk_size = max(1, chunk_size // len(runs))
+                        run_iters = []
+                        for run_file in runs:
+                            rows = np.load(run_file, mmap_mode='r')
+                            run_iters.append(((_pack_edge_keys(chunk_rows['source'], chunk_rows['sink']),
+                                               chunk_rows)
+                                              for chunk_rows, in _array_chunks((rows,), run_chunk_size)))
+
+                        position = 0
+                        for _, rows in _merge_sorted_runs(run_iters):
+                            edge_table.modify_rows(position, position + len(rows), rows=rows)
+                            position += len(rows)
+            finally:
+                if tmp_dir is not None:
+                    shutil.rmtree(tmp_dir)
+
+            offsets = np.concatenate([[0], np.cumsum(counts)])
+            index = self.file.create_array(self._edges, index_name, obj=offsets.astype(np.int64))
+            index.attrs['n_rows'] = n_rows
+            index.attrs['region_start'] = region_start
+
+    def _clustered_row_index(self, source_partition, sink_partition):
+        """
+        Row offsets of each source region in a clustered edge table.
+
+        :return: numpy array with the first row of each source region in
+                 the partition, plus the number of rows, or None if the
+                 table has no valid index
+        """
+        if not self._clustered:
+            return None
+
+        try:
+            index = getattr(self._edges, self._edge_table_index_name(source_partition, sink_partition))
+        except tables.NoSuchNodeError:
+            return None
+
+        edge_table = self._edge_table(source_partition, sink_partition, create_if_missing=False)
+        region_start, region_end = self._partition_region_range(source_partition)
+        if (index.attrs['n_rows'] != edge_table._original_len() or
+                index.attrs['region_start'] != region_start or
+                len(index) != region_end - region_start + 1):
+            return None
+        return index[:]
+
+    def _clustered_row_ranges(self, source_partition, sink_partition, region_ranges):
+        """
+        Contiguous row ranges of a clustered edge table covering source region ranges.
+
+        :param region_ranges: list of (first, last) source region index tuples,
+                              both inclusive
+        :return: list of sorted, non-overlapping (start, stop) row ranges, or
+                 None if the table has no valid index
+        """
+        index = self._clustered_row_index(source_partition, sink_partition)
+        if index is None:
+            return None
+
+        region_start, region_end = self._partition_region_range(source_partition)
+        row_ranges = []
+        for first, last in sorted(region_ranges):
+            first = min(max(first, region_start), region_end) - region_start
+            last = min(max(last + 1, region_start), region_end) - region_start
+            start, stop = int(index[first]), int(index[last])
+            if start >= stop:
+                continue
+            if len(row_ranges) > 0 and start <= row_ranges[-1][1]:
+                row_ranges[-1] = (row_ranges[-1][0], max(stop, row_ranges[-1][1]))
+            else:
+                row_ranges.append((start, stop))
+        return row_ranges
+
+    def _set_partition_density(self, density):
+        """
+        Set the estimated number of edges per region for 'density' partitioning.
+
+        Has to be called before regions are added to the object.
+
+        :param density: array with one value per region
+        """
+        self._partition_density = np.asarray(density, dtype=np.float64)
+
+    def _region_edge_density(self):
+        """
+        Estimate the number of edges each region is part of.
+
+        Does not read any edges: source regions of clustered tables are
+        counted from the row index, all other edges of a table are spread
+        evenly over the regions of its source and sink partition.
+
+        :return: numpy array with one estimate per region
+        """
+        density = np.zeros(len(self.regions), dtype=np.float64)
+        for (source_partition, sink_partition), edge_table in self._iter_edge_tables():
+            source_start, source_end = self._partition_region_range(source_partition)
+            sink_start, sink_end = self._partition_region_range(sink_partition)
+            index = self._clustered_row_index(source_partition, sink_partition)
+            if index is not None:
+                density[source_start:source_end] += np.diff(index)
+            elif source_end > source_start:
+                density[source_start:source_end] += edge_table.nrows / (source_end - source_start)
+            if sink_end > sink_start:
+                density[sink_start:sink_end] += edge_table.nrows / (sink_end - sink_start)
+        return density
+
     def _update_partitions(self):
         logger.debug("Updating partitions!")
         n_regions = len(self.regions)
@@ -1726,6 +2479,15 @@ class RegionPairsTable(RegionPairsContainer, Maskable, RegionsTable):
         logger.debug("Regions: {}".format(n_regions))
 
         partition_breaks = []
+        if self._partition_strategy == 'density':
+            if self._partition_density is not None and len(self._partition_density) == n_regions:
+                n_partitions = int(np.ceil(n_regions / max(1000, int(n_regions / 100))))
+                self._partition_strategy = _balanced_partition_breaks(self._partition_density,
+                                                                      n_partitions)
+            else:
+                logger.debug("No edge density estimate for regions, using 'auto' partitioning")
+                self._partition_strategy = 'auto'
+
         if self._partition_strategy == 'auto':
             size = max(1000, int(n_regions / 100))
             self._partition_strategy = size
@@ -1909,20 +2671,263 @@ class RegionPairsTable(RegionPairsContainer, Maskable, RegionsTable):
                     if row_start > col_start:
                         condition1, condition2 = condition2, condition1
 
+                    # sorted tables: search only the blocks of rows with matching sources
+                    row_ranges = self._clustered_row_ranges(i, j, [(row_start, row_end),
+                                                                   (col_start, col_end)])
+                    if row_ranges is None:
+                        row_ranges = [(None, None)]
+
                     overlap = range_overlap(row_start, row_end, col_start, col_end)
 
-                    for edge_row in edge_table.where(condition1, excluded_filters=excluded_filters,
-                                                     maskable=self):
-                        yield edge_row
+                    for start, stop in row_ranges:
+                        for edge_row in edge_table.where(condition1, start=start, stop=stop,
+                                                         excluded_filters=excluded_filters,
+                                                         maskable=self):
+                            yield edge_row
 
-                    for edge_row in edge_table.where(condition2, excluded_filters=excluded_filters,
-                                                     maskable=self):
-                        if overlap is not None:
-                            if (overlap[0] <= edge_row['source'] <= overlap[1]) and (
-                                    overlap[0] <= edge_row['sink'] <= overlap[1]):
-                                continue
+                    for start, stop in row_ranges:
+                        for edge_row in edge_table.where(condition2, start=start, stop=stop,
+                                                         excluded_filters=excluded_filters,
+                                                         maskable=self):
+                            if overlap is not None:
+                                if (overlap[0] <= edge_row['source'] <= overlap[1]) and (
+                                        overlap[0] <= edge_row['sink'] <= overlap[1]):
+                                    continue
+
+                            yield edge_row
 
-                        yield edge_row
+    def _excluded_filters_ix(self, excluded_filters=0):
+        """
+        Convert excluded filters (mask names, :class:`~fanc.general.Mask`
+        objects, or binary mask) to a binary mask.
+        """
+        if isinstance(excluded_filters, (int, np.integer)):
+            return int(excluded_filters)
+        if excluded_filters == 'all':
+            excluded_filters = list(self.masks())
+        return self.get_binary_mask_from_masks(excluded_filters)
+
+    def _edge_rows_to_arrays(self, rows, score_field, excluded_mask_ix, mask_field='_mask'):
+        """
+        Extract source, sink, and weight arrays from a structured array of
+        edge table rows, removing rows masked by filters not in excluded_mask_ix.
+        """
+        if len(rows) > 0:
+            is_visible = (rows[mask_field] | excluded_mask_ix) == excluded_mask_ix
+            if not is_visible.all():
+                rows = rows[is_visible]
+
+        source = rows['source'].astype(np.int64)
+        sink = rows['sink'].astype(np.int64)
+        if score_field is not None and score_field in rows.dtype.names:
+            weight = rows[score_field].astype(np.float64)
+        else:
+            weight = np.full(len(rows), self._default_value, dtype=np.float64)
+        return source, sink, weight
+
+    def _edge_table_arrays(self, edge_table, score_field=None, chunk_size=1000000,
+                           excluded_filters=0, condition=None):
+        """
+        Read (source, sink, weight) arrays from an edge table in chunks.
+
+        :param edge_table: :class:`~fanc.general.MaskedTable` with edges
+        :param score_field: Name of the weight column
+        :param chunk_size: Maximum number of rows read at once
+        :param excluded_filters: Filters whose masked rows are still returned
+        :param condition: Optional PyTables condition string or list of
+                          condition strings. If provided, only rows matching
+                          (any of) them are returned
+        """
+        excluded_mask_ix = self._excluded_filters_ix(excluded_filters)
+        mask_field = edge_table._mask_field
+
+        if condition is None:
+            n_rows = edge_table._original_len()
+            for start in range(0, n_rows, chunk_size):
+                rows = edge_table.read(start, min(n_rows, start + chunk_size))
+                arrays = self._edge_rows_to_arrays(rows, score_field, excluded_mask_ix,
+                                                   mask_field=mask_field)
+                if len(arrays[0]) > 0:
+                    yield arrays
+        else:
+            if isinstance(condition, string_types):
+                condition = [condition]
+            row_ixs = np.unique(np.concatenate([edge_table.get_where_list(c) for c in condition]))
+            for start in range(0, len(row_ixs), chunk_size):
+                rows = edge_table.read_coordinates(row_ixs[start:start + chunk_size])
+                arrays = self._edge_rows_to_arrays(rows, score_field, excluded_mask_ix,
+                                                   mask_field=mask_field)
+                if len(arrays[0]) > 0:
+                    yield arrays
+
+    def _edge_table_window_arrays(self, edge_table, row_ranges, row_window, col_window,
+                                  score_field=None, chunk_size=1000000, excluded_filters=0):
+        """
+        Read (source, sink, weight) arrays of edges in a matrix window from
+        contiguous row ranges of an edge table.
+
+        :param edge_table: :class:`~fanc.general.MaskedTable` with edges
+        :param row_ranges: list of non-overlapping (start, stop) row ranges
+        :param row_window: tuple (first, last) region index of the window rows
+        :param col_window: tuple (first, last) region index of the window columns
+        """
+        excluded_mask_ix = self._excluded_filters_ix(excluded_filters)
+        mask_field = edge_table._mask_field
+        row_first, row_last = row_window
+        col_first, col_last = col_window
+
+        for range_start, range_stop in row_ranges:
+            for start in range(range_start, range_stop, chunk_size):
+                rows = edge_table.read(start, min(range_stop, start + chunk_size))
+                source, sink = rows['source'], rows['sink']
+                in_window = np.logical_or(
+                    (row_first <= source) & (source <= row_last) & (col_first <= sink) & (sink <= col_last),
+                    (col_first <= source) & (source <= col_last) & (row_first <= sink) & (sink <= row_last)
+                )
+                arrays = self._edge_rows_to_arrays(rows[in_window], score_field, excluded_mask_ix,
+                                                   mask_field=mask_field)
+                if len(arrays[0]) > 0:
+                    yield arrays
+
+    def _edge_arrays_iter(self, score_field=None, chunk_size=1000000, excluded_filters=0):
+        """
+        Read raw (source, sink, weight) arrays from all edge tables.
+        """
+        if score_field is None:
+            score_field = self._default_score_field
+
+        for _, edge_table in self._iter_edge_tables():
+            for arrays in self._edge_table_arrays(edge_table, score_field=score_field,
+                                                  chunk_size=chunk_size,
+                                                  excluded_filters=excluded_filters):
+                yield arrays
+
+    def _sorted_edge_arrays(self, score_field=None, chunk_size=1000000, excluded_filters=0):
+        """
+        Read raw (source, sink, weight) arrays of all edges, sorted by source and sink.
+
+        The edge tables of each source partition are read in order and
+        combined in a k-way merge (see :func:`~_merge_sorted_runs`), so that
+        only about chunk_size edges are held in memory at a time. Clustered
+        tables are already sorted. Chunks of other tables are sorted, and
+        saved to temporary files if a table has more than one chunk.
+        """
+        if score_field is None:
+            score_field = self._default_score_field
+
+        if self._partition_breaks is None:
+            return
+
+        n_partitions = len(self._partition_breaks) + 1
+        for source_partition in range(n_partitions):
+            run_dir = None
+            try:
+                clustered_tables = []
+                runs = []
+                run_files = []
+                for sink_partition in range(source_partition, n_partitions):
+                    try:
+                        edge_table = self._edge_table(source_partition, sink_partition, create_if_missing=False)
+                    except ValueError:
+                        continue
+
+                    if self._clustered_row_index(source_partition, sink_partition) is not None:
+                        clustered_tables.append(edge_table)
+                        continue
+
+                    n_rows = edge_table._original_len()
+                    for source, sink, weight in self._edge_table_arrays(edge_table, score_field=score_field,
+                                                                        chunk_size=chunk_size,
+                                                                        excluded_filters=excluded_filters):
+                        keys = _pack_edge_keys(source, sink)
+                        order = np.argsort(keys, kind='mergesort')
+                        if n_rows <= chunk_size:
+                            runs.append(iter([(keys[order], weight[order])]))
+                        else:
+                            if run_dir is None:
+                                run_dir = tempfile.mkdtemp(prefix='fanc_sort_')
+                            run_files.append(_save_sorted_run(run_dir, keys[order], weight[order]))
+
+                n_runs = len(clustered_tables) + len(runs) + len(run_files)
+                if n_runs == 0:
+                    continue
+
+                run_chunk_size = max(1, chunk_size // n_runs)
+                for edge_table in clustered_tables:
+                    runs.append((_pack_edge_keys(source, sink), weight)
+                                for source, sink, weight in self._edge_table_arrays(edge_table,
+                                                                                     score_field=score_field,
+                                                                                     chunk_size=run_chunk_size,
+                                                                                     excluded_filters=excluded_filters))
+                runs += _load_sorted_runs(run_files, chunk_size=run_chunk_size * max(1, len(run_files)))
+
+                for keys, weight in _merge_sorted_runs(runs):
+                    source, sink = _unpack_edge_keys(keys)
+                    yield source, sink, weight
+            finally:
+                if run_dir is not None:
+                    shutil.rmtree(run_dir)
+
+    def _edge_arrays_subset(self, row_regions, col_regions, score_field=None,
+                            chunk_size=1000000, excluded_filters=0, *args, **kwargs):
+        if score_field is None:
+            score_field = self._default_score_field
+
+        row_start, row_end = self._min_max_region_ix(row_regions)
+        col_start, col_end = self._min_max_region_ix(col_regions)
+
+        row_partition_start = self._get_partition_ix(row_start)
+        row_partition_end = self._get_partition_ix(row_end)
+        col_partition_start = self._get_partition_ix(col_start)
+        col_partition_end = self._get_partition_ix(col_end)
+
+        # rows matching both conditions are only returned once
+        condition = "(%d < source) & (source < %d) & (%d < sink) & (sink < %d)"
+        conditions = [condition % (row_start - 1, row_end + 1, col_start - 1, col_end + 1),
+                      condition % (col_start - 1, col_end + 1, row_start - 1, row_end + 1)]
+
+        partition_extracted = set()
+        for a in range(row_partition_start, row_partition_end + 1):
+            for b in range(col_partition_start, col_partition_end + 1):
+                if b < a:
+                    i, j = b, a
+                else:
+                    i, j = a, b
+
+                if (i, j) in partition_extracted:
+                    continue
+                partition_extracted.add((i, j))
+
+                try:
+                    edge_table = self._edge_table(i, j, create_if_missing=False)
+                except ValueError:
+                    continue
+
+                # read whole tables if all of their regions are requested
+                if self._is_partition_covered(a, row_start, row_end) and \
+                        self._is_partition_covered(b, col_start, col_end):
+                    table_condition = None
+                else:
+                    table_condition = conditions
+
+                    # sorted tables: read only the blocks of rows with matching sources
+                    row_ranges = self._clustered_row_ranges(i, j, [(row_start, row_end),
+                                                                   (col_start, col_end)])
+                    if row_ranges is not None:
+                        for arrays in self._edge_table_window_arrays(edge_table, row_ranges,
+                                                                     (row_start, row_end),
+                                                                     (col_start, col_end),
+                                                                     score_field=score_field,
+                                                                     chunk_size=chunk_size,
+                                                                     excluded_filters=excluded_filters):
+                            yield arrays
+                        continue
+
+                for arrays in self._edge_table_arrays(edge_table, score_field=score_field,
+                                                      chunk_size=chunk_size,
+                                                      excluded_filters=excluded_filters,
+                                                      condition=table_condition):
+                    yield arrays
 
     def _matrix_entries(self, key, row_regions, col_regions,
                         score_field=None, *args, **kwargs):
@@ -1998,29 +3003,156 @@ class RegionPairsTable(RegionPairsContainer, Maskable, RegionsTable):
 
     def _update_mappability(self):
         logger.info("Updating region mappability")
-        mappable = [False] * len(self.regions)
-        weight_field = getattr(self, '_default_score_field', None)
-        default_value = getattr(self, '_default_value', 1.)
+        mappable = np.zeros(len(self.regions), dtype=bool)
 
         with RareUpdateProgressBar(max_value=len(self.edges), prefix='Mappability',
                                    silent=config.hide_progressbars) as pb:
-            for i, edge in enumerate(self.edges_dict(lazy=True)):
+            i = 0
+            for source, sink, weight in self._edge_arrays_iter():
+                non_zero = weight != 0
+                mappable[source[non_zero]] = True
+                mappable[sink[non_zero]] = True
+                i += len(source)
+                pb.update(i)
+
+        self.region_data('valid', mappable)
+
+    def _region_valid(self):
+        arrays = self._region_arrays()
+        if 'valid' not in arrays:
+            return np.ones(len(arrays['start']), dtype=bool)
+        return arrays['valid'].copy()
+
+    def mappable(self, region=None):
+        """
+        Get the mappability of regions in this object.
+
+        A "mappable" region has at least one contact to another region
+        in the genome.
+
+        :param region: Optional region selector. If None, returns the
+                       mappability of all regions
+        :return: :class:`~np.array` where True means mappable
+                 and False unmappable
+        """
+        if region is None:
+            return self._region_valid()
+        return RegionPairsContainer.mappable(self, region)
+
+    def _prepare_filter(self, mask_filter):
+        """
+        Connect a :class:`~fanc.general.MaskFilter` to this object.
+
+        Called on a freshly opened, read-only copy of this object
+        in each worker process when filtering with multiple threads.
+        Override in subclasses whose filters need access to the
+        object they are filtering.
+
+        :param mask_filter: :class:`~fanc.general.MaskFilter`
+        """
+        pass
+
+    def _run_filters(self, mask_filters, threads=1, log_progress=not config.hide_progressbars):
+        """
+        Apply a list of filters to all edge tables.
+
+        With more than one thread, the mask columns of the edge tables
+        are computed by worker processes, each receiving the filters once
+        and working on a read-only handle of this file. The masks are then
+        written by this process.
+
+        :param mask_filters: list of :class:`~fanc.general.MaskFilter`
+        :param threads: Number of worker processes
+        :param log_progress: If true, process iterating through all edges
+                             will be continuously reported.
+        :return: dict with merged mask statistics of all edge tables
+        """
+        partitions = [partition for partition, _ in self._iter_edge_tables()]
+
+        if threads > 1 and self.file.params.get('DRIVER') == 'H5FD_CORE':
+            logger.warning("Parallel filtering requires a file-based object, "
+                           "filtering with a single thread.")
+            threads = 1
+
+        merged_stats = defaultdict(int)
+        with RareUpdateProgressBar(max_value=len(partitions),
+                                   silent=not log_progress,
+                                   prefix="Filter") as pb:
+            if threads > 1 and len(partitions) > 0:
+                # workers read the file while this process holds it open for
+                # writing, so everything must be on disk before they start
+                self.flush()
+                self.file.flush()
+
+                context = mp.get_context("spawn")
+                input_queue = context.Queue()
+                output_queue = context.Queue()
+                for partition in partitions:
+                    input_queue.put(partition)
+                n_workers = min(threads, len(partitions))
+                for _ in range(n_workers):
+                    input_queue.put(None)
+
+                # workers cannot acquire an HDF5 file lock on a file that
+                # is open for writing
+                file_locking = os.environ.get('HDF5_USE_FILE_LOCKING')
+                os.environ['HDF5_USE_FILE_LOCKING'] = 'FALSE'
+                workers = []
                 try:
-                    if weight_field is not None:
-                        weight = edge[weight_field]
+                    for _ in range(n_workers):
+                        worker = context.Process(target=_filter_edge_table_worker,
+                                                 args=(self.file.filename, self._load_kwargs, mask_filters,
+                                                       input_queue, output_queue))
+                        worker.daemon = True
+                        worker.start()
+                        workers.append(worker)
+
+                    # collect all masks before writing, so workers never
+                    # read from a file that is being modified
+                    partition_masks = dict()
+                    while len(partition_masks) < len(partitions):
+                        workers_alive = any(worker.is_alive() for worker in workers)
+                        try:
+                            output = output_queue.get(block=True, timeout=1)
+                        except Empty:
+                            if not workers_alive:
+                                raise RuntimeError("Filter workers exited before all edge "
+                                                   "tables were filtered")
+                            continue
+                        if isinstance(output, Exception):
+                            raise output
+                        partition, masks = output
+                        partition_masks[partition] = masks
+                        pb.update(len(partition_masks))
+                finally:
+                    for worker in workers:
+                        if worker.is_alive():
+                            worker.terminate()
+                        worker.join()
+                    if file_locking is None:
+                        del os.environ['HDF5_USE_FILE_LOCKING']
                     else:
-                        weight = default_value
-                except KeyError:
-                    weight = default_value
+                        os.environ['HDF5_USE_FILE_LOCKING'] = file_locking
 
-                if weight != 0:
-                    mappable[edge['source']] = True
-                    mappable[edge['sink']] = True
-                pb.update(i)
+                for partition in partitions:
+                    stats = self._edge_table(*partition)._apply_masks(partition_masks[partition])
+                    for key, value in stats.items():
+                        merged_stats[key] += value
+            else:
+                for i, partition in enumerate(partitions):
+                    stats = self._edge_table(*partition)._filter(mask_filters)
+                    for key, value in stats.items():
+                        merged_stats[key] += value
+                    pb.update(i)
 
-        self.region_data('valid', mappable)
+        if log_progress:
+            total = sum(merged_stats.values())
+            filtered = total - merged_stats.get(0, 0)
+            logger.info("Total: {}. Filtered: {}".format(total, filtered))
+
+        return dict(merged_stats)
 
-    def filter(self, edge_filter, queue=False, log_progress=not config.hide_progressbars):
+    def filter(self, edge_filter, queue=False, log_progress=not config.hide_progressbars, threads=1):
         """
         Filter edges in this object by using a
         :class:`~fanc.general.MaskFilter`.
@@ -2031,53 +3163,32 @@ class RegionPairsTable(RegionPairsContainer, Maskable, RegionsTable):
                       :func:`~RegionPairsTable.run_queued_filters`
         :param log_progress: If true, process iterating through all edges
                              will be continuously reported.
+        :param threads: Number of processes used to filter edge tables
+                        in parallel. Requires a file-based object.
+        :return: dict with mask statistics if the filter is not queued
         """
-        total = 0
-        filtered = 0
         if not queue:
-            with RareUpdateProgressBar(max_value=sum(1 for _ in self._edges),
-                                       silent=not log_progress,
-                                       prefix="Filter") as pb:
-                for i, (_, edge_table) in enumerate(self._iter_edge_tables()):
-                    stats = edge_table.filter(edge_filter, _logging=False)
-                    for key, value in stats.items():
-                        if key != 0:
-                            filtered += stats[key]
-                        total += stats[key]
-                    pb.update(i)
-            if log_progress:
-                logger.info("Total: {}. Filtered: {}".format(total, filtered))
+            stats = self._run_filters([edge_filter], threads=threads, log_progress=log_progress)
             self._update_mappability()
+            return stats
         else:
             self._queued_filters.append(edge_filter)
 
-    def run_queued_filters(self, log_progress=not config.hide_progressbars):
+    def run_queued_filters(self, log_progress=not config.hide_progressbars, threads=1):
         """
         Run queued filters.
 
         :param log_progress: If true, process iterating through all edges
                              will be continuously reported.
+        :param threads: Number of processes used to filter edge tables
+                        in parallel. Requires a file-based object.
+        :return: dict with mask statistics
         """
-        total = 0
-        filtered = 0
-        with RareUpdateProgressBar(max_value=sum(1 for _ in self._edges),
-                                   silent=not log_progress,
-                                   prefix="Filter") as pb:
-            for i, (_, edge_table) in enumerate(self._iter_edge_tables()):
-                for f in self._queued_filters:
-                    edge_table.queue_filter(f)
-
-                stats = edge_table.run_queued_filters(_logging=False)
-                for key, value in stats.items():
-                    if key != 0:
-                        filtered += stats[key]
-                    total += stats[key]
-                pb.update(i)
-        if log_progress:
-            logger.info("Total: {}. Filtered: {}".format(total, filtered))
+        stats = self._run_filters(self._queued_filters, threads=threads, log_progress=log_progress)
 
         self._queued_filters = []
         self._update_mappability()
+        return stats
 
     def reset_filters(self, log_progress=not config.hide_progressbars):
         with RareUpdateProgressBar(max_value=sum(1 for _ in self._edges),
@@ -2151,7 +3262,19 @@ class RegionPairsTable(RegionPairsContainer, Maskable, RegionsTable):
 
     @classmethod
     def merge_region_pairs_tables(cls, pairs, check_regions_identical=True,
-                                  *args, **kwargs):
+                                  chunk_size=1000000, *args, **kwargs):
+        """
+        Merge pair objects with identical regions and partitioning.
+
+        Unmasked rows of matching edge tables are copied to the output
+        in chunks of at most chunk_size rows.
+
+        :param pairs: list of :class:`~RegionPairsTable`
+        :param check_regions_identical: If True, raise a ValueError if the
+                                        regions of the pair objects are not identical
+        :param chunk_size: Maximum number of rows copied at once
+        :return: merged :class:`~RegionPairsTable`
+        """
         try:
             for pair in pairs:
                 assert isinstance(pair, RegionPairsTable)
@@ -2186,15 +3309,23 @@ class RegionPairsTable(RegionPairsContainer, Maskable, RegionsTable):
             with RareUpdateProgressBar(max_value=len(partition_pairs), prefix='Merge') as pb:
                 for i, (source_partition, sink_partition) in enumerate(partition_pairs):
                     edge_table = new_pairs._edge_table(source_partition, sink_partition)
-                    fields = edge_table.colnames
-                    new_row = edge_table.row
                     for pair in pairs:
                         if not pair._has_edge_table(source_partition, sink_partition):
                             continue
-                        for row in pair._edge_table(source_partition, sink_partition).iterrows():
-                            for field in fields:
-                                new_row[field] = row[field]
-                            new_row.append()
+                        pair_table = pair._edge_table(source_partition, sink_partition)
+                        mask_field = pair_table._mask_field
+                        n_rows = pair_table._original_len()
+                        # bulk copy of unmasked rows
+                        for start in range(0, n_rows, chunk_size):
+                            rows = pair_table.read(start, min(n_rows, start + chunk_size))
+                            rows = rows[rows[mask_field] == 0]
+                            new_rows = np.zeros(len(rows), dtype=edge_table.dtype)
+                            for name in edge_table.colnames:
+                                if name in rows.dtype.names:
+                                    new_rows[name] = rows[name]
+                                else:
+                                    new_rows[name] = edge_table.coldflts[name]
+                            edge_table.append(new_rows)
                     edge_table.flush()
                     pb.update(i)
             new_pairs._edges_dirty = True
@@ -2286,7 +3417,9 @@ class RegionMatrixTable(RegionMatrixContainer, RegionPairsTable):
                  default_score_field='weight', default_value=0.0,
                  _table_name_regions='regions', _table_name_edges='edges',
                  _table_name_expected_values='expected_values',
-                 _edge_buffer_size=config.edge_buffer_size):
+                 _edge_buffer_size=config.edge_buffer_size,
+                 _table_name_masks='mask', _meta_group='meta_information',
+                 clustered=False):
 
         self._default_score_field = default_score_field
         self._default_value = default_value
@@ -2305,13 +3438,18 @@ class RegionMatrixTable(RegionMatrixContainer, RegionPairsTable):
                                   additional_region_fields=additional_region_fields,
                                   additional_edge_fields=additional_edge_fields,
                                   partition_strategy=partition_strategy,
+                                  clustered=clustered,
                                   _table_name_regions=_table_name_regions,
                                   _table_name_edges=_table_name_edges,
+                                  _table_name_masks=_table_name_masks,
+                                  _meta_group=_meta_group,
                                   _edge_buffer_size=_edge_buffer_size)
         RegionMatrixContainer.__init__(self)
 
         file_exists = False
-        if file_name is not None and os.path.exists(os.path.expanduser(file_name)):
+        if isinstance(file_name, tables.file.File):
+            file_exists = True
+        elif file_name is not None and os.path.exists(os.path.expanduser(file_name)):
             file_exists = True
 
         # create expected value group
@@ -2326,7 +3464,31 @@ class RegionMatrixTable(RegionMatrixContainer, RegionPairsTable):
         else:
             self._expected_value_group = self.file.create_group('/', _table_name_expected_values)
 
+        self._expected_values_cache = dict()
+
+    @property
+    def _bias_version(self):
+        """
+        Counter that is incremented every time the bias vector changes.
+        """
+        try:
+            return int(self.meta['bias_version'])
+        except (KeyError, AttributeError):
+            return 0
+
+    def _increment_bias_version(self):
+        try:
+            self.meta['bias_version'] = self._bias_version + 1
+        except tables.FileModeError:
+            pass
+
+    def _expected_values_key(self, norm):
+        if norm:
+            return 'corrected', self._bias_version
+        return 'uncorrected', 0
+
     def _remove_expected_values(self):
+        self._expected_values_cache = dict()
         if self._expected_value_group is not None:
             try:
                 self.file.remove_node(self._expected_value_group, 'corrected', recursive=True)
@@ -2346,95 +3508,137 @@ class RegionMatrixTable(RegionMatrixContainer, RegionPairsTable):
 
     def set_biases(self, biases):
         self.region_data('bias', biases)
-        self._remove_expected_values()
 
     def expected_values_and_marginals(self, selected_chromosome=None, norm=True,
                                       force=False, *args, **kwargs):
-        group_name = 'corrected' if norm else 'uncorrected'
+        """
+        Calculate or load the expected values and marginals of this matrix.
+
+        Results are cached in memory and, if possible, saved to file, where
+        they are stored by normalisation state and version of the bias vector.
+        Subsequent calls will therefore not recompute expected values unless
+        edges or biases have changed in the meantime, or :code:`force=True`.
+
+        See :func:`~RegionMatrixContainer.expected_values_and_marginals`
+        for details.
+
+        :param selected_chromosome: (optional) Chromosome name. If provided,
+                                    will only return expected values for this
+                                    chromosome.
+        :param norm: If False, will calculate the expected values on the
+                     unnormalised matrix.
+        :param force: Recalculate expected values even if they are cached
+        :return: list of intra-chromosomal expected values,
+                 dict of intra-chromosomal expected values by chromosome,
+                 inter-chromosomal expected value, marginals, valid
+        """
+        group_name, bias_version = self._expected_values_key(norm)
+        cache_key = (group_name, bias_version)
+
+        result = None
+        if not force:
+            result = self._expected_values_cache.get(cache_key, None)
+
+        if result is None and not force and self._expected_value_group is not None:
+            result = self._load_expected_values(group_name, bias_version)
+            if result is not None:
+                self._expected_values_cache[cache_key] = result
+
+        if result is None:
+            result = RegionMatrixContainer.expected_values_and_marginals(self, norm=norm, *args, **kwargs)
+            self._expected_values_cache[cache_key] = result
+            self._save_expected_values(group_name, bias_version, *result)
 
-        if not force and self._expected_value_group is not None:
             try:
-                group = self.file.get_node(self._expected_value_group, group_name)
-                if selected_chromosome is not None:
-                    return self.file.get_node(group, '_' + selected_chromosome)[:]
-                else:
-                    intra_expected = None
-                    inter_expected = None
-                    marginals = None
-                    chromosome_intra_expected = {}
-                    for node in self.file.walk_nodes(group):
-                        if isinstance(node, tables.Group):
-                            continue
-                        if node.name == '__intra__':
-                            intra_expected = node[:]
-                        elif node.name == '__marginals__':
-                            marginals = node[:]
-                        elif node.name == '__inter__':
-                            inter_expected = node[0]
-                        else:
-                            if node.name.startswith('_'):
-                                chromosome = node.name[1:]
-                                chromosome_intra_expected[chromosome] = node[:]
-                    valid = self.region_data('valid')
-                    if intra_expected is not None and inter_expected is not None and marginals is not None \
-                            and len(chromosome_intra_expected) > 0:
-                        return intra_expected, chromosome_intra_expected, inter_expected, marginals, valid
-            except tables.NoSuchNodeError:
+                self.region_data('valid', result[4])
+            except (OSError, KeyError, tables.FileModeError):  # ignore older Hic versions and read-only files
                 pass
 
-        (intra_expected, chromosome_intra_expected,
-         inter_expected, marginals, valid) = RegionMatrixContainer.expected_values_and_marginals(self, norm=norm, *args,
-                                                                                                 **kwargs)
+        intra_expected, chromosome_intra_expected, inter_expected, marginals, valid = result
 
-        # try saving to object
-        logger.debug("Attempting to save expected values and marginals to file")
-        if hasattr(self, '_expected_value_group') and self._expected_value_group is not None:
-            try:
-                try:
-                    logger.debug("Removing old expected value vectors")
-                    self.file.remove_node(self._expected_value_group, group_name, recursive=True)
-                except tables.NoSuchNodeError:
-                    pass
+        if selected_chromosome is not None:
+            return chromosome_intra_expected[selected_chromosome], marginals, valid
 
-                logger.debug("Creating expected value group")
-                group = self.file.create_group(self._expected_value_group, group_name)
-
-                logger.debug("Saving intra-chromosomal expected values")
-                self.file.create_array(group, '__intra__',
-                                       np.array(intra_expected), "Intra-chromosomal expected values")
-                logger.debug("Saving inter-chromosomal expected values")
-                self.file.create_array(group, '__inter__',
-                                       np.array([inter_expected]), "Inter-chromosomal expected value")
-                logger.debug("Saving marginals")
-                self.file.create_array(group, '__marginals__',
-                                       np.array(marginals), "Marginals")
-
-                for chromosome, values in chromosome_intra_expected.items():
-                    logger.debug("Saving intra-chromosomal expected values {}".format(chromosome))
-                    self.file.create_array(group, '_' + chromosome,
-                                           np.array(values), "Intra-chromosomal expected "
-                                                             "value {}".format(chromosome))
-            except tables.FileModeError:
-                warnings.warn("Matrix file opened in read-only mode, "
-                              "cannot save expected values to object. "
-                              "Run 'fanc expected <matrix_file>' on the "
-                              "command line or in Python "
-                              "use mode 'a' to add expected values to "
-                              "an existing object. The results of the current "
-                              "computation are not affected if you don't "
-                              "do this, but it will speed things up in the future.")
+        return intra_expected, chromosome_intra_expected, inter_expected, marginals, valid
 
+    def _load_expected_values(self, group_name, bias_version):
         try:
-            self.region_data('valid', valid)
-        except (OSError, KeyError):  # ignore older Hic versions and read-only files
-            pass
+            group = self.file.get_node(self._expected_value_group, group_name)
+        except tables.NoSuchNodeError:
+            return None
+
+        if getattr(group._v_attrs, 'bias_version', 0) != bias_version:
+            logger.debug("Expected values on file are outdated")
+            return None
+
+        intra_expected = None
+        inter_expected = None
+        marginals = None
+        chromosome_intra_expected = {}
+        for node in self.file.walk_nodes(group):
+            if isinstance(node, tables.Group):
+                continue
+            if node.name == '__intra__':
+                intra_expected = node[:]
+            elif node.name == '__marginals__':
+                marginals = node[:]
+            elif node.name == '__inter__':
+                inter_expected = node[0]
+            elif node.name.startswith('_'):
+                chromosome = node.name[1:]
+                chromosome_intra_expected[chromosome] = node[:]
+
+        if intra_expected is None or inter_expected is None or marginals is None \
+                or len(chromosome_intra_expected) == 0:
+            return None
+
+        valid = self._regions.col('valid')
+        return intra_expected, chromosome_intra_expected, inter_expected, marginals, valid
 
-        if selected_chromosome is not None:
-            return chromosome_intra_expected[selected_chromosome], marginals
+    def _save_expected_values(self, group_name, bias_version, intra_expected, chromosome_intra_expected,
+                              inter_expected, marginals, valid):
+        logger.debug("Attempting to save expected values and marginals to file")
+        if getattr(self, '_expected_value_group', None) is None:
+            return
 
-        return intra_expected, chromosome_intra_expected, inter_expected, marginals, valid
+        try:
+            try:
+                logger.debug("Removing old expected value vectors")
+                self.file.remove_node(self._expected_value_group, group_name, recursive=True)
+            except tables.NoSuchNodeError:
+                pass
+
+            logger.debug("Creating expected value group")
+            group = self.file.create_group(self._expected_value_group, group_name)
+            group._v_attrs.bias_version = bias_version
+
+            logger.debug("Saving intra-chromosomal expected values")
+            self.file.create_array(group, '__intra__',
+                                   np.array(intra_expected), "Intra-chromosomal expected values")
+            logger.debug("Saving inter-chromosomal expected values")
+            self.file.create_array(group, '__inter__',
+                                   np.array([inter_expected]), "Inter-chromosomal expected value")
+            logger.debug("Saving marginals")
+            self.file.create_array(group, '__marginals__',
+                                   np.array(marginals), "Marginals")
+
+            for chromosome, values in chromosome_intra_expected.items():
+                logger.debug("Saving intra-chromosomal expected values {}".format(chromosome))
+                self.file.create_array(group, '_' + chromosome,
+                                       np.array(values), "Intra-chromosomal expected "
+                                                         "value {}".format(chromosome))
+        except tables.FileModeError:
+            warnings.warn("Matrix file opened in read-only mode, "
+                          "cannot save expected values to object. "
+                          "Run 'fanc expected <matrix_file>' on the "
+                          "command line or in Python "
+                          "use mode 'a' to add expected values to "
+                          "an existing object. The results of the current "
+                          "computation are not affected if you don't "
+                          "do this, but it will speed things up in the future.")
 
     def _update_mappability(self):
+        self._remove_expected_values()
         _ = self.expected_values_and_marginals(force=True)
 
     def region_data(self, key, value=None):
@@ -2442,6 +3646,7 @@ class RegionMatrixTable(RegionMatrixContainer, RegionPairsTable):
 
         if key == 'bias' and value is not None:
             logger.debug("Recalculating mappability and expected values after bias vector change!")
+            self._increment_bias_version()
             self._update_mappability()
 
         return data
@@ -2449,6 +3654,25 @@ class RegionMatrixTable(RegionMatrixContainer, RegionPairsTable):
     @classmethod
     def merge_region_matrix_tables(cls, matrices, check_regions_identical=True,
                                    *args, **kwargs):
+        """
+        Merge matrices with identical regions and partitioning by adding weights.
+
+        Matching edge tables of all matrices are read in chunks of at most
+        chunk_size rows, sorted, and combined in a k-way merge, which is
+        appended to the output in chunks. Edge tables are independent and
+        can be merged in parallel threads.
+
+        :param matrices: list of :class:`~RegionMatrixTable`
+        :param check_regions_identical: If True, raise a ValueError if the
+                                        regions of the matrices are not identical
+        :param threads: Number of edge tables merged in parallel
+        :param chunk_size: Maximum number of rows read from an edge table at once
+        :return: merged :class:`~RegionMatrixTable`
+        """
+        # keyword-only, all other arguments are passed on to the constructor
+        threads = kwargs.pop('threads', 1)
+        chunk_size = kwargs.pop('chunk_size', 1000000)
+
         try:
             for matrix in matrices:
                 assert isinstance(matrix, RegionMatrixTable)
@@ -2485,30 +3709,39 @@ class RegionMatrixTable(RegionMatrixContainer, RegionPairsTable):
             for (source_partition, sink_partition), _ in matrix._iter_edge_tables():
                 new_matrix._edge_table(source_partition, sink_partition)
                 partition_pairs.add((source_partition, sink_partition))
+        partition_pairs = sorted(partition_pairs)
 
         new_matrix._disable_edge_indexes()
 
         default_field = getattr(new_matrix, '_default_score_field', 'weight')
-        logger.info("Starting fast matrix merge")
-        with RareUpdateProgressBar(max_value=len(partition_pairs), prefix="Merge") as pb:
-            for i, (source_partition, sink_partition) in enumerate(partition_pairs):
-                edges = defaultdict(int)
-                for matrix in matrices:
-                    if not matrix._has_edge_table(source_partition, sink_partition):
-                        continue
+        lock = threading.Lock()
+
+        # keep sorted runs next to the temporary file of the merged matrix
+        run_tmpdir = None
+        if new_matrix.tmp_file_name is not None:
+            run_tmpdir = os.path.dirname(new_matrix.tmp_file_name)
+
+        def _merge_partition(partition):
+            for keys, weights in _merge_edge_tables(matrices, partition, default_field,
+                                                    chunk_size=chunk_size, lock=lock,
+                                                    tmpdir=run_tmpdir):
+                with lock:
+                    edge_table = new_matrix._edge_table(*partition)
+                    rows = np.zeros(len(keys), dtype=edge_table.dtype)
+                    for name in edge_table.colnames:
+                        rows[name] = edge_table.coldflts[name]
+                    rows['source'], rows['sink'] = _unpack_edge_keys(keys)
+                    rows[default_field] = weights
+                    edge_table.append(rows)
+                    edge_table.flush()
+            return partition
 
-                    for row in matrix._edge_table(source_partition, sink_partition).iterrows():
-                        edges[(row['source'], row['sink'])] += row[default_field]
-
-                edge_table = new_matrix._edge_table(source_partition, sink_partition)
-                new_row = edge_table.row
-                for (source, sink), weight in edges.items():
-                    new_row['source'] = source
-                    new_row['sink'] = sink
-                    new_row[default_field] = weight
-                    new_row.append()
-                edge_table.flush()
-                pb.update(i)
+        logger.info("Starting fast matrix merge")
+        with RareUpdateProgressBar(max_value=len(partition_pairs), prefix="Merge",
+                                   silent=config.hide_progressbars) as pb:
+            with ThreadPool(max(1, threads)) as pool:
+                for i, _ in enumerate(pool.imap_unordered(_merge_partition, partition_pairs)):
+                    pb.update(i)
         logger.info("Done merging matrices")
         new_matrix._edges_dirty = True
 
@@ -2526,16 +3759,20 @@ class RegionMatrixTable(RegionMatrixContainer, RegionPairsTable):
         Merging is done by adding the weight of edges in each object.
 
         :param matrices: list of :class:`~RegionMatrixContainer`
+        :param threads: Number of edge tables merged in parallel if all
+                        matrices are :class:`~RegionMatrixTable` with
+                        identical partitioning
         :return: merged :class:`~RegionMatrixContainer`
         """
+        threads = kwargs.pop('threads', 1)
         matrices = [matrix for matrix in matrices]
         if not RegionPairsContainer.regions_identical(matrices):
             raise ValueError("Regions in matrix objects are not identical, "
                              "cannot perform merge!")
 
         try:
-            return cls.merge_region_matrix_tables(matrices, check_regions_identical=False,
-                                                  *args, **kwargs)
+            return cls.merge_region_matrix_tables(matrices, False, *args,
+                                                  threads=threads, **kwargs)
         except ValueError:
             logger.info("Pair objects not compatible with fast merge, "
                         "performing regular merge")
@@ -8,16 +8,13 @@ import os
 import threading
 import uuid
 from abc import abstractmethod, ABCMeta
-from bisect import bisect_right
 from builtins import object
 from collections import defaultdict
-from queue import Empty
-from timeit import default_timer as timer
+from queue import Empty, Full
 import tempfile
 import shutil
 from datetime import datetime
 
-import msgpack
 import numpy as np
 import pysam
 import tables as t
@@ -27,9 +24,11 @@ from genomic_regions import GenomicRegion, RegionBased
 from .config import config
 from .general import MaskFilter, Mask
 from .hic import Hic
-from .matrix import Edge, RegionPairsTable
-from .regions import genome_regions
-from .tools.general import RareUpdateProgressBar, add_dict, find_alignment_match_positions, WorkerMonitor
+from .matrix import Edge, RegionPairsTable, _pack_edge_keys, _unpack_edge_keys, _sum_sorted_runs, \
+    _array_chunks
+from .regions import genome_regions, Genome, Chromosome
+from .tools.general import RareUpdateProgressBar, add_dict, find_alignment_match_positions, \
+    share_array, attached_array, SharedArraySlots
 from .tools.sambam import natural_cmp
 from .tools.files import split_sam_pairs
 
@@ -128,35 +127,40 @@ def generate_pairs_split(sam1_file, sam2_file, regions,
     return pairs
 
 
-class Monitor(WorkerMonitor):
+def _put_unless_aborted(queue, item, abort=None):
     """
-    Class to monitor fragment info worker threads.
-    """
-    def __init__(self, value=0, manager=None):
-        WorkerMonitor.__init__(self, value=value, manager=manager)
-        self.generating_pairs_lock = manager.Lock()
-
-        with self.generating_pairs_lock:
-            self.generating_pairs = True
-
-    def set_generating_pairs(self, value):
-        """
-        Set the pair generating status.
-        """
-        with self.generating_pairs_lock:
-            self.generating_pairs = value
+    Put an item on a bounded queue, giving up once abort is set.
 
-    def is_generating_pairs(self):
-        """
-        Check the pair generating status.
-        """
-        with self.generating_pairs_lock:
-            return self.generating_pairs
+    :param queue: Queue
+    :param item: Item to put on the queue
+    :param abort: Optional :class:`threading.Event`
+    :return: True if the item was put on the queue, False if aborted
+    """
+    while True:
+        try:
+            queue.put(item, timeout=1)
+            return True
+        except Full:
+            if abort is not None and abort.is_set():
+                return False
 
 
-def _split_sam_worker(sam_file1, sam_file2, input_queue, monitor, batch_size=10000000,
-                      tmpdir=None, check_sorted=True):
-    monitor.set_generating_pairs(True)
+def _split_sam_worker(sam_file1, sam_file2, input_queue, n_workers, batch_size=10000000,
+                      tmpdir=None, check_sorted=True, abort=None):
+    """
+    Worker that splits paired SAM files into chunks for :func:`~_load_paired_sam_worker`.
+
+    :param sam_file1: SAM/BAM file of first reads
+    :param sam_file2: SAM/BAM file of second reads
+    :param input_queue: Queue for split SAM files
+    :param n_workers: Number of workers reading from input_queue.
+                      Each receives a None when all files have been split.
+    :param batch_size: Number of read pairs per split file
+    :param tmpdir: Folder for split files
+    :param check_sorted: Check that SAM files are sorted by read name
+    :param abort: Optional :class:`threading.Event` that stops the worker
+                  when set, e.g. because the workers have been terminated
+    """
     try:
         if tmpdir is None:
             tmpdir = tempfile.mkdtemp()
@@ -168,193 +172,475 @@ def _split_sam_worker(sam_file1, sam_file2, input_queue, monitor, batch_size=100
                                                                       chunk_size=batch_size,
                                                                       check_sorted=check_sorted):
                 logger.debug("Split pairs batch {}".format(pairs_file))
-                input_queue.put([pairs_file, chunk_size, unmappable])
-                monitor.increment()
+                if not _put_unless_aborted(input_queue, [pairs_file, chunk_size, unmappable], abort):
+                    return
         except ValueError as e:
             logger.error(e)
-            monitor.increment()
-            input_queue.put(e)
+            _put_unless_aborted(input_queue, e, abort)
     finally:
-        monitor.set_generating_pairs(False)
+        for _ in range(n_workers):
+            if not _put_unless_aborted(input_queue, None, abort):
+                break
 
 
-def _load_paired_sam_worker(monitor, input_file_queue, output_file_queue, fi, fe,
-                            partition_breaks, read_filters=None,
-                            tmpdir=None, buffer_size=1000000):
-    logger.debug("Launching SAM worker")
-    worker_uuid = uuid.uuid4()
-    monitor.set_worker_busy(worker_uuid)
-    logger.debug("Assigning SAM worker ID {}".format(worker_uuid))
+# maximum number of records in a shared memory slot. Independent of the
+# batch size, so that shared memory use stays small (/dev/shm is often
+# limited, e.g. to 64MB in Docker); larger batches span several slots
+_shared_slot_size = 20000
 
-    if tmpdir is None:
-        tmpdir = tempfile.mkdtemp()
+_read_pair_dtype = np.dtype([
+    ('chromosome1', np.int32), ('position1', np.int64), ('flag1', np.int32),
+    ('chromosome2', np.int32), ('position2', np.int64), ('flag2', np.int32),
+])
 
-    file_counter = 0
-    cumulative_wait_time = 0
-    while True:
-        # wait for input
-        monitor.set_worker_idle(worker_uuid)
-        logger.debug("Worker {} waiting for input".format(worker_uuid))
-        s = datetime.now()
-        input_data = input_file_queue.get(True)
-        if isinstance(input_data, Exception):
-            output_file_queue.put(input_data)
-            break
-        read_pairs_file, chunk_size, unmappable = input_data
-        w = datetime.now() - s
-        logger.debug("Worker {} wait time: {}".format(worker_uuid, w))
-        cumulative_wait_time += w.total_seconds()
-
-        s = datetime.now()
-        monitor.set_worker_busy(worker_uuid)
-        logger.debug('Worker {} received input!'.format(worker_uuid))
-
-        output_file = os.path.join(tmpdir, 'fragment_info_{}_{}.txt'.format(worker_uuid, file_counter))
-        logger.debug("Writing fragment info to output file {}".format(output_file))
-        file_counter += 1
-
-        lines = []
-        skipped_counter = 0
-        pair_generator = PairedSamBamReadPairGenerator(read_pairs_file)
-        if read_filters is not None:
-            for f in read_filters:
-                pair_generator.add_filter(f)
-        pair_generator._unmappable_count = unmappable
-
-        for read1, read2 in pair_generator:
-            chrom1, pos1, flag1 = read1.reference_name, read1.pos, read1.flag
-            chrom2, pos2, flag2 = read2.reference_name, read2.pos, read2.flag
-            chrom1 = chrom1.decode() if isinstance(chrom1, bytes) else chrom1
-            chrom2 = chrom2.decode() if isinstance(chrom2, bytes) else chrom2
+_pair_dtype = np.dtype([
+    ('ix', np.int32), ('source', np.int64), ('sink', np.int64),
+    ('left_read_position', np.int64), ('left_read_strand', np.int8),
+    ('left_fragment_start', np.int64), ('left_fragment_end', np.int64),
+    ('left_fragment_chromosome', np.int32),
+    ('right_read_position', np.int64), ('right_read_strand', np.int8),
+    ('right_fragment_start', np.int64), ('right_fragment_end', np.int64),
+    ('right_fragment_chromosome', np.int32),
+])
 
-            try:
-                pos_ix1 = bisect_right(fe[chrom1], pos1)
-                pos_ix2 = bisect_right(fe[chrom2], pos2)
+_fragment_dtype = np.dtype([
+    ('ix', np.int64), ('chromosome', np.int32),
+    ('start', np.int64), ('end', np.int64),
+    ('global_end', np.int64),
+])
 
-                f_ix1, f_chromosome_ix1, f_start1, f_end1 = fi[chrom1][pos_ix1]
-                f_ix2, f_chromosome_ix2, f_start2, f_end2 = fi[chrom2][pos_ix2]
+_chromosome_fragments_dtype = np.dtype([
+    ('offset', np.int64), ('count', np.int64), ('shift', np.int64),
+])
 
-                p_ix1 = bisect_right(partition_breaks, f_ix1)
-                p_ix2 = bisect_right(partition_breaks, f_ix2)
 
-                r_strand1 = -1 if flag1 & 16 else 1
-                r_strand2 = -1 if flag2 & 16 else 1
+def _fragment_info_arrays(regions, chromosome_to_ix):
+    """
+    Build the restriction fragment lookup used by :func:`~_fragment_info_pairs`.
+
+    Fragment ends are shifted by the cumulative length of all previous
+    chromosomes, so that the fragments of all chromosomes can be found
+    with a single :func:`numpy.searchsorted` call.
+
+    :param regions: iterator over restriction fragments, sorted by
+                    chromosome and start
+    :param chromosome_to_ix: dict mapping chromosome names to chromosome index
+    :return: tuple (fragment structured array, structured array with
+             first fragment, number of fragments and shift for each
+             chromosome index)
+    """
+    fragment_list = []
+    chromosome_fragments = defaultdict(int)
+    chromosome_order = []
+    for region in regions:
+        chromosome = region.chromosome
+        if chromosome not in chromosome_fragments:
+            chromosome_order.append(chromosome)
+        chromosome_fragments[chromosome] += 1
+        fragment_list.append((region.ix, chromosome_to_ix[chromosome], region.start, region.end, 0))
+    fragments = np.array(fragment_list, dtype=_fragment_dtype)
+
+    n_chromosomes = max(chromosome_to_ix.values()) + 1 if len(chromosome_to_ix) > 0 else 0
+    chromosomes = np.zeros(n_chromosomes, dtype=_chromosome_fragments_dtype)
+    offset, shift = 0, 0
+    for chromosome in chromosome_order:
+        n_fragments = chromosome_fragments[chromosome]
+        chromosomes[chromosome_to_ix[chromosome]] = (offset, n_fragments, shift)
+        chromosome_fragments_slice = slice(offset, offset + n_fragments)
+        fragments['global_end'][chromosome_fragments_slice] = fragments['end'][chromosome_fragments_slice] + shift
+        shift += int(np.max(fragments['end'][chromosome_fragments_slice])) + 1
+        offset += n_fragments
+
+    return fragments, chromosomes
+
+
+def _read_pair_records(read_pairs, chromosome_to_ix, batch_size=1000000):
+    """
+    Convert read pairs to arrays of fixed-size records.
 
-                if p_ix1 > p_ix2:
-                    line = "{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(
-                        p_ix2, pos2, r_strand2, f_ix2, f_chromosome_ix2, f_start2, f_end2,
-                        p_ix1, pos1, r_strand1, f_ix1, f_chromosome_ix1, f_start1, f_end1
-                    )
-                else:
-                    line = "{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(
-                        p_ix1, pos1, r_strand1, f_ix1, f_chromosome_ix1, f_start1, f_end1,
-                        p_ix2, pos2, r_strand2, f_ix2, f_chromosome_ix2, f_start2, f_end2
-                    )
-                lines.append(line)
+    :param read_pairs: iterator of read tuples (read1, read2)
+    :param chromosome_to_ix: dict mapping chromosome names to chromosome index.
+                             Unknown chromosomes are assigned index -1
+    :param batch_size: Maximum number of read pairs per array
+    :return: iterator over structured arrays of read pairs
+    """
+    def _records(batch):
+        records = np.empty(len(batch[0]), dtype=_read_pair_dtype)
+        for name, values in zip(_read_pair_dtype.names, batch):
+            records[name] = values
+        return records
+
+    batch = ([], [], [], [], [], [])
+    for read1, read2 in read_pairs:
+        for i, read in ((0, read1), (3, read2)):
+            chromosome = read.reference_name
+            if isinstance(chromosome, bytes):
+                chromosome = chromosome.decode()
+            batch[i].append(chromosome_to_ix.get(chromosome, -1))
+            batch[i + 1].append(read.pos)
+            batch[i + 2].append(read.flag)
+        if len(batch[0]) >= batch_size:
+            yield _records(batch)
+            batch = ([], [], [], [], [], [])
+    if len(batch[0]) > 0:
+        yield _records(batch)
+
+
+def _read_fragment_ixs(chromosome_ixs, positions, fragments, chromosomes):
+    """
+    Find the restriction fragment for each read.
 
-                if len(lines) > buffer_size:
-                    with open(output_file, 'a') as o:
-                        for line in lines:
-                            o.write(line)
-                    lines = []
-            except (KeyError, IndexError):
-                skipped_counter += 1
+    Equivalent to a :func:`~bisect.bisect_right` of the read position in the
+    fragment ends of its chromosome.
 
-        with open(output_file, 'a') as o:
-            for line in lines:
-                o.write(line)
+    :param chromosome_ixs: array of chromosome indexes, -1 for unknown chromosomes
+    :param positions: array of read positions
+    :param fragments: fragment array from :func:`~_fragment_info_arrays`
+    :param chromosomes: chromosome array from :func:`~_fragment_info_arrays`
+    :return: array of row indices into fragments, -1 if a read
+             cannot be assigned to a fragment
+    """
+    chromosome_ixs = np.asarray(chromosome_ixs, dtype=np.int64)
+    positions = np.asarray(positions, dtype=np.int64)
+    if len(positions) == 0:
+        return np.zeros(0, dtype=np.int64)
 
-        logger.debug("Done obtaining fragment info for {} in {}".format(read_pairs_file, output_file))
-        output_file_queue.put((read_pairs_file, output_file, pair_generator.stats()))
+    known = np.logical_and(chromosome_ixs >= 0, chromosome_ixs < len(chromosomes))
+    read_chromosomes = chromosomes[np.where(known, chromosome_ixs, 0)] if len(chromosomes) > 0 \
+        else np.zeros(len(positions), dtype=_chromosome_fragments_dtype)
 
-        l = datetime.now() - s
-        logger.debug("Worker {} load time: {}".format(worker_uuid, l))
+    fragment_ixs = np.searchsorted(fragments['global_end'], positions + read_chromosomes['shift'], side='right')
+    local_ixs = fragment_ixs - read_chromosomes['offset']
+    invalid = np.logical_or(local_ixs >= read_chromosomes['count'], local_ixs < 0)
+    fragment_ixs[np.logical_or(invalid, ~known)] = -1
+    return fragment_ixs
 
 
-def _fragment_info_worker(monitor, input_queue, output_queue, fi, fe):
+def _fragment_info_pairs(reads, fragments, chromosomes):
     """
-    Worker that finds the restriction fragment info for read pairs.
+    Assign read pairs to restriction fragments.
+
+    :param reads: structured array of read pairs from :func:`~_read_pair_records`
+    :param fragments: fragment array from :func:`~_fragment_info_arrays`
+    :param chromosomes: chromosome array from :func:`~_fragment_info_arrays`
+    :return: structured array with pair dtype, ix is not set.
+             Read pairs that cannot be assigned are skipped.
+    """
+    fragment_ixs1 = _read_fragment_ixs(reads['chromosome1'], reads['position1'], fragments, chromosomes)
+    fragment_ixs2 = _read_fragment_ixs(reads['chromosome2'], reads['position2'], fragments, chromosomes)
+    valid = np.logical_and(fragment_ixs1 >= 0, fragment_ixs2 >= 0)
+    fragment_ixs1, fragment_ixs2 = fragment_ixs1[valid], fragment_ixs2[valid]
+
+    reads = reads[valid]
+    positions1, positions2 = reads['position1'], reads['position2']
+    strands1 = np.where(reads['flag1'] & 16, -1, 1)
+    strands2 = np.where(reads['flag2'] & 16, -1, 1)
+
+    # left read maps to the fragment with the smaller index
+    swap = fragments['ix'][fragment_ixs1] > fragments['ix'][fragment_ixs2]
+    pairs = np.zeros(len(fragment_ixs1), dtype=_pair_dtype)
+    for side, index_field, fragment_ixs, positions, strands in (
+            ('left', 'source',
+             np.where(swap, fragment_ixs2, fragment_ixs1),
+             np.where(swap, positions2, positions1),
+             np.where(swap, strands2, strands1)),
+            ('right', 'sink',
+             np.where(swap, fragment_ixs1, fragment_ixs2),
+             np.where(swap, positions1, positions2),
+             np.where(swap, strands1, strands2))):
+        side_fragments = fragments[fragment_ixs]
+        pairs[index_field] = side_fragments['ix']
+        pairs[side + '_read_position'] = positions
+        pairs[side + '_read_strand'] = strands
+        pairs[side + '_fragment_start'] = side_fragments['start']
+        pairs[side + '_fragment_end'] = side_fragments['end']
+        pairs[side + '_fragment_chromosome'] = side_fragments['chromosome']
+    return pairs
 
-    Finds the restriction fragment each read maps to, and returns the
-    coordinates of the read and fragment pairs for each read pair.
 
-    :param monitor: :class:`~Monitor`
-    :param input_queue: Queue for input read_pairs
-    :param output_queue: Queue for output fragment infos
-    :param fi: Fragment info dictionary by chromosome and fragment index
-    :param fe: Fragment end coordinates by chromosome
-    :return: list of fragment infos
+def _load_paired_sam_worker(input_file_queue, output_queue, pair_slots,
+                            fragments_descriptor, chromosomes, chromosome_to_ix,
+                            read_filters=None):
+    """
+    Worker that finds the restriction fragment info for split SAM files.
+
+    Pairs are written to shared memory slots, and only (slot, number of pairs, info)
+    tuples are put on the output queue. info is None, except for the final
+    tuple of each SAM file, which has no slot and contains the SAM file
+    name and read filter statistics. A None is put on the output queue
+    once the input queue is exhausted.
+
+    :param input_file_queue: Queue of split SAM files from :func:`~_split_sam_worker`
+    :param output_queue: Queue for output slot descriptions
+    :param pair_slots: :class:`~fanc.tools.general.SharedArraySlots` with pair dtype
+    :param fragments_descriptor: Shared memory descriptor of the fragment
+                                 array from :func:`~_fragment_info_arrays`
+    :param chromosomes: Chromosome array from :func:`~_fragment_info_arrays`
+    :param chromosome_to_ix: dict mapping chromosome names to chromosome index
+    :param read_filters: list of read filters
     """
     worker_uuid = uuid.uuid4()
-    logger.debug("Starting fragment info worker {}".format(worker_uuid))
+    logger.debug("Launching SAM worker {}".format(worker_uuid))
+
+    fragments_shm, fragments = attached_array(fragments_descriptor)
 
     while True:
-        # wait for input
-        monitor.set_worker_idle(worker_uuid)
         logger.debug("Worker {} waiting for input".format(worker_uuid))
-        read_pairs = input_queue.get(True)
-        monitor.set_worker_busy(worker_uuid)
-        logger.debug('Worker {} reveived input!'.format(worker_uuid))
-        read_pairs = msgpack.loads(read_pairs, strict_map_key=False)
+        input_data = input_file_queue.get(True)
+        if input_data is None:
+            output_queue.put(None)
+            break
+        if isinstance(input_data, Exception):
+            output_queue.put(input_data)
+            break
 
-        fragment_infos = []
-        skipped_counter = 0
-        for (chrom1, pos1, flag1), (chrom2, pos2, flag2) in read_pairs:
-            chrom1 = chrom1.decode() if isinstance(chrom1, bytes) else chrom1
-            chrom2 = chrom2.decode() if isinstance(chrom2, bytes) else chrom2
+        try:
+            read_pairs_file, chunk_size, unmappable = input_data
+            s = datetime.now()
+            logger.debug('Worker {} received input!'.format(worker_uuid))
+
+            pair_generator = PairedSamBamReadPairGenerator(read_pairs_file)
+            if read_filters is not None:
+                for f in read_filters:
+                    pair_generator.add_filter(f)
+            pair_generator._unmappable_count = unmappable
+
+            n_reads = 0
+            for reads in _read_pair_records(pair_generator, chromosome_to_ix, pair_slots.slot_size):
+                n_reads += len(reads)
+                pairs = _fragment_info_pairs(reads, fragments, chromosomes)
+                for slot, n in pair_slots.put(pairs):
+                    output_queue.put((slot, n, None))
+                del pairs
+            output_queue.put((None, 0, (read_pairs_file, pair_generator.stats())))
+
+            logger.debug("Worker {} done with {} in {}".format(worker_uuid, read_pairs_file,
+                                                               datetime.now() - s))
+        except Exception as e:
+            output_queue.put(e)
+            break
 
-            try:
-                pos_ix1 = bisect_right(fe[chrom1], pos1)
-                pos_ix2 = bisect_right(fe[chrom2], pos2)
 
-                f_ix1, f_chromosome_ix1, f_start1, f_end1 = fi[chrom1][pos_ix1]
-                f_ix2, f_chromosome_ix2, f_start2, f_end2 = fi[chrom2][pos_ix2]
+def _fragment_info_worker(input_queue, output_queue, read_slots, pair_slots,
+                          fragments_descriptor, chromosomes):
+    """
+    Worker that finds the restriction fragment info for read pairs.
 
-                r_strand1 = -1 if flag1 & 16 else 1
-                r_strand2 = -1 if flag2 & 16 else 1
+    Finds the restriction fragment each read maps to, and returns the
+    coordinates of the read and fragment pairs for each read pair.
+    Read and fragment pairs are exchanged in shared memory slots, and the
+    queues only carry (slot, number of records) tuples. A None on the
+    input queue terminates the worker, which then puts a None on the
+    output queue.
+
+    :param input_queue: Queue of read pair slots
+    :param output_queue: Queue for fragment info slots
+    :param read_slots: :class:`~fanc.tools.general.SharedArraySlots` with read pair dtype
+    :param pair_slots: :class:`~fanc.tools.general.SharedArraySlots` with pair dtype
+    :param fragments_descriptor: Shared memory descriptor of the fragment
+                                 array from :func:`~_fragment_info_arrays`
+    :param chromosomes: Chromosome array from :func:`~_fragment_info_arrays`
+    """
+    worker_uuid = uuid.uuid4()
+    logger.debug("Starting fragment info worker {}".format(worker_uuid))
 
-                fragment_infos.append(
-                    ((pos1, r_strand1, f_ix1, f_chromosome_ix1, f_start1, f_end1),
-                     (pos2, r_strand2, f_ix2, f_chromosome_ix2, f_start2, f_end2))
-                )
-            except (KeyError, IndexError):
-                skipped_counter += 1
-        logger.debug("Worker {} skipped {} pairs".format(worker_uuid, skipped_counter))
-        output_queue.put(msgpack.dumps(fragment_infos))
-        del read_pairs
+    fragments_shm, fragments = attached_array(fragments_descriptor)
 
+    while True:
+        logger.debug("Worker {} waiting for input".format(worker_uuid))
+        input_data = input_queue.get(True)
+        if input_data is None:
+            output_queue.put(None)
+            break
+
+        try:
+            read_slot, n_reads = input_data
+            logger.debug('Worker {} reveived input!'.format(worker_uuid))
+            pairs = _fragment_info_pairs(read_slots.slot(read_slot, n_reads), fragments, chromosomes)
+            read_slots.release(read_slot)
+            logger.debug("Worker {} skipped {} pairs".format(worker_uuid, n_reads - len(pairs)))
+            for slot, n in pair_slots.put(pairs):
+                output_queue.put((slot, n))
+            del pairs
+        except Exception as e:
+            output_queue.put(e)
+            break
 
-def _read_pairs_worker(read_pairs, input_queue, monitor, batch_size=100000):
+
+def _read_pairs_worker(read_pairs, input_queue, output_queue, read_slots, chromosome_to_ix,
+                       n_workers, batch_size=100000, abort=None):
     """
     Worker to distribute incoming read pairs to fragment info workers.
 
     :param read_pairs: Iterator of read tuples (read1, read2)
-    :param input_queue: Input queue for read pairs
-    :param monitor: :class:`~Monitor`
+    :param input_queue: Input queue for read pair slots
+    :param output_queue: Output queue of the fragment info workers,
+                         used to report exceptions
+    :param read_slots: :class:`~fanc.tools.general.SharedArraySlots` with read pair dtype
+    :param chromosome_to_ix: dict mapping chromosome names to chromosome index
+    :param n_workers: Number of fragment info workers
     :param batch_size: Number of read pairs sent to each worker
+    :param abort: Optional :class:`threading.Event` that stops the worker
+                  when set, e.g. because the workers have been terminated
     """
     logger.debug("Starting read pairs worker")
     try:
-        read_pairs_batch = []
-        for read1, read2 in read_pairs:
-            read_pairs_batch.append((
-                (read1.reference_name, read1.pos, read1.flag),
-                (read2.reference_name, read2.pos, read2.flag)
-            ))
-            if len(read_pairs_batch) >= batch_size:
-                logger.debug("Submitting read pair batch ({}) to input queue".format(batch_size))
-                input_queue.put(msgpack.dumps(read_pairs_batch))
-                read_pairs_batch = []
-                monitor.increment()
-        if len(read_pairs_batch) > 0:
-            logger.debug("Submitting read pair batch ({}) to input queue".format(batch_size))
-            input_queue.put(msgpack.dumps(read_pairs_batch))
-            monitor.increment()
+        for reads in _read_pair_records(read_pairs, chromosome_to_ix, min(batch_size, read_slots.slot_size)):
+            logger.debug("Submitting read pair batch ({}) to input queue".format(len(reads)))
+            for slot, n in read_slots.put(reads, abort=abort):
+                input_queue.put((slot, n))
+            if abort is not None and abort.is_set():
+                break
+    except Exception as e:
+        output_queue.put(e)
     finally:
-        monitor.set_generating_pairs(False)
+        for _ in range(n_workers):
+            input_queue.put(None)
     logger.debug("Terminating read pairs worker")
 
 
+def _partition_region_ranges(partition_breaks, n_regions):
+    """
+    First and last region index of each partition.
+
+    :return: list of (start, end) tuples, both inclusive
+    """
+    starts = [0] + list(partition_breaks)
+    ends = [b - 1 for b in partition_breaks] + [n_regions - 1]
+    return list(zip(starts, ends))
+
+
+class _ReadPairBinner(object):
+    """
+    Assign read positions to equidistant bins.
+
+    Bins are identical to those of :func:`~fanc.hic.Hic.bin`.
+
+    :param chromosomes: list of chromosome names, in region order
+    :param chromosome_lengths: dict with chromosome name: length
+    :param chromosome_to_ix: dict mapping chromosome names to chromosome index
+    :param bin_size: Bin size in base pairs
+    """
+    def __init__(self, chromosomes, chromosome_lengths, chromosome_to_ix, bin_size):
+        self.bin_size = bin_size
+
+        genome = Genome(chromosomes=[Chromosome(name=chromosome, length=chromosome_lengths[chromosome])
+                                     for chromosome in chromosomes])
+        self.regions = genome.get_regions(bin_size)
+        genome.close()
+
+        chromosome_bins = defaultdict(int)
+        for region in self.regions.regions(lazy=True):
+            chromosome_bins[region.chromosome] += 1
+
+        n_chromosomes = max(chromosome_to_ix.values()) + 1 if len(chromosome_to_ix) > 0 else 0
+        self._offsets = np.zeros(n_chromosomes, dtype=np.int64)
+        self._n_bins = np.ones(n_chromosomes, dtype=np.int64)
+        offset = 0
+        for chromosome in chromosomes:
+            chromosome_ix = chromosome_to_ix[chromosome]
+            self._offsets[chromosome_ix] = offset
+            self._n_bins[chromosome_ix] = chromosome_bins[chromosome]
+            offset += chromosome_bins[chromosome]
+
+    def bins(self, chromosome_ixs, positions):
+        """
+        Bin index of each (0-based) position.
+
+        :param chromosome_ixs: array of chromosome indexes
+        :param positions: array of positions
+        :return: array of bin indexes
+        """
+        chromosome_ixs = np.asarray(chromosome_ixs, dtype=np.int64)
+        positions = np.asarray(positions, dtype=np.int64)
+        return self._offsets[chromosome_ixs] + np.minimum(positions // self.bin_size,
+                                                          self._n_bins[chromosome_ixs] - 1)
+
+    def pair_bins(self, rows):
+        """
+        Bin indexes of left and right read of each pair.
+
+        :param rows: structured array of pair table rows, or dict of
+                     pair table column arrays
+        :return: tuple (source bins, sink bins) with source <= sink
+        """
+        left_bins = self.bins(rows['left_fragment_chromosome'], rows['left_read_position'])
+        right_bins = self.bins(rows['right_fragment_chromosome'], rows['right_read_position'])
+        return np.minimum(left_bins, right_bins), np.maximum(left_bins, right_bins)
+
+
+class _PartitionedEdgeCounts(object):
+    """
+    Count edges of a :class:`~fanc.hic.Hic` object by partition.
+
+    Counts of every chunk are kept as a sorted run of packed edge keys.
+    The runs of a partition are combined in a single k-way merge when
+    the partition is written to the Hi-C edge table.
+
+    :param hic: :class:`~fanc.hic.Hic` object with regions
+    """
+    def __init__(self, hic):
+        self.hic = hic
+        self._partition_breaks = np.array(hic._partition_breaks, dtype=np.int64)
+        self._n_partitions = len(self._partition_breaks) + 1
+        self._counts = dict()
+
+    def partitions(self, source_range, sink_range):
+        """
+        Partitions that can contain edges between two region ranges.
+
+        :param source_range: tuple (first, last) region index
+        :param sink_range: tuple (first, last) region index
+        :return: set of (source partition, sink partition) tuples
+        """
+        partitions = set()
+        for range1, range2 in ((source_range, sink_range), (sink_range, source_range)):
+            for partition1 in range(self.hic._get_partition_ix(range1[0]),
+                                    self.hic._get_partition_ix(range1[1]) + 1):
+                for partition2 in range(max(partition1, self.hic._get_partition_ix(range2[0])),
+                                        self.hic._get_partition_ix(range2[1]) + 1):
+                    partitions.add((partition1, partition2))
+        return partitions
+
+    def add(self, source, sink):
+        """
+        Count edges.
+
+        :param source: array of source region indexes
+        :param sink: array of sink region indexes, not smaller than source
+        """
+        keys = _pack_edge_keys(source, sink)
+        partition_keys = np.searchsorted(self._partition_breaks, source, side='right') * self._n_partitions + \
+            np.searchsorted(self._partition_breaks, sink, side='right')
+        for partition_key in np.unique(partition_keys).tolist():
+            partition = divmod(partition_key, self._n_partitions)
+            chunk_keys, chunk_counts = np.unique(keys[partition_keys == partition_key],
+                                                 return_counts=True)
+            self._counts.setdefault(partition, []).append((chunk_keys, chunk_counts))
+
+    def write(self, partition, chunk_size=1000000):
+        """
+        Append the counts of a partition to the Hi-C object and free them.
+
+        :param partition: tuple (source partition, sink partition)
+        :param chunk_size: Approximate number of edges merged and appended at once
+        """
+        if partition not in self._counts:
+            return
+
+        runs = self._counts.pop(partition)
+        run_chunk_size = max(1, chunk_size // len(runs))
+        hic_edge_table = self.hic._edge_table(partition[0], partition[1])
+        for keys, counts in _sum_sorted_runs([_array_chunks(run, run_chunk_size) for run in runs]):
+            edges = np.empty(len(keys), dtype=hic_edge_table.dtype)
+            for name in hic_edge_table.colnames:
+                edges[name] = hic_edge_table.coldflts[name]
+            edges['source'], edges['sink'] = _unpack_edge_keys(keys)
+            edges[self.hic._default_score_field] = counts
+            hic_edge_table.append(edges)
+        hic_edge_table.flush(update_index=False)
+
+
 class MinimalRead(object):
     """
     Minimal class representing an aligned read.
@@ -1260,6 +1546,9 @@ class ReadPairs(RegionPairsTable):
         """
         Parallel loading of read pairs along with mapping to restriction fragments.
 
+        Read pairs and their fragment info are passed to and from the
+        workers in shared memory slots of fixed-size records.
+
         :param read_pairs: iterator of read pairs, typically
                            from a :class:`~ReadPairGenerator`
         :param threads: Number of threads used for parallel
@@ -1268,51 +1557,73 @@ class ReadPairs(RegionPairsTable):
         :param timeout: Time to wait for reply of first worker. If this
                         threshold is exceeded before any read pairs have been
                         returned, a warning is displayed.
+        :return: iterator over structured arrays of read pairs. Arrays are
+                 only valid until the next iteration
         """
-        fragment_infos = defaultdict(list)
-        fragment_ends = defaultdict(list)
-        for region in self.regions(lazy=True):
-            chromosome = region.chromosome
-            fragment_infos[chromosome].append((region.ix, self._chromosome_to_ix[chromosome],
-                                               region.start, region.end))
-            fragment_ends[chromosome].append(region.end)
+        fragments, chromosomes = _fragment_info_arrays(self.regions(lazy=True),
+                                                       self._chromosome_to_ix)
+        fragments_shm, fragments_descriptor = share_array(fragments)
+        del fragments
+
+        context = mp.get_context("spawn")
+        slot_size = min(batch_size, _shared_slot_size)
+        read_slots = SharedArraySlots(2 * threads, slot_size, _read_pair_dtype, context=context)
+        pair_slots = SharedArraySlots(2 * threads, slot_size, _pair_dtype, context=context)
+        input_queue = context.Queue()
+        output_queue = context.Queue()
 
         worker_pool = None
         t_pairs = None
+        abort = threading.Event()
         try:
-            manager = mp.Manager()
-            monitor = Monitor(manager=manager)
-            input_queue = manager.Queue(maxsize=2*threads)
-            output_queue = manager.Queue(maxsize=2*threads)
-
-            monitor.set_generating_pairs(True)
-            t_pairs = threading.Thread(target=_read_pairs_worker, args=(read_pairs, input_queue,
-                                                                        monitor, batch_size))
+            t_pairs = threading.Thread(target=_read_pairs_worker, args=(read_pairs, input_queue, output_queue,
+                                                                        read_slots, self._chromosome_to_ix,
+                                                                        threads, batch_size, abort))
             t_pairs.daemon = True
             t_pairs.start()
 
             logger.debug("Launching fragment info workers")
-            with mp.get_context("spawn").Pool(threads, _fragment_info_worker,
-                                              (monitor, input_queue, output_queue,
-                                               fragment_infos, fragment_ends)) as worker_pool:
-                output_counter = 0
-                while output_counter < monitor.value() or not monitor.workers_idle() or monitor.is_generating_pairs():
+            with context.Pool(threads, _fragment_info_worker,
+                              (input_queue, output_queue, read_slots, pair_slots,
+                               fragments_descriptor, chromosomes)) as worker_pool:
+                finished_workers = 0
+                waiting_time = 0
+                while finished_workers < threads:
                     try:
-                        read_pair_infos = output_queue.get(block=True, timeout=timeout)
-
-                        for read1_info, read2_info in msgpack.loads(read_pair_infos, strict_map_key=False):
-                            yield read1_info, read2_info
-                        output_counter += 1
-                        del read_pair_infos
+                        output_data = output_queue.get(block=True, timeout=1)
                     except Empty:
-                        logger.warning("Reached SAM pair generator timeout. This could mean that no "
-                                       "valid read pairs were found after filtering. "
-                                       "Check filter settings!")
+                        waiting_time += 1
+                        if waiting_time >= timeout:
+                            logger.warning("Reached SAM pair generator timeout. This could mean that no "
+                                           "valid read pairs were found after filtering. "
+                                           "Check filter settings!")
+                            waiting_time = 0
+                        continue
+                    waiting_time = 0
+
+                    if output_data is None:
+                        finished_workers += 1
+                        continue
+                    if isinstance(output_data, Exception):
+                        raise output_data
+
+                    slot, n = output_data
+                    yield pair_slots.slot(slot, n)
+                    pair_slots.release(slot)
         finally:
+            # stop the producer thread before the workers are gone,
+            # otherwise it waits for free slots forever. It checks for
+            # the abort between slots and must be done before the slots
+            # are closed
+            abort.set()
             if worker_pool is not None:
                 worker_pool.terminate()
             if t_pairs is not None:
                 t_pairs.join()
+            read_slots.close()
+            pair_slots.close()
+            fragments_shm.close()
+            fragments_shm.unlink()
 
     def _add_infos(self, fi1, fi2):
         r_pos1, r_strand1, f_ix1, f_chromosome_ix1, f_start1, f_end1 = fi1
@@ -1333,6 +1644,20 @@ class ReadPairs(RegionPairsTable):
 
         self._add_pair(edge)
 
+    def _add_pair_array(self, pairs):
+        """
+        Add a structured array of pairs from :func:`~_fragment_info_pairs`.
+
+        Assigns consecutive pair indexes and sends the pairs to the edge buffer.
+        """
+        if self._pair_count is None:
+            self._pair_count = sum(edge_table._original_len()
+                                   for _, edge_table in self._iter_edge_tables())
+
+        pairs['ix'] = np.arange(self._pair_count, self._pair_count + len(pairs))
+        self._edge_buffer.add_array(pairs)
+        self._pair_count += len(pairs)
+
     def _default_edge_list(self):
         record = [None] * len(self._field_names_dict)
         for name, ix in self._field_names_dict.items():
@@ -1384,83 +1709,92 @@ class ReadPairs(RegionPairsTable):
         self._edges_dirty = True
         self._disable_edge_indexes()
 
-        fragment_infos = defaultdict(list)
-        fragment_ends = defaultdict(list)
-        for region in self.regions(lazy=True):
-            chromosome = region.chromosome
-            fragment_infos[chromosome].append((region.ix, self._chromosome_to_ix[chromosome],
-                                               region.start, region.end))
-            fragment_ends[chromosome].append(region.end)
+        fragments, chromosomes = _fragment_info_arrays(self.regions(lazy=True),
+                                                       self._chromosome_to_ix)
+        fragments_shm, fragments_descriptor = share_array(fragments)
+        del fragments
 
         if tmpdir is None:
             split_tmpdir = tempfile.mkdtemp()
-            pairs_tmpdir = tempfile.mkdtemp()
         else:
             split_tmpdir = tempfile.mkdtemp(dir=tmpdir)
-            pairs_tmpdir = tempfile.mkdtemp(dir=tmpdir)
+
+        context = mp.get_context("spawn")
+        pair_slots = SharedArraySlots(2 * threads, min(batch_size, _shared_slot_size), _pair_dtype,
+                                      context=context)
+        input_file_queue = context.Queue(maxsize=threads * 3)
+        output_queue = context.Queue()
 
         worker_pool = None
         t_split = None
+        abort = threading.Event()
         all_stats = defaultdict(int)
+        cumulative_wait_time = 0
+        cumulative_load_time = 0
         try:
-            queue_manager = mp.Manager()
-            input_file_queue = queue_manager.Queue(maxsize=threads * 3)
-            output_file_queue = queue_manager.Queue(maxsize=threads * 3)
-
-            monitor = Monitor(manager=queue_manager)
-            monitor.set_generating_pairs(True)
             t_split = threading.Thread(target=_split_sam_worker, args=(sam_file1, sam_file2,
                                                                        input_file_queue,
-                                                                       monitor, batch_size,
+                                                                       threads, batch_size,
                                                                        split_tmpdir,
-                                                                       check_sorted))
+                                                                       check_sorted, abort))
             t_split.daemon = True
             logger.debug("Launching SAM splitting thread")
             t_split.start()
 
             logger.debug("Launching _load_paired_sam_worker workers")
-            with mp.get_context("spawn").Pool(threads, _load_paired_sam_worker,
-                                             (monitor, input_file_queue, output_file_queue,
-                                              fragment_infos, fragment_ends, self._partition_breaks,
-                                              read_filters, pairs_tmpdir)) as worker_pool:
+            with context.Pool(threads, _load_paired_sam_worker,
+                              (input_file_queue, output_queue, pair_slots,
+                               fragments_descriptor, chromosomes, self._chromosome_to_ix,
+                               read_filters)) as worker_pool:
                 logger.debug("Done launching _load_paired_sam_worker workers")
 
-                output_counter = 0
-                cumulative_wait_time = 0
-                cumulative_load_time = 0
-                while output_counter < monitor.value() or not monitor.workers_idle() or monitor.is_generating_pairs():
+                finished_workers = 0
+                waiting_time = 0
+                while finished_workers < threads:
+                    s = datetime.now()
                     try:
-                        logger.debug("SAM output collection counter: {}".format(output_counter))
-                        s = datetime.now()
-                        output_data = output_file_queue.get(block=True)
-                        if isinstance(output_data, Exception):
-                            raise output_data
-                        input_file, read_pairs_file, chunk_stats = output_data
-                        w = datetime.now() - s
-                        logger.debug("Wait time: {}".format(w))
-                        cumulative_wait_time += w.total_seconds()
-
-                        s = datetime.now()
+                        output_data = output_queue.get(block=True, timeout=1)
+                    except Empty:
+                        waiting_time += 1
+                        if waiting_time >= 600:
+                            logger.warning("Reached SAM pair generator timeout. This could mean that no "
+                                           "valid read pairs were found after filtering. "
+                                           "Check filter settings!")
+                            waiting_time = 0
+                        continue
+                    waiting_time = 0
+                    cumulative_wait_time += (datetime.now() - s).total_seconds()
+
+                    if output_data is None:
+                        finished_workers += 1
+                        continue
+                    if isinstance(output_data, Exception):
+                        raise output_data
+
+                    s = datetime.now()
+                    slot, n, info = output_data
+                    if slot is not None:
+                        self._add_pair_array(pair_slots.slot(slot, n))
+                        pair_slots.release(slot)
+                    if info is not None:
+                        input_file, chunk_stats = info
+                        logger.debug("Done loading {}".format(input_file))
                         os.remove(input_file)
-                        self.load_read_pairs_fragment_info_file(read_pairs_file)
-                        os.remove(read_pairs_file)
                         for key, value in chunk_stats.items():
                             all_stats[key] += value
-                        output_counter += 1
-                        l = datetime.now() - s
-                        logger.debug("Load time: {}".format(l))
-                        cumulative_load_time += l.total_seconds()
-                    except Empty:
-                        logger.warning("Reached SAM pair generator timeout. This could mean that no "
-                                       "valid read pairs were found after filtering. "
-                                       "Check filter settings!")
+                    cumulative_load_time += (datetime.now() - s).total_seconds()
         finally:
+            # stop the splitting thread before the workers are gone,
+            # otherwise it waits for space in the input queue forever
+            abort.set()
             if worker_pool is not None:
                 worker_pool.terminate()
             if t_split is not None:
                 t_split.join()
             shutil.rmtree(split_tmpdir)
-            shutil.rmtree(pairs_tmpdir)
+            pair_slots.close()
+            fragments_shm.close()
+            fragments_shm.unlink()
 
         logger.debug('Cumulative: {} wait, {} load'.format(cumulative_wait_time, cumulative_load_time))
 
@@ -1502,31 +1836,8 @@ class ReadPairs(RegionPairsTable):
         self._edges_dirty = True
         self._disable_edge_indexes()
 
-        if self._pair_count is None:
-            self._pair_count = sum(edge_table._original_len()
-                                   for _, edge_table in self._iter_edge_tables())
-
-        start_time = timer()
-        chunk_start_time = timer()
-        pairs_counter = 0
-        edge = {}
-        for fi1, fi2 in self._read_pairs_fragment_info(read_pairs, batch_size=batch_size, threads=threads):
-            source, sink = int(fi1[2]), int(fi2[2])
-            if source > sink:
-                source, sink = sink, source
-                fi1, fi2 = fi2, fi1
-
-            edge['ix'] = self._pair_count
-            edge['source'] = source
-            edge['sink'] = sink
-            edge['left_read_position'], edge['right_read_position'] = int(fi1[0]), int(fi2[0])
-            edge['left_read_strand'], edge['right_read_strand'] = fi1[1], fi2[1]
-            edge['left_fragment_start'], edge['right_fragment_start'] = int(fi1[4]), int(fi2[4])
-            edge['left_fragment_end'], edge['right_fragment_end'] = int(fi1[5]), int(fi2[5])
-            edge['left_fragment_chromosome'], edge['right_fragment_chromosome'] = int(fi1[3]), int(fi2[3])
-
-            self._edge_buffer.add_dict(edge)
-            self._pair_count += 1
+        for pairs in self._read_pairs_fragment_info(read_pairs, batch_size=batch_size, threads=threads):
+            self._add_pair_array(pairs)
 
         logger.info('Done saving read pairs.')
 
@@ -1707,7 +2018,11 @@ class ReadPairs(RegionPairsTable):
             return int(dists[which_valid_indices[0]])
         return None
 
-    def filter(self, pair_filter, queue=False, log_progress=not config.hide_progressbars):
+    def _prepare_filter(self, mask_filter):
+        if isinstance(mask_filter, FragmentReadPairFilter):
+            mask_filter.set_pairs_object(self)
+
+    def filter(self, pair_filter, queue=False, log_progress=not config.hide_progressbars, threads=1):
         """
         Apply a :class:`~FragmentReadPairFilter` to the read pairs in this object.
 
@@ -1716,55 +2031,32 @@ class ReadPairs(RegionPairsTable):
                       queues this filter. All queued filters can then be run
                       at the same time using :func:`~ReadPairs.run_queued_filters`
         :param log_progress:
-        :return:
+        :param threads: Number of processes used to filter the pair tables
+                        in parallel. Requires a file-based object.
+        :return: dict with mask statistics if the filter is not queued
         """
         pair_filter.set_pairs_object(self)
 
-        total = 0
-        filtered = 0
         if not queue:
-            with RareUpdateProgressBar(max_value=sum(1 for _ in self._edges),
-                                       silent=not log_progress,
-                                       prefix="Filter") as pb:
-                for i, (_, edge_table) in enumerate(self._iter_edge_tables()):
-                    stats = edge_table.filter(pair_filter, _logging=False)
-                    for key, value in stats.items():
-                        if key != 0:
-                            filtered += stats[key]
-                        total += stats[key]
-                    pb.update(i)
-            if log_progress:
-                logger.debug("Total: {}. Valid: {}".format(total, total - filtered))
+            return self._run_filters([pair_filter], threads=threads, log_progress=log_progress)
         else:
             self._queued_filters.append(pair_filter)
 
-    def run_queued_filters(self, log_progress=not config.hide_progressbars):
+    def run_queued_filters(self, log_progress=not config.hide_progressbars, threads=1):
         """
         Run queued filters. See :func:`~ReadPairs.filter`
 
         :param log_progress: If true, process iterating through all edges
                              will be continuously reported.
+        :param threads: Number of processes used to filter the pair tables
+                        in parallel. Requires a file-based object.
+        :return: dict with mask statistics
         """
-        total = 0
-        filtered = 0
-        with RareUpdateProgressBar(max_value=sum(1 for _ in self._edges),
-                                   silent=not log_progress,
-                                   prefix="Filter") as pb:
-            for i, (_, edge_table) in enumerate(self._iter_edge_tables()):
-                for f in self._queued_filters:
-                    edge_table.queue_filter(f)
-
-                stats = edge_table.run_queued_filters(_logging=False)
-                for key, value in stats.items():
-                    if key != 0:
-                        filtered += stats[key]
-                    total += stats[key]
-                pb.update(i)
-        if log_progress:
-            logger.info("Total: {}. Valid: {}".format(total, total - filtered))
+        stats = self._run_filters(self._queued_filters, threads=threads, log_progress=log_progress)
 
         self._queued_filters = []
         self._update_mappability()
+        return stats
 
     def filter_pcr_duplicates(self, threshold=3, queue=False):
         """
@@ -1962,49 +2254,126 @@ class ReadPairs(RegionPairsTable):
             l += len(edge_table)
         return l
 
-    def to_hic(self, file_name=None, tmpdir=None, _hic_class=Hic):
+    def to_hic(self, file_name=None, tmpdir=None, bin_size=None, chunk_size=1000000, _hic_class=Hic):
         """
         Convert this :class:`~ReadPairs` to a :class:`~fanc.Hic` object.
 
-        :param file_name: Path to the :class:`~fanc.Hic` output file
+        Valid pairs are read in chunks and counted per Hi-C partition.
+        A partition is written as soon as all pair tables that can
+        contribute to it have been processed, so memory use is bounded
+        by the number of distinct edges in a partition.
+
+        If one or more bin sizes are provided, the read positions of
+        each pair are assigned directly to equidistant bins, and all
+        resolutions are counted in a single pass over the pairs without
+        constructing a fragment-level matrix. Note that this differs
+        slightly from :func:`~fanc.hic.Hic.bin` of a fragment-level
+        matrix, which distributes contacts of fragments spanning
+        bin borders across bins.
+
+        :param file_name: Path to the :class:`~fanc.Hic` output file.
+                          List of paths if bin_size is a list.
         :param tmpdir: If True (or path to temporary directory) will
                        work in temporary directory until closed
-        """
-        hic = _hic_class(file_name=file_name, mode='w', tmpdir=tmpdir)
-        hic.add_regions(self.regions(), preserve_attributes=False)
-
-        hic._disable_edge_indexes()
+        :param bin_size: Bin size in base pairs, or list of bin sizes.
+                         If None (default), the matrix is constructed
+                         on restriction fragment level
+        :param chunk_size: Number of pairs read at once
+        :return: :class:`~fanc.Hic`, or list of :class:`~fanc.Hic`
+                 if bin_size is a list
+        """
+        if isinstance(bin_size, (list, tuple)):
+            bin_sizes = list(bin_size)
+            file_names = [None] * len(bin_sizes) if file_name is None else list(file_name)
+            if len(file_names) != len(bin_sizes):
+                raise ValueError("Must provide one file name per bin size!")
+        else:
+            bin_sizes = [bin_size]
+            file_names = [file_name]
+
+        n_regions = len(self.regions)
+        fragments, _ = _fragment_info_arrays(self.regions(lazy=True), self._chromosome_to_ix)
+        chromosomes = self.chromosomes()
+        chromosome_lengths = self.chromosome_lengths
+
+        # region index ranges of each output for every pair table
+        pairs_edge_tables = list(self._iter_edge_tables())
+        pairs_partition_ranges = _partition_region_ranges(self._partition_breaks, n_regions)
+
+        outputs = []
+        for output_bin_size, output_file_name in zip(bin_sizes, file_names):
+            hic = _hic_class(file_name=output_file_name, mode='w', tmpdir=tmpdir)
+            if output_bin_size is None:
+                binner = None
+                hic.add_regions(self.regions(), preserve_attributes=False)
+                first_region_ixs = last_region_ixs = np.arange(n_regions)
+            else:
+                binner = _ReadPairBinner(chromosomes, chromosome_lengths,
+                                         self._chromosome_to_ix, output_bin_size)
+                hic.add_regions(binner.regions.regions(lazy=True), preserve_attributes=False)
+                binner.regions.close()
+                first_region_ixs = binner.bins(fragments['chromosome'], fragments['start'] - 1)
+                last_region_ixs = binner.bins(fragments['chromosome'], fragments['end'] - 1)
+            hic._disable_edge_indexes()
+            counts = _PartitionedEdgeCounts(hic)
+
+            # Hi-C partitions that are complete after each pair table
+            last_pairs_table = dict()
+            for i, ((source_partition, sink_partition), _) in enumerate(pairs_edge_tables):
+                source_start, source_end = pairs_partition_ranges[source_partition]
+                sink_start, sink_end = pairs_partition_ranges[sink_partition]
+                for hic_partition in counts.partitions(
+                        (first_region_ixs[source_start], last_region_ixs[source_end]),
+                        (first_region_ixs[sink_start], last_region_ixs[sink_end])):
+                    last_pairs_table[hic_partition] = i
+            completed_partitions = defaultdict(list)
+            for hic_partition, i in viewitems(last_pairs_table):
+                completed_partitions[i].append(hic_partition)
+
+            outputs.append((binner, counts, completed_partitions))
+
+        # only read the columns required for counting
+        fields = ['source', 'sink']
+        if any(binner is not None for binner, _, _ in outputs):
+            fields += ['left_fragment_chromosome', 'left_read_position',
+                       'right_fragment_chromosome', 'right_read_position']
 
         n_pairs = len(self)
         pairs_counter = 0
         with RareUpdateProgressBar(max_value=n_pairs, silent=config.hide_progressbars,
                                    prefix="Hi-C convert") as pb:
-            for _, pairs_edge_table in self._iter_edge_tables():
-
-                partition_edge_buffer = defaultdict(lambda: defaultdict(int))
-                for row in pairs_edge_table:
-                    key = (row['source'], row['sink'])
-                    source_partition = self._get_partition_ix(key[0])
-                    sink_partition = self._get_partition_ix(key[1])
-                    partition_edge_buffer[(source_partition, sink_partition)][key] += 1
+            for i, (_, pairs_edge_table) in enumerate(pairs_edge_tables):
+                n_rows = pairs_edge_table._original_len()
+                for start in range(0, n_rows, chunk_size):
+                    stop = min(n_rows, start + chunk_size)
+                    is_valid = pairs_edge_table.read(start, stop, field=pairs_edge_table._mask_field) == 0
+                    n_valid = int(is_valid.sum())
+                    if n_valid == 0:
+                        continue
+                    columns = {field: pairs_edge_table.read(start, stop, field=field)[is_valid]
+                               for field in fields}
+
+                    for binner, counts, _ in outputs:
+                        if binner is None:
+                            counts.add(columns['source'], columns['sink'])
+                        else:
+                            counts.add(*binner.pair_bins(columns))
+                    pairs_counter += n_valid
                     pb.update(pairs_counter)
-                    pairs_counter += 1
 
-                for hic_partition_key, edge_buffer in viewitems(partition_edge_buffer):
-                    hic_edge_table = hic._edge_table(hic_partition_key[0], hic_partition_key[1])
-                    row = hic_edge_table.row
+                for _, counts, completed_partitions in outputs:
+                    for hic_partition in sorted(completed_partitions[i]):
+                        counts.write(hic_partition, chunk_size=chunk_size)
 
-                    for (source, sink), weight in viewitems(edge_buffer):
-                        row['source'] = source
-                        row['sink'] = sink
-                        row[hic._default_score_field] = float(weight)
-                        row.append()
-                    hic_edge_table.flush(update_index=False)
-        hic.flush()
+        hics = []
+        for _, counts, _ in outputs:
+            counts.hic.flush()
+            counts.hic._enable_edge_indexes()
+            hics.append(counts.hic)
 
-        hic._enable_edge_indexes()
-
-        return hic
+        if isinstance(bin_size, (list, tuple)):
+            return hics
+        return hics[0]
 
     def pairs_by_chromosomes(self, chromosome1, chromosome2, **kwargs):
         """
@@ -2414,6 +2783,14 @@ class FragmentReadPairFilter(with_metaclass(ABCMeta, MaskFilter)):
         self.pairs = None
         self._lazy_pair = None
 
+    def __getstate__(self):
+        # the pairs object cannot be pickled, it is
+        # set again by ReadPairs._prepare_filter
+        state = self.__dict__.copy()
+        state['pairs'] = None
+        state['_lazy_pair'] = None
+        return state
+
     def set_pairs_object(self, pairs):
         self.pairs = pairs
         fr1 = LazyFragmentRead({}, pairs, side='left')
@@ -2432,6 +2809,38 @@ class FragmentReadPairFilter(with_metaclass(ABCMeta, MaskFilter)):
         return self.valid_pair(pair)
 
 
+def _same_chromosome_chunk(rows):
+    """
+    Vectorised :func:`~FragmentReadPair.is_same_chromosome` for
+    a structured array of pair rows.
+    """
+    return rows['left_fragment_chromosome'] == rows['right_fragment_chromosome']
+
+
+def _same_fragment_chunk(rows):
+    """
+    Vectorised :func:`~FragmentReadPair.is_same_fragment` for
+    a structured array of pair rows.
+    """
+    return np.logical_and(_same_chromosome_chunk(rows),
+                          rows['left_fragment_start'] == rows['right_fragment_start'])
+
+
+def _gap_size_chunk(rows):
+    """
+    Vectorised :func:`~FragmentReadPair.get_gap_size` for
+    a structured array of pair rows.
+
+    Unlike the pair method, this returns a gap for pairs on
+    different chromosomes, too, so it should always be combined
+    with :func:`~_same_chromosome_chunk`.
+    """
+    gap = rows['right_fragment_start'].astype(np.int64) - rows['left_fragment_end']
+    gap[gap == 1] = 0
+    gap[_same_fragment_chunk(rows)] = 0
+    return gap
+
+
 class InwardPairsFilter(FragmentReadPairFilter):
     """
     Filter inward-facing read pairs at a distance less
@@ -2458,12 +2867,67 @@ class InwardPairsFilter(FragmentReadPairFilter):
             return False
         return True
 
+    def valid_chunk(self, rows):
+        inward = np.logical_and(rows['left_read_strand'] == 1, rows['right_read_strand'] == -1)
+        invalid = np.logical_and(np.logical_and(_same_chromosome_chunk(rows), inward),
+                                 _gap_size_chunk(rows) <= self.minimum_distance)
+        return ~invalid
+
+
+def _duplicate_run_anchors(left_groups, right_groups, left_positions, right_positions, threshold):
+    """
+    Assign sorted pairs to runs of duplicates.
+
+    Pairs must be sorted by group pair (e.g. chromosome or fragment pair)
+    and left read position. A run starts with a pair that is not within the
+    threshold of the first pair of the current run, and contains all
+    following pairs of the same group pair whose read positions are both
+    within the threshold of that first pair.
+
+    :return: numpy array with the index of the first pair of each pair's run
+    """
+    n_pairs = len(left_positions)
+    anchors = np.arange(n_pairs)
+    if n_pairs < 2:
+        return anchors
+
+    # a pair too far from its predecessor can never continue a run,
+    # so runs are resolved in independent blocks, one offset at a time
+    block_start = np.ones(n_pairs, dtype=bool)
+    block_start[1:] = np.logical_or.reduce((
+        left_groups[1:] != left_groups[:-1],
+        right_groups[1:] != right_groups[:-1],
+        left_positions[1:] - left_positions[:-1] > threshold,
+    ))
+    starts = np.flatnonzero(block_start)
+    lengths = np.diff(np.append(starts, n_pairs))
+    order = np.argsort(-lengths, kind='stable')
+    starts, lengths = starts[order], lengths[order]
+
+    current = starts.copy()
+    for offset in range(1, int(lengths[0])):
+        n_active = np.searchsorted(-lengths, -offset, side='left')
+        ixs = starts[:n_active] + offset
+        firsts = current[:n_active]
+        is_duplicate = np.logical_and(np.abs(left_positions[ixs] - left_positions[firsts]) <= threshold,
+                                      np.abs(right_positions[ixs] - right_positions[firsts]) <= threshold)
+        anchors[ixs[is_duplicate]] = firsts[is_duplicate]
+        current[:n_active] = np.where(is_duplicate, firsts, ixs)
+    return anchors
+
 
 class PCRDuplicateFilter(FragmentReadPairFilter):
     """
     Masks alignments that are suspected to be PCR duplicates.
     In order to be considered duplicates, two pairs need to have identical
     start positions of their respective left alignments AND of their right alignments.
+
+    Pairs are sorted by fragment pair, left and right read position. A pair
+    is marked as duplicate if both of its read positions are within the
+    threshold of the first pair of the current run of duplicates. Runs
+    starting close to a fragment end are merged with runs of neighbouring
+    fragments in the same way, so the result does not depend on how pairs
+    are partitioned into tables.
     """
 
     def __init__(self, pairs, threshold=2, mask=None):
@@ -2480,63 +2944,131 @@ class PCRDuplicateFilter(FragmentReadPairFilter):
         FragmentReadPairFilter.__init__(self, mask=mask)
         self.threshold = threshold
         self.pairs = pairs
-        self.duplicates_set = set()
         self.duplicate_stats = defaultdict(int)
+
         original_len = 0
+        max_ix = -1
+        duplicate_ixs = []
+        boundary_runs = []
+        region_arrays = self.pairs._region_arrays()
         for _, edge_table in self.pairs._iter_edge_tables():
             original_len += edge_table._original_len()
-            self._mark_duplicates(edge_table)
-
-        n_dups = len(self.duplicates_set)
-        percent_dups = 1. * n_dups / original_len
+            if edge_table._original_len() == 0:
+                continue
+            table_max_ix, table_duplicate_ixs, table_boundary_runs = self._mark_duplicates(
+                edge_table, region_arrays
+            )
+            max_ix = max(max_ix, table_max_ix)
+            duplicate_ixs.append(table_duplicate_ixs)
+            boundary_runs.append(table_boundary_runs)
+
+        if len(boundary_runs) > 0:
+            duplicate_ixs.append(self._merge_boundary_runs(np.concatenate(boundary_runs)))
+
+        self.duplicates = np.zeros(max_ix + 1, dtype=bool)
+        for ixs in duplicate_ixs:
+            self.duplicates[ixs] = True
+
+        n_dups = int(np.sum(self.duplicates))
+        percent_dups = 1. * n_dups / original_len if original_len > 0 else 0.
         logger.info("PCR duplicate stats: " +
                     "{} ({:.1%}) of pairs marked as duplicate. ".format(n_dups, percent_dups) +
                     " (multiplicity:occurances) " +
-                    " ".join("{}:{}".format(k, v) for k, v in self.duplicate_stats.items()))
-
-    def _mark_duplicates(self, edge_table):
-        pairs = [
-            (
-                row['ix'],
-                row['left_fragment_chromosome'], row['right_fragment_chromosome'],
-                row['left_read_position'], row['right_read_position']
-             ) for row in edge_table._iter_visible_and_masked()
-        ]
-        pairs = sorted(pairs, key=lambda p: p[3])
-
-        current_positions = {}
-        current_duplicates = {}
-        for ix, left_chromosome, right_chromosome, left_position, right_position in pairs:
-            chromosomes = (left_chromosome, right_chromosome)
-
-            # case 1: no current duplicates
-            if current_positions.get(chromosomes) is None:
-                current_positions[chromosomes] = (left_position, right_position)
-                current_duplicates[chromosomes] = 1
-                continue
-
-            # case 2: found duplicate
-            if (abs(left_position - current_positions[chromosomes][0]) <= self.threshold and
-                    abs(right_position - current_positions[chromosomes][1]) <= self.threshold):
-                self.duplicates_set.add(ix)
-                current_duplicates[chromosomes] += 1
-                continue
-
-            # update statistics
-            if current_duplicates[chromosomes] > 1:
-                self.duplicate_stats[current_duplicates[chromosomes]] += 1
-
-            current_positions[chromosomes] = (left_position, right_position)
-            current_duplicates[chromosomes] = 1
+                    " ".join("{}:{}".format(k, v) for k, v in sorted(self.duplicate_stats.items())))
+
+    def _update_duplicate_stats(self, multiplicities):
+        multiplicities, counts = np.unique(multiplicities[multiplicities > 1], return_counts=True)
+        for multiplicity, count in zip(multiplicities.tolist(), counts.tolist()):
+            self.duplicate_stats[multiplicity] += count
+
+    def _mark_duplicates(self, edge_table, region_arrays):
+        """
+        Find runs of duplicates in a single pair table.
+
+        Runs whose first pair lies within the threshold of a fragment end
+        may continue in a neighbouring fragment. They are not counted here,
+        but returned for :func:`~PCRDuplicateFilter._merge_boundary_runs`.
+
+        :param edge_table: pair table
+        :param region_arrays: fragment 'start', 'end' and 'chromosome' arrays
+                              (see :func:`~fanc.regions.RegionsTable._region_arrays`)
+        :return: tuple (largest pair ix, ix of duplicate pairs, boundary runs)
+        """
+        ixs = edge_table.col('ix')
+        sources = edge_table.col('source')
+        sinks = edge_table.col('sink')
+        left_positions = edge_table.col('left_read_position').astype(np.int64)
+        right_positions = edge_table.col('right_read_position').astype(np.int64)
+
+        order = np.lexsort((right_positions, left_positions, sinks, sources))
+        ixs = ixs[order]
+        sources = sources[order]
+        sinks = sinks[order]
+        left_positions = left_positions[order]
+        right_positions = right_positions[order]
+
+        anchors = _duplicate_run_anchors(sources, sinks, left_positions, right_positions, self.threshold)
+        is_anchor = anchors == np.arange(len(anchors))
+        multiplicities = np.bincount(anchors, minlength=len(anchors))
+
+        # runs of different fragment pairs can only match if their
+        # first pairs are on either side of a fragment end
+        fragment_starts, fragment_ends = region_arrays['start'], region_arrays['end']
+        is_boundary = np.logical_and(is_anchor, np.logical_or.reduce((
+            left_positions - fragment_starts[sources] <= self.threshold,
+            fragment_ends[sources] - left_positions <= self.threshold,
+            right_positions - fragment_starts[sinks] <= self.threshold,
+            fragment_ends[sinks] - right_positions <= self.threshold,
+        )))
+        self._update_duplicate_stats(multiplicities[np.logical_and(is_anchor, ~is_boundary)])
+
+        boundary_runs = np.empty(np.count_nonzero(is_boundary),
+                                 dtype=[('ix', np.int64), ('multiplicity', np.int64),
+                                        ('left_chromosome', np.int64), ('right_chromosome', np.int64),
+                                        ('left_position', np.int64), ('right_position', np.int64)])
+        boundary_runs['ix'] = ixs[is_boundary]
+        boundary_runs['multiplicity'] = multiplicities[is_boundary]
+        boundary_runs['left_chromosome'] = region_arrays['chromosome'][sources[is_boundary]]
+        boundary_runs['right_chromosome'] = region_arrays['chromosome'][sinks[is_boundary]]
+        boundary_runs['left_position'] = left_positions[is_boundary]
+        boundary_runs['right_position'] = right_positions[is_boundary]
+
+        return int(np.max(ixs)), ixs[~is_anchor], boundary_runs
+
+    def _merge_boundary_runs(self, boundary_runs):
+        """
+        Merge runs of duplicates that continue across pair tables.
+
+        The first pairs of runs are treated like pairs in a single table:
+        a run becomes part of another if its first pair is a duplicate of
+        that run's first pair.
+
+        :return: ix of the first pairs of merged runs, which are duplicates
+        """
+        boundary_runs = boundary_runs[np.lexsort((boundary_runs['right_position'],
+                                                  boundary_runs['left_position'],
+                                                  boundary_runs['right_chromosome'],
+                                                  boundary_runs['left_chromosome']))]
+        anchors = _duplicate_run_anchors(boundary_runs['left_chromosome'], boundary_runs['right_chromosome'],
+                                         boundary_runs['left_position'], boundary_runs['right_position'],
+                                         self.threshold)
+        is_anchor = anchors == np.arange(len(anchors))
+        multiplicities = np.bincount(anchors, weights=boundary_runs['multiplicity'],
+                                     minlength=len(anchors)).astype(np.int64)
+        self._update_duplicate_stats(multiplicities[is_anchor])
+        return boundary_runs['ix'][~is_anchor]
 
     def valid_pair(self, pair):
         """
         Check if a pair is duplicated.
         """
-        if pair.ix in self.duplicates_set:
+        if self.duplicates[pair.ix]:
             return False
         return True
 
+    def valid_chunk(self, rows):
+        return ~self.duplicates[rows['ix']]
+
 
 class OutwardPairsFilter(FragmentReadPairFilter):
     """
@@ -2564,6 +3096,12 @@ class OutwardPairsFilter(FragmentReadPairFilter):
             return True
         return False
 
+    def valid_chunk(self, rows):
+        outward = np.logical_and(rows['left_read_strand'] == -1, rows['right_read_strand'] == 1)
+        invalid = np.logical_and(np.logical_and(_same_chromosome_chunk(rows), outward),
+                                 _gap_size_chunk(rows) <= self.minimum_distance)
+        return ~invalid
+
 
 class ReDistanceFilter(FragmentReadPairFilter):
     """
@@ -2589,6 +3127,14 @@ class ReDistanceFilter(FragmentReadPairFilter):
 
         return True
 
+    def valid_chunk(self, rows):
+        distances = []
+        for side in ('left', 'right'):
+            position = rows[side + '_read_position'].astype(np.int64)
+            distances.append(np.minimum(np.abs(position - rows[side + '_fragment_start']),
+                                        np.abs(position - rows[side + '_fragment_end'])))
+        return distances[0] + distances[1] <= self.maximum_distance
+
 
 class SelfLigationFilter(FragmentReadPairFilter):
     """
@@ -2606,3 +3152,6 @@ class SelfLigationFilter(FragmentReadPairFilter):
         if pair.is_same_fragment():
             return False
         return True
+
+    def valid_chunk(self, rows):
+        return ~_same_fragment_chunk(rows)
@@ -445,7 +445,8 @@ class RegionsTable(RegionBasedWithBins, FileGroup):
         size = t.Int32Col(pos=4)
 
     def __init__(self, file_name=None, mode='a', tmpdir=None,
-                 additional_fields=None, _table_name_regions='regions'):
+                 additional_fields=None, _table_name_regions='regions',
+                 _meta_group='meta_information'):
         """
         Initialize region table.
 
@@ -466,14 +467,20 @@ class RegionsTable(RegionBasedWithBins, FileGroup):
         :param _table_name_regions: (Internal) name of the HDF5
                                     node that stores data for this
                                     object
+        :param _meta_group: (Internal) name of the HDF5 node
+                            that stores meta information
         """
         self._regions_dirty = False
+        self._region_arrays_cache = None
 
         file_exists = False
-        if file_name is not None and os.path.exists(os.path.expanduser(file_name)):
+        if isinstance(file_name, t.file.File):
+            file_exists = '/' + _table_name_regions in file_name
+        elif file_name is not None and os.path.exists(os.path.expanduser(file_name)):
             file_exists = True
 
-        FileGroup.__init__(self, _table_name_regions, file_name, mode=mode, tmpdir=tmpdir)
+        FileGroup.__init__(self, _table_name_regions, file_name, mode=mode, tmpdir=tmpdir,
+                           _meta_group=_meta_group)
 
         if file_exists and mode != 'w':
             self._regions = self._group.regions
@@ -569,12 +576,14 @@ class RegionsTable(RegionBasedWithBins, FileGroup):
             self._regions.flush()
             self._update_chromosomes_info()
             self._regions_dirty = False
+            self._region_arrays_cache = None
 
     def flush(self):
         """
         Write buffered data to file.
         """
         self._flush_regions()
+        self._region_arrays_cache = None
 
     def _add_region(self, region, preserve_attributes=True, *args, **kwargs):
         """
@@ -590,6 +599,7 @@ class RegionsTable(RegionBasedWithBins, FileGroup):
         :return: Region index of the added region.
         """
         self._regions_dirty = True
+        self._region_arrays_cache = None
         if self._max_region_ix is None:
             self._max_region_ix = len(self._regions) - 1
         ix = self._max_region_ix + 1
@@ -681,9 +691,86 @@ class RegionsTable(RegionBasedWithBins, FileGroup):
                 row[key] = value[i]
                 row.update()
             self._flush_regions()
+            self._region_arrays_cache = None
 
         return (row[key] for row in self._regions)
 
+    def _region_arrays(self):
+        """
+        Get cached NumPy arrays of basic region attributes.
+
+        The arrays are read from the regions table on first access and
+        discarded whenever regions are added or region data changes.
+
+        :return: dict with region 'start', 'end', and 'chromosome' (index
+                 into 'chromosome_names') arrays, plus 'valid' and 'bias'
+                 if the regions table has these columns. 'sorted' is True
+                 if chromosomes are contiguous and regions are sorted by
+                 start and end within each chromosome, in which case
+                 'chromosome_bounds' holds the first and last + 1 region
+                 index of each chromosome.
+        """
+        self._flush_regions()
+        if self._region_arrays_cache is not None:
+            return self._region_arrays_cache
+
+        arrays = dict()
+        names, first_ix, chromosome_ix = np.unique(self._regions.col('chromosome'),
+                                                   return_index=True, return_inverse=True)
+        order = np.argsort(first_ix)
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        arrays['chromosome'] = rank[chromosome_ix.ravel()]
+        arrays['chromosome_names'] = [names[i].decode() for i in order]
+        arrays['start'] = self._regions.col('start')
+        arrays['end'] = self._regions.col('end')
+        for name in ('valid', 'bias'):
+            if name in self._regions.colnames:
+                arrays[name] = self._regions.col(name)
+
+        same_chromosome = arrays['chromosome'][1:] == arrays['chromosome'][:-1]
+        arrays['sorted'] = bool(np.all(np.diff(arrays['chromosome']) >= 0) and
+                                np.all(np.diff(arrays['start'])[same_chromosome] >= 0) and
+                                np.all(np.diff(arrays['end'])[same_chromosome] >= 0))
+        if arrays['sorted']:
+            bounds = np.searchsorted(arrays['chromosome'], np.arange(len(order) + 1))
+            arrays['chromosome_bounds'] = list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+        self._region_arrays_cache = arrays
+        return arrays
+
+    def _region_ix_range(self, region):
+        """
+        Get the range of region indexes overlapping a genomic region.
+
+        Uses binary search on the cached region arrays.
+
+        :param region: :class:`~GenomicRegion`
+        :return: tuple (first, last + 1) of region indexes, or None if
+                 the range cannot be determined from the cached arrays
+        """
+        if region.chromosome is None:
+            return None
+
+        arrays = self._region_arrays()
+        if not arrays['sorted']:
+            return None
+
+        try:
+            chromosome_ix = arrays['chromosome_names'].index(region.chromosome)
+        except ValueError:
+            return 0, 0
+
+        chromosome_start, chromosome_end = arrays['chromosome_bounds'][chromosome_ix]
+        first, last = chromosome_start, chromosome_end
+        if region.start is not None:
+            first += int(np.searchsorted(arrays['end'][chromosome_start:chromosome_end],
+                                         region.start, side='left'))
+        if region.end is not None:
+            last = chromosome_start + int(np.searchsorted(arrays['start'][chromosome_start:chromosome_end],
+                                                          region.end, side='right'))
+        return first, max(first, last)
+
     def _get_region_ix(self, region):
         """
         Get index from other region properties (chromosome, start, end)
@@ -797,6 +884,12 @@ class RegionsTable(RegionBasedWithBins, FileGroup):
                     k = GenomicRegion.from_string(k)
 
                 query = '('
+                ix_range = self._region_ix_range(k)
+                if ix_range is not None:
+                    for row in self._regions.iterrows(*ix_range):
+                        yield row
+                    continue
+
                 if k.chromosome is not None:
                     query += "(chromosome == b'%s') & " % k.chromosome
                 if k.end is not None:
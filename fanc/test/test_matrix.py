@@ -1,16 +1,21 @@
 import os
+import struct
+import zlib
+from collections import defaultdict, OrderedDict
 import numpy as np
 from fanc.compatibility.cooler import to_cooler
 from genomic_regions import GenomicRegion
-from fanc.matrix import Edge, RegionPairsTable, RegionMatrixTable, RegionMatrix
-from fanc.hic import Hic, _get_overlap_map, _edge_overlap_split_rao, kr_balancing, ice_balancing
+from fanc.matrix import Edge, RegionPairsTable, RegionMatrixTable, RegionMatrix, _balanced_partition_breaks
+from fanc.hic import Hic, _get_overlap_map, _edge_overlap_split_rao, _coarsening_map, kr_balancing, ice_balancing, correct_matrix, \
+    DiagonalFilter, LowCoverageFilter, MultiResolutionHic
 from fanc.regions import Chromosome, Genome
 from fanc.pairs import ReadPairs, SamBamReadPairGenerator
 from fanc.tools.matrix import is_symmetric
-from fanc.compatibility.juicer import JuicerHic
+from fanc.compatibility.juicer import JuicerHic, to_juicer, _decode_block, _juicer_block_worker
 from fanc.compatibility.cooler import CoolerHic
 from fanc.tools.load import load
 import tables
+import scipy.sparse as sp
 import pytest
 
 test_dir = os.path.dirname(os.path.realpath(__file__))
@@ -110,6 +115,28 @@ class RegionMatrixContainerTestFactory:
                               edges_dict[(edge.source, edge.sink)],
                               rtol=1e-03)
 
+    @pytest.mark.parametrize("norm", [True, False])
+    @pytest.mark.parametrize("oe", [True, False])
+    def test_edge_arrays(self, norm, oe):
+        edges_dict = {(e.source, e.sink): e.weight for e in self.matrix.edges(norm=norm, oe=oe, lazy=True)}
+
+        n = 0
+        for source, sink, weight in self.matrix.edge_arrays(norm=norm, oe=oe, chunk_size=1000):
+            assert len(source) == len(sink) == len(weight) <= 1000
+            for i in range(len(source)):
+                assert np.isclose(weight[i], edges_dict[(source[i], sink[i])], equal_nan=True)
+            n += len(source)
+        assert n == len(edges_dict)
+
+    def test_marginals(self):
+        marginals = np.zeros(len(self.matrix.regions))
+        for edge in self.matrix.edges(norm=False, lazy=True):
+            marginals[edge.source] += edge.weight
+            if edge.source != edge.sink:
+                marginals[edge.sink] += edge.weight
+
+        assert np.allclose(self.matrix.marginals(norm=False, masked=False), marginals)
+
 
 class TestHic(RegionMatrixContainerTestFactory):
     def setup_method(self, method):
@@ -129,6 +156,260 @@ class TestJuicer(RegionMatrixContainerTestFactory):
         pass
 
 
+def _write_juicer_test_file(file_name):
+    """
+    Write a minimal .hic (v8) file with a single chr1 matrix at 1kb.
+
+    chr1 has 10 bins, contacts are (0, 0): 5, (1, 3): 2, and (2, 9): 1.
+    The KR vector is 1 everywhere, except for a missing value in bin 4.
+    """
+    def cstr(value):
+        return value.encode() + b'\0'
+
+    header = b'HIC\0' + struct.pack('<i', 8)
+    body = cstr('test') + struct.pack('<i', 1) + cstr('software') + cstr('fanc')
+    body += struct.pack('<i', 3)
+    for name, length in (('All', 15), ('chr1', 10000), ('chr2', 5000)):
+        body += cstr(name) + struct.pack('<i', length)
+    body += struct.pack('<iiii', 2, 1000, 5000, 0)
+
+    matrix_position = len(header) + 8 + len(body)
+    block = struct.pack('<iiibbh', 3, 0, 0, 0, 1, 3)
+    block += struct.pack('<hh', 0, 1) + struct.pack('<hh', 0, 5)
+    block += struct.pack('<hh', 3, 1) + struct.pack('<hh', 1, 2)
+    block += struct.pack('<hh', 9, 1) + struct.pack('<hh', 2, 1)
+    block = zlib.compress(block)
+    matrix = struct.pack('<iii', 1, 1, 1) + cstr('BP') + struct.pack('<iffff', 0, 8, 3, 0, 0)
+    matrix += struct.pack('<iiii', 1000, 10, 1, 1)
+    block_position = matrix_position + len(matrix) + 16
+    matrix += struct.pack('<iqi', 0, block_position, len(block))
+    body += matrix + block
+
+    master_index = len(header) + 8 + len(body)
+    footer = struct.pack('<i', 1) + cstr('1_1') + struct.pack('<qi', matrix_position, len(matrix))
+    footer += struct.pack('<i', 1) + cstr('BP') + struct.pack('<ii', 1000, 3) + struct.pack('<3d', 4, 2, 1)
+    footer += struct.pack('<i', 1) + struct.pack('<id', 1, 2.)
+    footer += struct.pack('<i', 1) + cstr('KR') + cstr('BP') + struct.pack('<ii', 1000, 2) + struct.pack('<2d', 1, 1)
+    footer += struct.pack('<i', 1) + struct.pack('<id', 1, 1.)
+    vector_position = master_index + 4 + len(footer) + 4 + len(cstr('KR')) + 4 + len(cstr('BP')) + 16
+    footer += struct.pack('<i', 1) + cstr('KR') + struct.pack('<i', 1) + cstr('BP')
+    footer += struct.pack('<iqi', 1000, vector_position, 84)
+    footer += struct.pack('<i', 10) + struct.pack('<10d', 1, 1, 1, 1, np.nan, 1, 1, 1, 1, 1)
+
+    with open(file_name, 'wb') as f:
+        f.write(header + struct.pack('<q', master_index) + body + struct.pack('<i', len(footer)) + footer)
+
+
+def _get_random_hic(excluded_regions=()):
+    genome = Genome(chromosomes=[Chromosome(name='chr1', length=9500), Chromosome(name='chr2', length=4000)])
+    regions = genome.get_regions(500)
+    hic = Hic()
+    hic.add_regions(regions.regions)
+    genome.close()
+    regions.close()
+
+    np.random.seed(0)
+    n_regions = len(hic.regions)
+    edges = defaultdict(int)
+    for source, sink in zip(np.random.randint(0, n_regions, 2000), np.random.randint(0, n_regions, 2000)):
+        if source not in excluded_regions and sink not in excluded_regions:
+            edges[(min(source, sink), max(source, sink))] += 1
+    hic.add_edges([(source, sink, weight) for (source, sink), weight in edges.items()])
+    hic.flush()
+    return hic
+
+
+class TestJuicerBlocks:
+    def test_decode_block(self):
+        # sparse rows: row 0 with columns 1 and 3, row 2 with column 0
+        for use_float, weight_format in ((0, '<h'), (1, '<f')):
+            block = struct.pack('<iiibbh', 3, 10, 20, use_float, 1, 2)
+            block += struct.pack('<hh', 0, 2) + struct.pack('<h', 1) + struct.pack(weight_format, 5)
+            block += struct.pack('<h', 3) + struct.pack(weight_format, 7)
+            block += struct.pack('<hh', 2, 1) + struct.pack('<h', 0) + struct.pack(weight_format, 9)
+            x, y, weight = _decode_block(block, 8)
+            assert list(x) == [11, 13, 10]
+            assert list(y) == [20, 20, 22]
+            assert list(weight) == [5, 7, 9]
+
+        # dense, 2 bins wide, with missing values
+        block = struct.pack('<iiibbih', 4, 10, 20, 0, 2, 4, 2) + struct.pack('<4h', 1, -32768, 3, 4)
+        x, y, weight = _decode_block(block, 8)
+        assert list(x) == [10, 10, 11]
+        assert list(y) == [20, 21, 21]
+        assert list(weight) == [1, 3, 4]
+
+        block = struct.pack('<iiibbih', 4, 10, 20, 1, 2, 4, 2) + struct.pack('<4f', 1, np.nan, 3, 4)
+        x, y, weight = _decode_block(block, 8)
+        assert list(x) == [10, 10, 11]
+        assert list(weight) == [1, 3, 4]
+
+        # version 6 records
+        block = struct.pack('<i', 2) + struct.pack('<iif', 1, 2, 0.5) + struct.pack('<iif', 3, 4, 1.5)
+        x, y, weight = _decode_block(block, 6)
+        assert list(x) == [1, 3]
+        assert list(y) == [2, 4]
+        assert list(weight) == [0.5, 1.5]
+
+    def test_block_cache(self, tmpdir):
+        block = zlib.compress(struct.pack('<iiibbih', 4, 0, 0, 0, 2, 4, 2) + struct.pack('<4h', 1, 2, 3, 4))
+        file_name = str(tmpdir.join('blocks.bin'))
+        with open(file_name, 'wb') as f:
+            f.write(block * 3)
+
+        matrix = JuicerHic.__new__(JuicerHic)
+        matrix._block_cache = OrderedDict()
+        matrix._block_cache_bytes = 0
+        # room for two decoded blocks
+        matrix._block_cache_size = 2 * 4 * 24
+
+        with open(file_name, 'rb') as req:
+            for i in (0, 1, 0, 2):
+                x, y, weight = matrix._read_block(req, i * len(block), len(block), version=8)
+                assert list(weight) == [1, 2, 3, 4]
+        assert list(matrix._block_cache.keys()) == [0, 2 * len(block)]
+        assert matrix._block_cache_bytes == 2 * 4 * 24
+
+    def test_index(self, tmpdir):
+        file_name = str(tmpdir.join('test.hic'))
+        _write_juicer_test_file(file_name)
+
+        with JuicerHic(file_name, resolution=1000) as matrix:
+            assert matrix.version == 8
+            assert matrix.resolutions() == ([1000, 5000], [])
+            assert matrix.chromosomes() == ['chr1', 'chr2']
+            assert matrix.chromosome_lengths == {'All': 15, 'chr1': 10000, 'chr2': 5000}
+            assert matrix.juicer_attributes == {'software': 'fanc'}
+            assert np.allclose(matrix.expected_value_vector('chr1', 'NONE'), [2, 1, 0.5])
+            assert np.allclose(matrix.expected_value_vector('chr1', 'KR'), [1, 1])
+            assert np.isnan(matrix.normalisation_vector('chr1')[4])
+
+            m = matrix.matrix(('chr1', 'chr1'), norm=False)
+            assert m[0, 0] == 5
+            assert m[1, 3] == m[3, 1] == 2
+            assert m[2, 9] == 1
+            assert m.sum() == 11
+
+    def test_index_cache(self, tmpdir):
+        file_name = str(tmpdir.join('test.hic'))
+        _write_juicer_test_file(file_name)
+
+        with JuicerHic(file_name, resolution=1000, index_cache=True) as matrix:
+            index = matrix._index
+        assert os.path.exists(file_name + '.fanc_index')
+
+        with JuicerHic(file_name, resolution=1000, index_cache=True) as matrix:
+            assert matrix._read_index_cache() == index
+            assert matrix.resolutions() == ([1000, 5000], [])
+            assert matrix.matrix(('chr1', 'chr1'), norm=False).sum() == 11
+
+        # outdated cache is replaced
+        with open(file_name + '.fanc_index', 'rb') as f:
+            cache = f.read()
+        os.utime(file_name, (0, 0))
+        with JuicerHic(file_name, resolution=1000, index_cache=True) as matrix:
+            assert matrix._index == index
+        with open(file_name + '.fanc_index', 'rb') as f:
+            assert f.read() != cache
+
+
+    def test_encode_block(self):
+        x = np.array([3, 7, 2, 5])
+        y = np.array([10, 10, 12, 12])
+        for weight in (np.array([1., 2., 3., 40000.]), np.array([1., 2., 3., 4.])):
+            decoded_x, decoded_y, decoded_weight = _decode_block(zlib.decompress(_juicer_block_worker((x, y, weight))), 8)
+            assert list(decoded_x) == list(x)
+            assert list(decoded_y) == list(y)
+            assert list(decoded_weight) == list(weight)
+
+    def test_to_juicer(self, tmpdir):
+        hic = _get_random_hic()
+
+        file_name = str(tmpdir.join('test.hic'))
+        to_juicer(hic, file_name, resolutions=[500, 1000]).close()
+
+        for resolution in (500, 1000):
+            binned = hic if resolution == 500 else hic.bin(resolution)
+            with JuicerHic(file_name, resolution=resolution, norm='NONE') as matrix:
+                assert matrix.chromosomes() == ['chr1', 'chr2']
+                assert np.allclose(matrix.matrix(norm=False), binned.matrix(norm=False))
+
+            with JuicerHic(file_name, resolution=resolution, norm='KR') as matrix:
+                m = matrix.matrix(('chr1', 'chr1'))
+                marginals = np.sum(m, axis=0)
+                assert np.allclose(marginals[marginals > 0], marginals[marginals > 0].mean())
+                for normalisation in ('VC', 'VC_SQRT', 'NONE'):
+                    assert len(matrix.expected_value_vector('chr1', normalisation)) == \
+                        len(matrix.normalisation_vector('chr1', normalisation))
+        hic.close()
+
+
+class TestCoolerArrays:
+    def test_array_access(self, tmpdir):
+        hic = _get_random_hic(excluded_regions=(3, 4))
+        ice_balancing(hic)
+
+        cool = to_cooler(hic, str(tmpdir.join('test.cool')), multires=False)
+        assert np.allclose(cool.bias_vector(), hic.bias_vector())
+        assert list(cool.mappable()) == list(hic.mappable())
+        assert cool.chromosome_bins == hic.chromosome_bins
+        assert np.allclose(cool.marginals(norm=False), hic.marginals(norm=False))
+        assert np.allclose(cool.marginals(), hic.marginals())
+        assert np.allclose(cool.matrix(), hic.matrix())
+        assert np.allclose(cool.matrix(('chr2', 'chr1')), hic.matrix(('chr2', 'chr1')))
+        assert np.allclose(cool.matrix(('chr1:2000-6000', 'chr1'), oe=True),
+                           hic.matrix(('chr1:2000-6000', 'chr1'), oe=True))
+        assert np.allclose(cool.expected_values()[0], hic.expected_values()[0])
+
+        edges = sorted((edge.source, edge.sink, edge.weight) for edge in cool.edges(lazy=True, norm=False))
+        assert edges == sorted((edge.source, edge.sink, edge.weight) for edge in hic.edges(lazy=True, norm=False))
+
+        oe_weights = np.concatenate([weight for _, _, weight in cool.edge_arrays(oe=True)])
+        assert np.allclose(np.sort(oe_weights),
+                           np.sort(np.concatenate([weight for _, _, weight in hic.edge_arrays(oe=True)])))
+        cool.close()
+        hic.close()
+
+    def test_to_cooler_streaming(self, tmpdir):
+        hic = _get_random_hic()
+
+        # sorted chunks from the edge tables, and unsorted chunks in reversed chromosome order
+        for chromosomes in (['chr1', 'chr2'], ['chr2', 'chr1']):
+            cool = to_cooler(hic, str(tmpdir.join('test_{}.cool'.format(chromosomes[0]))),
+                             multires=False, chromosomes=chromosomes, chunksize=10)
+            assert cool.chromosomes() == chromosomes
+            for key in (('chr1', 'chr1'), ('chr1', 'chr2'), ('chr2', 'chr2')):
+                assert np.allclose(cool.matrix(key, norm=False), hic.matrix(key, norm=False))
+            cool.close()
+
+    def test_to_cooler_multi_resolution(self, tmpdir):
+        hic = _get_random_hic()
+        mhic = MultiResolutionHic(str(tmpdir.join('test.mhic')), mode='w')
+        mhic.add_hic(hic, 500)
+        mhic.coarsen([1000])
+        ice_balancing(mhic.hic(1000))
+
+        for threads in (1, 2):
+            # threads > 1 exports from worker processes while mhic is open for writing
+            file_name = str(tmpdir.join('test_{}.mcool'.format(threads)))
+            to_cooler(mhic, file_name, resolutions=[1000, 2000], copy_bias=True, threads=threads).close()
+            for resolution in (500, 1000):
+                with CoolerHic(file_name + '::resolutions/{}'.format(resolution)) as cool:
+                    assert np.allclose(cool.matrix(norm=False), mhic.hic(resolution).matrix(norm=False))
+                    assert np.allclose(cool.bias_vector(), mhic.hic(resolution).bias_vector())
+                    # no weights for the matrix that is not normalised in FAN-C
+                    assert ('weight' in cool.bins().columns) == (resolution == 1000)
+
+            # coarsened from the 1kb matrix and balanced by cooler
+            with CoolerHic(file_name + '::resolutions/2000') as cool:
+                binned = mhic.hic(1000).bin(2000)
+                assert np.allclose(cool.matrix(norm=False), binned.matrix(norm=False))
+                assert 'weight' in cool.bins().columns
+                binned.close()
+        mhic.close()
+        hic.close()
+
+
 class TestCooler(RegionMatrixContainerTestFactory):
     def setup_method(self, method):
         hic_file = os.path.join(test_dir, 'test_matrix', 'test_cooler.hic')
@@ -468,6 +749,68 @@ class TestHicBasic:
         edges = list(self.hic.edges(inter_chromosomal=False))
         assert sum(1 for _ in edges) == 31
 
+    @pytest.mark.parametrize("key", [None, 'chr2', ('chr1', 'chr3'), ('chr1:1-2500', 'chr1:1500-5000')])
+    def test_edge_arrays(self, key):
+        edges = {(e.source, e.sink): e.weight for e in self.hic.edges(key, lazy=True)}
+
+        arrays = list(self.hic.edge_arrays(key, chunk_size=4))
+        source = np.concatenate([a[0] for a in arrays])
+        sink = np.concatenate([a[1] for a in arrays])
+        weight = np.concatenate([a[2] for a in arrays])
+
+        assert len(source) == len(edges)
+        for s, t, w in zip(source, sink, weight):
+            assert np.isclose(edges[(s, t)], w)
+
+        assert sum(len(a[0]) for a in self.hic.edge_arrays(inter_chromosomal=False)) == 31
+
+    def test_possible_pairs_by_distance(self):
+        mappable = np.random.random(200) > 0.3
+        mappable[:10] = False
+
+        expected = np.zeros(len(mappable))
+        for i in range(len(mappable)):
+            for j in range(i, len(mappable)):
+                if mappable[i] and mappable[j]:
+                    expected[j - i] += 1
+
+        assert np.array_equal(Hic._possible_pairs_by_distance(mappable), expected)
+        assert np.array_equal(Hic._possible_pairs_by_distance(np.ones(5, dtype=bool)), [5, 4, 3, 2, 1])
+
+    def test_expected_values(self):
+        intra_sums = np.zeros(5)
+        intra_counts = np.zeros(5)
+        inter_sum = 0
+        chromosome_bins = self.hic.chromosome_bins
+        chromosome_of = {}
+        for chromosome, (start, end) in chromosome_bins.items():
+            for i in range(start, end):
+                chromosome_of[i] = chromosome
+            for d in range(end - start):
+                intra_counts[d] += end - start - d
+
+        for edge in self.hic.edges(norm=False, lazy=True):
+            if chromosome_of[edge.source] == chromosome_of[edge.sink]:
+                intra_sums[edge.sink - edge.source] += edge.weight
+            else:
+                inter_sum += edge.weight
+
+        intra, intra_chromosome, inter = self.hic.expected_values(norm=False)
+        assert np.allclose(intra, intra_sums / intra_counts)
+        assert np.isclose(inter, inter_sum / (5 * 3 + 5 * 4 + 3 * 4))
+        assert len(intra_chromosome['chr2']) == 3
+        assert np.allclose(self.hic.expected_values('chr2', norm=False), intra_chromosome['chr2'])
+
+        # results are stored by bias version
+        assert self.hic._expected_value_group.uncorrected is not None
+        bias = self.hic.bias_vector()
+        bias[0] = 2.
+        self.hic.bias_vector(bias)
+        assert self.hic.bias_vector()[0] == 2.
+        assert self.hic._expected_value_group.corrected._v_attrs.bias_version == self.hic._bias_version
+        intra_corrected, _, _ = self.hic.expected_values(norm=True)
+        assert intra_corrected[0] > intra[0]
+
     def test_get_node_x_by_region(self):
         region1 = GenomicRegion.from_string('chr1')
         nodes1 = list(self.hic.regions(region1))
@@ -607,7 +950,71 @@ class TestHicBasic:
         m = self.hic[1:1, 2:2]
         assert np.array_equal(m.shape, [0, 0])
 
-    def test_merge(self):
+    @pytest.mark.parametrize("key", [None, 'chr2', ('chr1', 'chr3'), ('chr3', 'chr1'),
+                                     ('chr1:1-2500', 'chr1:1500-5000')])
+    @pytest.mark.parametrize("oe", [True, False])
+    @pytest.mark.parametrize("log", [True, False])
+    def test_matrix_from_entries(self, key, oe, log):
+        default_value = 1.0 if oe else 0.0
+        row_regions, col_regions, entries = self.hic.regions_and_matrix_entries(key, oe=oe, lazy=True)
+        expected = np.full((len(row_regions), len(col_regions)), default_value)
+        for i, j, weight in entries:
+            if i < expected.shape[0] and j < expected.shape[1]:
+                expected[i, j] = weight
+        if log:
+            with np.errstate(divide='ignore'):
+                expected = np.log2(expected)
+            expected[~np.isfinite(expected)] = default_value
+
+        m = self.hic.matrix(key, oe=oe, log=log)
+        assert np.allclose(m.data, expected)
+
+    @pytest.mark.parametrize("key", [None, 'chr2', ('chr1', 'chr3'), ('chr3', 'chr1'),
+                                     ('chr1:1-2500', 'chr1:1500-5000')])
+    @pytest.mark.parametrize("format", ['csr', 'coo'])
+    def test_sparse_matrix(self, key, format):
+        m = self.hic.matrix(key)
+        m_sparse = self.hic.sparse_matrix(key, format=format)
+
+        assert m_sparse.format == format
+        assert np.allclose(m_sparse.toarray(), m.data)
+        assert m_sparse.row_regions == m.row_regions
+        assert m_sparse.col_regions == m.col_regions
+
+        m_oe = self.hic.matrix(key, oe=True)
+        m_oe_sparse = self.hic.sparse_matrix(key, oe=True, format=format)
+        nonzero = m_oe_sparse.toarray() != 0
+        assert np.allclose(m_oe_sparse.toarray()[nonzero], m_oe.data[nonzero])
+
+        with pytest.raises(ValueError):
+            self.hic.sparse_matrix(key, format='dense')
+
+    def test_correct_matrix_sparse(self):
+        m = np.random.randint(1, 100, size=(30, 30)).astype(np.float64)
+        m = m + m.T
+        m[[3, 17], :] = 0
+        m[:, [3, 17]] = 0
+
+        m_corrected, bias = correct_matrix(m)
+        m_corrected_sparse, bias_sparse = correct_matrix(sp.csr_matrix(m))
+
+        assert sp.issparse(m_corrected_sparse)
+        assert np.allclose(bias, bias_sparse)
+        assert np.allclose(m_corrected, m_corrected_sparse.toarray())
+
+        # very sparse matrix, balancing only succeeds after removing sparse rows
+        rs = np.random.RandomState(0)
+        m = np.triu(rs.poisson(0.05, size=(40, 40)).astype(np.float64))
+        m = m + np.triu(m, 1).T
+
+        m_corrected, bias = correct_matrix(m)
+        m_corrected_sparse, bias_sparse = correct_matrix(sp.csr_matrix(m))
+
+        assert np.sum(bias_sparse == 0) > np.sum(m.sum(axis=0) == 0)
+        assert np.allclose(bias, bias_sparse, rtol=1e-3)
+        assert np.allclose(m_corrected, m_corrected_sparse.toarray())
+
+    def test_merge(self, tmpdir):
         hic = self.hic_class()
 
         # add some nodes (120 to be exact)
@@ -633,6 +1040,13 @@ class TestHicBasic:
         # check length
         merged_hic_2x = Hic.merge([self.hic, hic])
         merged_hic_3x = Hic.merge([self.hic, hic, hic])
+        merged_hic_3x_threads = Hic.merge_region_matrix_tables([self.hic, hic, hic], threads=3, chunk_size=7,
+                                                               tmpdir=str(tmpdir))
+        # positional arguments are passed to the constructor
+        merged_hic_file = Hic.merge([self.hic, hic], str(tmpdir.join('merged.hic')))
+        assert os.path.isfile(str(tmpdir.join('merged.hic')))
+        assert np.array_equal(merged_hic_file[:, :], merged_hic_2x[:, :])
+        merged_hic_file.close()
         hic.close()
 
         m = self.hic[:, :]
@@ -643,8 +1057,10 @@ class TestHicBasic:
             for j in range(m.shape[1]):
                 assert m[i, j] == 0 or m[i, j] == m_merged_2x[i, j] / 2
                 assert m[i, j] == 0 or m[i, j] == m_merged_3x[i, j] / 3
+        assert np.array_equal(m_merged_3x, merged_hic_3x_threads[:, :])
         merged_hic_2x.close()
         merged_hic_3x.close()
+        merged_hic_3x_threads.close()
 
     def test_from_pairs(self):
         sam_file1 = os.path.join(self.dir, "test_matrix", "yeast.sample.chrI.1_sorted.sam")
@@ -678,6 +1094,68 @@ class TestHicBasic:
         assert reads == pl
         hic.close()
 
+    def test_from_pairs_partitions(self):
+        sam_file1 = os.path.join(self.dir, "test_matrix", "yeast.sample.chrI.1_sorted.sam")
+        sam_file2 = os.path.join(self.dir, "test_matrix", "yeast.sample.chrI.2_sorted.sam")
+        chrI = Chromosome.from_fasta(os.path.join(self.dir, "test_matrix", "chrI.fa"))
+        genome = Genome(chromosomes=[chrI])
+        regions = genome.get_regions('HindIII')
+
+        # pair partitions differ from Hi-C partitions
+        pairs = ReadPairs(partition_strategy=10)
+        pairs.add_regions(regions.regions)
+        pairs.add_read_pairs(SamBamReadPairGenerator(sam_file1, sam_file2))
+        genome.close()
+        regions.close()
+
+        counts = defaultdict(int)
+        for pair in pairs.pairs(lazy=True):
+            counts[(pair.left.fragment.ix, pair.right.fragment.ix)] += 1
+
+        hic = pairs.to_hic(chunk_size=100, _hic_class=self.hic_class)
+        pairs.close()
+
+        hic_counts = dict()
+        for edge in hic.edges(lazy=True):
+            key = (edge.source, edge.sink)
+            assert key not in hic_counts
+            hic_counts[key] = edge.weight
+        hic.close()
+
+        assert hic_counts == counts
+
+    def test_from_pairs_binned(self):
+        sam_file1 = os.path.join(self.dir, "test_matrix", "yeast.sample.chrI.1_sorted.sam")
+        sam_file2 = os.path.join(self.dir, "test_matrix", "yeast.sample.chrI.2_sorted.sam")
+        chrI = Chromosome.from_fasta(os.path.join(self.dir, "test_matrix", "chrI.fa"))
+        genome = Genome(chromosomes=[chrI])
+
+        pairs = ReadPairs(partition_strategy=10)
+        pairs.add_regions(genome.get_regions('HindIII').regions)
+        pairs.add_read_pairs(SamBamReadPairGenerator(sam_file1, sam_file2))
+
+        bin_sizes = [10000, 3333]
+        hics = pairs.to_hic(bin_size=bin_sizes, chunk_size=100, _hic_class=self.hic_class)
+        assert len(hics) == 2
+
+        for bin_size, hic in zip(bin_sizes, hics):
+            bins = genome.get_regions(bin_size)
+            assert [(r.start, r.end) for r in hic.regions] == [(r.start, r.end) for r in bins.regions]
+            bins.close()
+
+            n_bins = len(hic.regions)
+            counts = defaultdict(int)
+            for pair in pairs.pairs(lazy=True):
+                bin1 = min(pair.left.position // bin_size, n_bins - 1)
+                bin2 = min(pair.right.position // bin_size, n_bins - 1)
+                counts[(min(bin1, bin2), max(bin1, bin2))] += 1
+
+            hic_counts = {(edge.source, edge.sink): edge.weight for edge in hic.edges(lazy=True)}
+            assert hic_counts == counts
+            hic.close()
+        pairs.close()
+        genome.close()
+
     def test_overlap_map(self):
         # ----|----|----|----|---|-----|-| new
         # -------|-------|-------|-------| old
@@ -888,6 +1366,179 @@ class TestHicBasic:
         hic.close()
         binned.close()
 
+    def test_coarsen_bin(self, tmpdir):
+        dest_file = os.path.join(str(tmpdir), "hic.h5")
+
+        hic = self.hic_class(file_name=dest_file, mode='w')
+        for chromosome, n_bins, length in (('chr1', 5, 450), ('chr2', 2, 200)):
+            for i in range(n_bins):
+                hic.add_region(GenomicRegion(chromosome=chromosome, start=i * 100 + 1,
+                                             end=min(length, (i + 1) * 100)))
+        hic.flush()
+        for source in range(7):
+            for sink in range(source, 7):
+                hic.add_edge([source, sink, source + sink])
+        hic.flush()
+        hic.close()
+        hic = load(dest_file, mode='r')
+
+        regions = list(hic.regions)
+        bins = [GenomicRegion(chromosome='chr1', start=1, end=200),
+                GenomicRegion(chromosome='chr1', start=201, end=450),
+                GenomicRegion(chromosome='chr2', start=1, end=200)]
+        assert _coarsening_map(regions, bins).tolist() == [0, 0, 1, 1, 1, 2, 2]
+        assert _coarsening_map(regions, bins[:2]).tolist() == [0, 0, 1, 1, 1, -1, -1]
+        # not a multiple of the original bin size
+        assert _coarsening_map(regions, [GenomicRegion(chromosome='chr1', start=1, end=150),
+                                         GenomicRegion(chromosome='chr1', start=151, end=450)]) is None
+        # not equidistant
+        assert _coarsening_map(bins, regions) is None
+
+        binned = hic.bin(200)
+        assert len(binned.regions) == 4
+        m = hic.matrix(norm=False)
+        m_binned = binned.matrix(norm=False)
+        ixs = [[0, 1], [2, 3], [4], [5, 6]]
+        for i in range(4):
+            for j in range(i, 4):
+                block = m[np.ix_(ixs[i], ixs[j])]
+                if i == j:
+                    block = np.triu(block)
+                assert m_binned[i, j] == block.sum()
+        hic.close()
+        binned.close()
+
+    def test_density_partitions(self):
+        assert _balanced_partition_breaks([3, 1, 1, 1, 3, 1, 1, 1], 2) == [4]
+        assert _balanced_partition_breaks([1, 1, 1, 1, 10, 1, 1, 1, 1, 1], 3) == [4, 5]
+        assert _balanced_partition_breaks([0, 0, 0, 0], 2) == [2]
+        assert _balanced_partition_breaks([1, 2, 3], 1) == []
+
+        hic = self.hic_class(clustered=True, _edge_buffer_size='1M')
+        for chromosome, n_bins in (('chr1', 2000), ('chr2', 400), ('chr3', 100)):
+            for i in range(n_bins):
+                hic.add_region(GenomicRegion(chromosome=chromosome, start=i * 100 + 1, end=(i + 1) * 100))
+        hic.flush()
+        for i in range(2500):
+            hic.add_edge_simple(i, i, weight=1)
+        # dense block at the start of chr1
+        for i in range(300):
+            for j in range(i + 1, min(i + 30, 300)):
+                hic.add_edge_simple(i, j, weight=2)
+        hic.flush()
+        assert hic._partition_breaks == [1000, 2000]
+        assert np.allclose(hic._region_edge_density()[[0, 999, 1000, 2499]], [39.265, 10.265, 2, 2])
+
+        binned = hic.bin(100, partition_strategy='density', _edge_buffer_size='1M')
+        assert len(binned._partition_breaks) == 2
+        assert binned._partition_breaks[0] < 300
+        # small chromosomes share a partition
+        assert binned._partition_breaks[1] < 2000
+        original_sizes = [len(table) for (i, j), table in hic._iter_edge_tables() if i == j]
+        table_sizes = [len(table) for (i, j), table in binned._iter_edge_tables() if i == j]
+        assert max(table_sizes) < max(original_sizes) / 1.5
+        assert np.array_equal(hic.matrix(norm=False), binned.matrix(norm=False))
+
+        hic.close()
+        binned.close()
+
+    def test_clustered_edges(self):
+        rs = np.random.RandomState(0)
+        hics = [self.hic_class(partition_strategy=7, _edge_buffer_size='1M'),
+                self.hic_class(partition_strategy=7, clustered=True, _edge_buffer_size='1M')]
+        edges = set()
+        for _ in range(300):
+            source, sink = sorted(rs.randint(0, 30, 2))
+            edges.add((source, sink))
+        for hic in hics:
+            for i in range(30):
+                hic.add_region(GenomicRegion(chromosome='chr1', start=i * 100 + 1, end=(i + 1) * 100))
+            hic.flush()
+            # insert edges in random order
+            for source, sink in sorted(edges, key=lambda x: rs.rand()):
+                hic.add_edge_simple(source, sink, weight=source * 100 + sink)
+            hic.flush()
+
+        edge_table = hics[1]._edge_table(0, 2)
+        keys = edge_table.col('source') * 100 + edge_table.col('sink')
+        assert np.all(np.diff(keys) > 0)
+        assert hics[0]._clustered_row_ranges(0, 2, [(0, 6)]) is None
+        assert hics[1]._clustered_row_ranges(0, 2, [(0, 1), (1, 3), (5, 6)]) == \
+            [(0, sum(1 for s, t in edges if s <= 3 and 14 <= t < 21)),
+             (sum(1 for s, t in edges if s < 5 and 14 <= t < 21), len(edge_table))]
+
+        for key in ('chr1:250-1450', ('chr1:250-1450', 'chr1:1050-2950'),
+                    ('chr1:1650-2950', 'chr1:1-450'), ('chr1', 'chr1:701-1400')):
+            m = hics[0].matrix(key, norm=False)
+            m_clustered = hics[1].matrix(key, norm=False)
+            assert np.array_equal(m, m_clustered)
+            assert sorted((e.source, e.sink, e.weight) for e in hics[0].edges(key, norm=False)) == \
+                sorted((e.source, e.sink, e.weight) for e in hics[1].edges(key, norm=False))
+
+        for hic in hics:
+            hic.close()
+
+    def test_multi_resolution(self, tmpdir):
+        dest_file = os.path.join(str(tmpdir), "hic.mhic")
+
+        hic = self.hic_class()
+        for chromosome, n_bins, length in (('chr1', 10, 950), ('chr2', 4, 400)):
+            for i in range(n_bins):
+                hic.add_region(GenomicRegion(chromosome=chromosome, start=i * 100 + 1,
+                                             end=min(length, (i + 1) * 100)))
+        hic.flush()
+        for source in range(14):
+            for sink in range(source, 14):
+                hic.add_edge([source, sink, source + sink])
+        hic.flush()
+
+        with MultiResolutionHic(file_name=dest_file, mode='w') as mhic:
+            mhic.add_hic(hic, 100)
+            mhic.coarsen([400, 200])
+            assert mhic.resolutions() == [100, 200, 400]
+            with pytest.raises(ValueError):
+                mhic.coarsen(250)
+            with pytest.raises(ValueError):
+                mhic.hic(300)
+            assert np.array_equal(mhic.hic(100).matrix(norm=False), hic.matrix(norm=False))
+        hic.close()
+
+        mhic = load(dest_file)
+        assert isinstance(mhic, MultiResolutionHic)
+        assert mhic.resolutions() == [100, 200, 400]
+        mhic.close()
+
+        hic = load(dest_file, resolution=100)
+        for resolution in (200, 400):
+            binned = hic.bin(resolution)
+            hic_resolution = load(dest_file, resolution=resolution)
+            assert isinstance(hic_resolution, Hic)
+            assert [(r.chromosome, r.start, r.end) for r in hic_resolution.regions] == \
+                [(r.chromosome, r.start, r.end) for r in binned.regions]
+            assert np.allclose(hic_resolution.matrix(norm=False), binned.matrix(norm=False))
+            hic_resolution.close()
+            binned.close()
+
+        # worker processes must reopen the resolution, not the container
+        binned = hic.bin(150)
+        binned_threads = hic.bin(150, threads=2)
+        assert np.allclose(binned.matrix(norm=False), binned_threads.matrix(norm=False))
+        binned.close()
+        binned_threads.close()
+        hic.close()
+
+        with MultiResolutionHic(file_name=dest_file, mode='a') as mhic:
+            hic_threads = mhic.hic(100)
+            hic_threads.filter(DiagonalFilter(hic_threads, distance=1), queue=True)
+            hic_threads.run_queued_filters(threads=2)
+            m = hic_threads.matrix(norm=False)
+            for i in range(m.shape[0]):
+                for j in range(m.shape[1]):
+                    assert m[i, j] == (0 if abs(i - j) <= 1 else i + j)
+
+        with pytest.raises(ValueError):
+            load(dest_file, resolution=300)
+
     def test_knight_matrix_balancing(self):
         chrI = Chromosome.from_fasta(self.dir + "/test_matrix/chrI.fa")
         genome = Genome(chromosomes=[chrI])
@@ -961,6 +1612,33 @@ class TestHicBasic:
             assert (sum_m_corr[0] - 5 < n < sum_m_corr[0] + 5) or n == 0
         hic.close()
 
+    def test_ice_matrix_balancing_per_chromosome(self):
+        bias = ice_balancing(self.hic, whole_matrix=False)
+        for chromosome in self.hic.chromosomes():
+            m_corr = self.hic.matrix((chromosome, chromosome))
+            marginals = np.sum(m_corr, axis=0)
+            assert np.allclose(marginals, marginals[0], rtol=1e-2)
+
+        bias_parallel = ice_balancing(self.hic, whole_matrix=False, threads=2)
+        assert np.allclose(bias, bias_parallel)
+
+    @pytest.mark.parametrize("whole_matrix", [True, False])
+    @pytest.mark.parametrize("inter_chromosomal", [True, False])
+    @pytest.mark.parametrize("restore_coverage", [True, False])
+    def test_ice_matrix_balancing_out_of_core(self, whole_matrix, inter_chromosomal, restore_coverage):
+        bias = ice_balancing(self.hic, whole_matrix=whole_matrix, inter_chromosomal=inter_chromosomal,
+                             restore_coverage=restore_coverage)
+        # 800 bytes: only a few edges per chunk
+        bias_out_of_core = ice_balancing(self.hic, whole_matrix=whole_matrix,
+                                         inter_chromosomal=inter_chromosomal,
+                                         restore_coverage=restore_coverage,
+                                         out_of_core=True, memory_budget=800)
+        assert np.allclose(bias, bias_out_of_core)
+
+        bias_vc = self.hic.normalise('vc', whole_matrix=whole_matrix)
+        bias_vc_out_of_core = self.hic.normalise('vc', whole_matrix=whole_matrix, out_of_core=True)
+        assert np.allclose(bias_vc, bias_vc_out_of_core)
+
     def test_diagonal_filter(self):
         hic = self.hic
 
@@ -991,6 +1669,38 @@ class TestHicBasic:
                 else:
                     assert m[i, j] != 0
 
+    def test_filter_threads(self, tmpdir):
+        matrices = []
+        for threads in (1, 2):
+            hic = self.hic_class(file_name=str(tmpdir.join('threads_{}.hic'.format(threads))), mode='w',
+                                 partition_strategy=3)
+            hic.add_regions(self.hic.regions(lazy=False))
+            hic.add_edges(self.hic.edges(lazy=False, norm=False))
+            hic.filter(DiagonalFilter(hic, distance=1), queue=True)
+            hic.filter(LowCoverageFilter(hic, cutoff=201), queue=True)
+            hic.run_queued_filters(threads=threads)
+            matrices.append(hic.matrix(norm=False))
+            hic.close()
+        assert np.array_equal(matrices[0], matrices[1])
+        assert np.array_equal(matrices[0].mask, matrices[1].mask)
+
+        # no edge tables to filter
+        hic = self.hic_class(file_name=str(tmpdir.join('empty.hic')), mode='w')
+        hic.filter(DiagonalFilter(hic, distance=1), queue=True)
+        assert hic.run_queued_filters(threads=2) == dict()
+        hic.close()
+
+    def test_edge_filter_chunks(self):
+        hic = self.hic
+
+        filters = [DiagonalFilter(hic, distance=1), LowCoverageFilter(hic, cutoff=201)]
+        for f in filters:
+            assert f.supports_chunks()
+            for _, edge_table in hic._iter_edge_tables():
+                rows_valid = [f.valid(row) for row in edge_table._iter_visible_and_masked()]
+                chunk_valid = f.valid_chunk(edge_table.read())
+                assert chunk_valid.tolist() == rows_valid
+
     def test_to_cooler(self, tmpdir):
         cooler = pytest.importorskip("cooler")
         out = str(tmpdir.join("test_to_cooler.cool"))
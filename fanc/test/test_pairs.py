@@ -3,7 +3,8 @@ import pytest
 from fanc.pairs import SamBamReadPairGenerator, ReadPairs, UnmappedFilter, FragmentReadPair, \
     FragmentRead, InwardPairsFilter, OutwardPairsFilter, ContaminantFilter, QualityFilter, \
     BwaMemQualityFilter, ReDistanceFilter, SelfLigationFilter, LazyFragment, LazyFragmentRead, \
-    PCRDuplicateFilter
+    PCRDuplicateFilter, MinimalRead, _fragment_info_arrays, _fragment_info_pairs, \
+    _read_pair_records, _duplicate_run_anchors
 from genomic_regions import GenomicRegion
 from fanc.regions import Genome, Chromosome
 from fanc.general import Mask
@@ -166,6 +167,142 @@ class TestReadPairs:
         assert b.tolist() == [830, 413, 423]
         pairs.close()
 
+    def test_filter_chunks(self):
+        sam_file1 = os.path.join(self.dir, "test_matrix", "yeast.sample.chrI.1_sorted.sam")
+        sam_file2 = os.path.join(self.dir, "test_matrix", "yeast.sample.chrI.2_sorted.sam")
+
+        chrI = Chromosome.from_fasta(os.path.join(self.dir, "test_matrix", "chrI.fa"))
+        genome = Genome(chromosomes=[chrI])
+        pairs = self.pairs_class()
+        regions = genome.get_regions('HindIII')
+        pairs.add_regions(regions.regions)
+        pair_generator = SamBamReadPairGenerator(sam_file1, sam_file2)
+        pairs.add_read_pairs(pair_generator)
+        genome.close()
+        regions.close()
+
+        filters = [InwardPairsFilter(minimum_distance=5000), OutwardPairsFilter(minimum_distance=5000),
+                   ReDistanceFilter(maximum_distance=300), SelfLigationFilter()]
+        for f in filters:
+            f.set_pairs_object(pairs)
+            assert f.supports_chunks()
+            for _, edge_table in pairs._iter_edge_tables():
+                rows_valid = [f.valid(row) for row in edge_table._iter_visible_and_masked()]
+                chunk_valid = f.valid_chunk(edge_table.read())
+                assert chunk_valid.tolist() == rows_valid
+        pairs.close()
+
+    def test_filter_threads(self, tmpdir):
+        sam_file1 = os.path.join(self.dir, "test_matrix", "yeast.sample.chrI.1_sorted.sam")
+        sam_file2 = os.path.join(self.dir, "test_matrix", "yeast.sample.chrI.2_sorted.sam")
+
+        chrI = Chromosome.from_fasta(os.path.join(self.dir, "test_matrix", "chrI.fa"))
+        genome = Genome(chromosomes=[chrI])
+        regions = genome.get_regions('HindIII')
+
+        filter_stats = []
+        for threads in (1, 2):
+            pairs = self.pairs_class(file_name=str(tmpdir.join("threads_{}.pairs".format(threads))), mode='w')
+            pairs.add_regions(regions.regions)
+            pair_generator = SamBamReadPairGenerator(sam_file1, sam_file2)
+            pairs.add_read_pairs(pair_generator)
+            pairs.filter_inward(minimum_distance=5000, queue=True)
+            pairs.filter_self_ligated(queue=True)
+            pairs.filter_pcr_duplicates(threshold=3, queue=True)
+            stats = pairs.run_queued_filters(threads=threads)
+            assert stats[0] == len(pairs)
+            filter_stats.append(dict(pairs.filter_statistics()))
+            pairs.close()
+        genome.close()
+        regions.close()
+
+        assert filter_stats[0] == filter_stats[1]
+
+    def test_pcr_duplicates(self):
+        sam_file1 = os.path.join(self.dir, "test_matrix", "yeast.sample.chrI.1_sorted.sam")
+        sam_file2 = os.path.join(self.dir, "test_matrix", "yeast.sample.chrI.2_sorted.sam")
+
+        chrI = Chromosome.from_fasta(os.path.join(self.dir, "test_matrix", "chrI.fa"))
+        genome = Genome(chromosomes=[chrI])
+        regions = genome.get_regions('HindIII')
+
+        duplicates = []
+        for partition_strategy in ('chromosome', 10):
+            pairs = self.pairs_class(partition_strategy=partition_strategy)
+            pairs.add_regions(regions.regions)
+            pair_generator = SamBamReadPairGenerator(sam_file1, sam_file2)
+            pairs.add_read_pairs(pair_generator)
+
+            # exact duplicates
+            positions = set()
+            n_duplicates = 0
+            for pair in pairs.pairs(lazy=True):
+                key = (pair.left.fragment.chromosome, pair.right.fragment.chromosome,
+                       pair.left.position, pair.right.position)
+                if key in positions:
+                    n_duplicates += 1
+                positions.add(key)
+
+            pcr_filter = PCRDuplicateFilter(pairs, threshold=0)
+            assert np.sum(pcr_filter.duplicates) == n_duplicates
+            assert sum((k - 1) * v for k, v in pcr_filter.duplicate_stats.items()) == n_duplicates
+
+            pcr_filter = PCRDuplicateFilter(pairs, threshold=3)
+            duplicates.append(pcr_filter.duplicates)
+            pairs.close()
+        genome.close()
+        regions.close()
+
+        assert len(duplicates[0]) == len(duplicates[1])
+        assert np.array_equal(duplicates[0], duplicates[1])
+
+    def test_duplicate_run_anchors(self):
+        groups = np.zeros(6, dtype=np.int64)
+        left_positions = np.array([100, 100, 102, 103, 104, 108])
+        right_positions = np.array([500, 900, 500, 501, 500, 500])
+        # the pair at 900 starts a new run, later pairs are compared to it
+        anchors = _duplicate_run_anchors(groups, groups, left_positions, right_positions, 3)
+        assert list(anchors) == [0, 1, 2, 2, 2, 5]
+        # different groups never share a run
+        anchors = _duplicate_run_anchors(np.array([0, 1]), np.array([0, 0]),
+                                         np.array([100, 100]), np.array([500, 500]), 3)
+        assert list(anchors) == [0, 1]
+
+    def test_fragment_info_early_exit(self):
+        chromosome = self.pairs.regions[0].chromosome
+        read_pairs = ((MinimalRead(chromosome, 100 + i % 40000, '+'), MinimalRead(chromosome, 200 + i % 40000, '-'))
+                      for i in range(100000))
+        pair_batches = self.pairs._read_pairs_fragment_info(read_pairs, threads=1, batch_size=100)
+        assert len(next(pair_batches)) > 0
+        # must not wait for the read pair thread, which has no free slots left
+        pair_batches.close()
+
+    def test_fragment_info_pairs(self):
+        fragments, chromosomes = _fragment_info_arrays(self.pairs.regions(lazy=True),
+                                                       self.pairs._chromosome_to_ix)
+        chromosome = self.pairs.regions[0].chromosome
+        read_pairs = [(MinimalRead(chromosome, 1200, '+'), MinimalRead(chromosome, 5066, '-')),
+                      (MinimalRead(chromosome, 5500, '-'), MinimalRead(chromosome, 1000, '+')),
+                      (MinimalRead('foo', 10, '+'), MinimalRead(chromosome, 10, '+')),
+                      (MinimalRead(chromosome, 60000, '+'), MinimalRead(chromosome, 10, '+'))]
+        reads_batches = list(_read_pair_records(read_pairs, self.pairs._chromosome_to_ix, batch_size=3))
+        assert [len(reads) for reads in reads_batches] == [3, 1]
+        reads = np.concatenate(reads_batches)
+        pairs = _fragment_info_pairs(reads, fragments, chromosomes)
+
+        # unknown chromosome and position beyond chromosome end are skipped
+        assert len(pairs) == 2
+        assert pairs['source'].tolist() == [1, 1]
+        assert pairs['sink'].tolist() == [5, 5]
+        assert pairs['left_read_position'].tolist() == [1200, 1000]
+        assert pairs['left_read_strand'].tolist() == [1, 1]
+        assert pairs['right_read_position'].tolist() == [5066, 5500]
+        assert pairs['right_read_strand'].tolist() == [-1, -1]
+        assert pairs['left_fragment_start'].tolist() == [1001, 1001]
+        assert pairs['left_fragment_end'].tolist() == [2000, 2000]
+        assert pairs['right_fragment_start'].tolist() == [5001, 5001]
+        assert pairs['right_fragment_end'].tolist() == [6000, 6000]
+
     def test_re_dist(self):
         read1 = FragmentRead(GenomicRegion(chromosome='chr1', start=1, end=1000), position=200, strand=-1)
         assert read1.re_distance() == 199
@@ -179,6 +179,29 @@ class TestRegionsTable(RegionBasedTestFactory):
         self.regions.close()
         self.empty_regions.close()
 
+    def test_region_arrays(self):
+        arrays = self.regions._region_arrays()
+        assert arrays['sorted']
+        assert arrays['chromosome_names'] == ['chr1', 'chr2', 'chr3']
+        assert arrays['chromosome_bounds'] == [(0, 9), (9, 23), (23, 29)]
+        assert np.array_equal(arrays['start'][:3], [1, 1001, 2001])
+
+        for key in ['chr1', 'chr2:1-5001', 'chr1:3400-8100', 'chr3:6002-6500', 'chr4']:
+            region = GenomicRegion.from_string(key)
+            query = "(chromosome == b'{}')".format(region.chromosome)
+            if region.start is not None:
+                query += " & (start <= {}) & (end >= {})".format(region.end, region.start)
+            expected = [row['ix'] for row in self.regions._regions.where(query)]
+            assert [r.ix for r in self.regions.regions(key)] == expected
+
+        # cache is discarded when regions change
+        self.regions.add_region(GenomicRegion(start=1, end=1000, chromosome='chr1'))
+        self.regions.flush()
+        arrays = self.regions._region_arrays()
+        assert not arrays['sorted']
+        assert len(arrays['start']) == 30
+        assert [r.ix for r in self.regions.regions('chr1:1-1000')] == [0, 29]
+
     def test_add_additional_fields(self):
         # GenomicRegion
         self.empty_regions.add_region(GenomicRegion(start=1, end=1000, chromosome='chr1', a=10, b='ten'))
@@ -18,6 +18,9 @@ from future.utils import string_types
 import pysam
 import threading
 import multiprocessing as mp
+from queue import Empty
+from multiprocessing import shared_memory
+import numpy as np
 import warnings
 
 random.seed(0)
@@ -530,6 +533,155 @@ class WorkerMonitor(object):
             return True
 
 
+def share_array(array):
+    """
+    Copy a numpy array into a new shared memory block.
+
+    The returned descriptor can be sent to other processes, which
+    obtain a view of the array with :func:`~attached_array`.
+    The caller owns the shared memory block and must close and
+    unlink it when it is no longer needed.
+
+    :param array: numpy array
+    :return: tuple (:class:`~multiprocessing.shared_memory.SharedMemory`, descriptor)
+    """
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[...] = array
+    return shm, (shm.name, array.shape, array.dtype)
+
+
+def attached_array(descriptor):
+    """
+    Attach to an array shared with :func:`~share_array`.
+
+    Keep a reference to the returned shared memory block for as
+    long as the array is used, and close it afterwards.
+
+    :param descriptor: descriptor returned by :func:`~share_array`
+    :return: tuple (:class:`~multiprocessing.shared_memory.SharedMemory`, numpy array)
+    """
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+class SharedArraySlots(object):
+    """
+    Ring of equally sized numpy array slots in a single shared memory block.
+
+    Used to pass fixed-dtype records between processes without pickling
+    them: a producer acquires a free slot, fills it and sends only the
+    slot index and record count to the consumer, which releases the slot
+    once it has copied the records.
+
+    Objects can be passed to worker processes at creation time, for
+    example as :class:`~multiprocessing.pool.Pool` initializer
+    arguments, where they attach to the existing memory block. The
+    creating process owns the block and must call :func:`~close`.
+
+    :param n_slots: Number of slots
+    :param slot_size: Maximum number of records per slot
+    :param dtype: numpy dtype of the records
+    :param context: multiprocessing context used to create the queue
+                    of free slots. Spawn context by default
+    """
+    def __init__(self, n_slots, slot_size, dtype, context=None):
+        if context is None:
+            context = mp.get_context("spawn")
+        self.n_slots = n_slots
+        self.slot_size = slot_size
+        self.dtype = np.dtype(dtype)
+        self._shm = shared_memory.SharedMemory(create=True,
+                                               size=max(1, n_slots * slot_size * self.dtype.itemsize))
+        self._owner = True
+        self._array = None
+        self._free_slots = context.Queue()
+        for i in range(n_slots):
+            self._free_slots.put(i)
+
+    def __getstate__(self):
+        return self._shm.name, self.n_slots, self.slot_size, self.dtype, self._free_slots
+
+    def __setstate__(self, state):
+        name, self.n_slots, self.slot_size, self.dtype, self._free_slots = state
+        self._shm = shared_memory.SharedMemory(name=name)
+        self._owner = False
+        self._array = None
+
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = np.ndarray((self.n_slots, self.slot_size), dtype=self.dtype,
+                                     buffer=self._shm.buf)
+        return self._array
+
+    def acquire(self, abort=None):
+        """
+        Wait for a free slot.
+
+        :param abort: Optional :class:`threading.Event`. Waiting stops
+                      once it is set, e.g. because the consumer is gone.
+        :return: slot index, or None if waiting was aborted
+        """
+        while True:
+            try:
+                return self._free_slots.get(timeout=1)
+            except Empty:
+                if abort is not None and abort.is_set():
+                    return None
+
+    def release(self, slot):
+        """
+        Return a slot to the pool of free slots.
+
+        :param slot: slot index from :func:`~acquire`
+        """
+        self._free_slots.put(slot)
+
+    def slot(self, slot, n=None):
+        """
+        Array view of a slot.
+
+        :param slot: slot index
+        :param n: Number of records in view. Full slot if None
+        :return: numpy structured array
+        """
+        if n is None:
+            n = self.slot_size
+        return self.array[slot, :n]
+
+    def put(self, records, abort=None):
+        """
+        Copy records into free slots.
+
+        :param records: numpy array of records with slot dtype
+        :param abort: Optional :class:`threading.Event`, see :func:`~acquire`.
+                      No further slots are returned once it is set.
+        :return: iterator over (slot index, number of records) tuples
+        """
+        for start in range(0, len(records), self.slot_size):
+            chunk = records[start:start + self.slot_size]
+            slot = self.acquire(abort=abort)
+            if slot is None:
+                return
+            self.array[slot, :len(chunk)] = chunk
+            yield slot, len(chunk)
+
+    def close(self):
+        """
+        Detach from the shared memory block, and free it if this is
+        the creating process.
+
+        Views obtained with :func:`~slot` must no longer be in use.
+        """
+        self._array = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
 def get_sam_mapper(sam_file):
     try:
         if isinstance(sam_file, pysam.AlignmentFile):
@@ -44,7 +44,9 @@ def load(file_name, *args, **kwargs):
     :param args: Positional arguments passed to the class/function that can
                  load the file
     :param kwargs: Keyword arguments passed to the class/function that can
-                   load the file
+                   load the file. For multi-resolution files
+                   (:class:`~MultiResolutionHic`), use :code:`resolution`
+                   to load a single resolution as :class:`~Hic`
     :return: object (:class:`~RegionBased`, :class:`~RegionMatrixContainer`,
              :class:`~RegionPairsContainer`, or :class:`~pysam.AlignmentFile`)
     """
@@ -64,6 +66,8 @@ def load(file_name, *args, **kwargs):
         logger.debug("Class ID string: {}".format(classid))
         cls_ = class_id_dict[classid]
         logger.debug("Detected {}".format(cls_))
+        if hasattr(cls_, '_load_file'):
+            return cls_._load_file(file_name, mode=mode, *args, **kwargs)
         return cls_(file_name=file_name, mode=mode, *args, **kwargs)
     except (tables.HDF5ExtError, AttributeError, KeyError) as e:
         logger.debug("Not a FileBased class (exception: {})".format(e))